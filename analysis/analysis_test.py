@@ -5,15 +5,24 @@ Test the analysis
 import numpy as np
 import matplotlib.pyplot as plt
 import mne
+import config
 import load_data
 import fixation_events
-import dist_convert as dc
+import gaze_maps
+import preproc
+import filtered_cache
+
+dc = config.dist_convert()
 
 
 plt.ion()  # Interactive plots
 
 n = 0  # Which subject to analyze
 
+# Only read, filter and clean the data around the events, instead of the
+# whole continuous recording. See `preproc.py`.
+EPOCH_FIRST = True
+
 d = load_data.load_data(n)  # Load the data
 
 
@@ -24,7 +33,7 @@ plt.plot(d['eye'].fixations['x_avg'],
          'ob', alpha=0.4,
          markerfacecolor='none',
          label='Fixations')
-plt.plot(*np.transpose(fixation_events.stim_locs),
+plt.plot(*np.transpose(fixation_events.stim_locs()),
          '*r',
          label='Stimulus centers')
 plt.xlabel('X position')
@@ -33,25 +42,52 @@ plt.xlim(0, dc.screen_res[0])
 plt.ylim(0, dc.screen_res[1])
 plt.legend()
 
+# Duration-weighted density of the fixations
+maps = gaze_maps.GazeMaps()
+maps.add(d['fix_info'], subject=n)
+plt.figure()
+maps.plot()
+
 
 # Check whether we see a visual potential at stimulus onset
-d['raw'].load_data()  # Apply ICA
-d['raw'].filter(0.1, 40)  # Bandpass filter
-d['ica'].apply(d['raw'])
-epochs = mne.Epochs(d['raw'],
-                    d['meg_events'],
-                    event_id=load_data.expt_info['event_dict']['stimuli'],
-                    tmin=-0.2, tmax=1.0,
-                    baseline=(None, 0))
+if EPOCH_FIRST:
+    epochs = preproc.read_epochs(d['raw'],
+                                 d['meg_events'],
+                                 config.expt_info()['event_dict']['stimuli'],
+                                 tmin=-0.2, tmax=1.0,
+                                 l_freq=0.1, h_freq=40,
+                                 ica=d['ica'],
+                                 baseline=(None, 0))
+else:
+    # Band-pass filtered recording, from the cache in `data/filtered/`
+    raw_filt = filtered_cache.get(d['raw'], 0.1, 40.0)
+    epochs = mne.Epochs(raw_filt,
+                        d['meg_events'],
+                        event_id=config.expt_info()['event_dict']['stimuli'],
+                        tmin=-0.2, tmax=1.0,
+                        baseline=(None, 0),
+                        preload=True)
+    d['ica'].apply(epochs)
 evoked = epochs.average()
 evoked.plot(spatial_colors=True)
 
 
 # Check whether we see a fixation-induced potential
-epochs = mne.Epochs(d['raw'],
-                    d['fix_events'],
-                    event_id=load_data.expt_info['event_dict']['fix_on'],
-                    tmin=-0.2, tmax=1.0,
-                    baseline=(None, 0))
+if EPOCH_FIRST:
+    epochs = preproc.read_epochs(d['raw'],
+                                 d['fix_events'],
+                                 config.expt_info()['event_dict']['fix_on'],
+                                 tmin=-0.2, tmax=1.0,
+                                 l_freq=0.1, h_freq=40,
+                                 ica=d['ica'],
+                                 baseline=(None, 0))
+else:
+    epochs = mne.Epochs(raw_filt,
+                        d['fix_events'],
+                        event_id=config.expt_info()['event_dict']['fix_on'],
+                        tmin=-0.2, tmax=1.0,
+                        baseline=(None, 0),
+                        preload=True)
+    d['ica'].apply(epochs)
 evoked = epochs.average()
 evoked.plot(spatial_colors=True)
@@ -5,33 +5,26 @@ Copied from the script for saccades-attention v1
 """
 
 import os
-import json
-import socket
 import numpy as np
-import pandas as pd
 import mne
+import config
+import ica_fit
+import profiling
 # from load_data import meg_filename
 
-expt_info = json.load(open('expt_info.json'))
-
-hostname = socket.gethostname().lower()
-if hostname.startswith('colles'):
-    data_dir = expt_info['data_dir'][hostname]
-else:
-    data_dir = expt_info['data_dir']['standard']
-
-subject_info = pd.read_csv(data_dir + 'subject_info.csv',
-                           engine='python', sep=',')
-
 
 def identify_artifacts(n):
     """ Identify artifacts for a given subject number.
     """
+    data_dir = config.data_dir()
+    subject_info = config.subject_info()
+    expt_info = config.expt_info()
     subj_fname = str(subject_info['meg_dir'][n])
     meg_fname = subject_info['meg_fname'][n]
 
     # Read in the data
-    raw = mne.io.read_raw_fif(f"{data_dir}raw/{subj_fname}/{meg_fname}")
+    raw_fname = f"{data_dir}raw/{subj_fname}/{meg_fname}"
+    raw = mne.io.read_raw_fif(raw_fname)
 
     # Make annotations to mark everything that's not part of the trial.
     # This helps make sure that ICA doesn't pay attention to all the bad data
@@ -66,19 +59,19 @@ def identify_artifacts(n):
             annotations = mne.read_annotations(annot_fname)
         elif resp in 'Yy':
             print('Creating new artifact annotations')
-            annotations = identify_manual(raw)
+            annotations = identify_manual(raw, subj_fname)
             annotations.save(annot_fname)
         else:
             print(f'Option not recognized -- exiting')
             return None
     else:
-        annotations = identify_manual(raw)
+        annotations = identify_manual(raw, subj_fname)
         annotations.save(annot_fname)
     raw.set_annotations(annotations)
 
-    # ICA
-    raw_downsamp = downsample(raw, 10)  # Downsample before ICA
-    ica = identify_ica(raw_downsamp)
+    # ICA -- reuses any earlier fit in `ica/fits/`
+    ica, raw_downsamp, _ = ica_fit.fit_raw(raw, subj_fname, raw_fname)
+    identify_ica(raw_downsamp, ica)
     ica_fname = f'{data_dir}ica/{subj_fname}-ica.fif'
     ica.save(ica_fname)
 
@@ -90,16 +83,23 @@ def identify_artifacts(n):
     # raw.plot()
 
 
-def downsample(raw, downsample_factor):
+@profiling.profiled('artifacts.downsample')
+def downsample(raw, downsample_factor, data=None):
     """ Resample a raw data object without any filtering.
         This is only for use in ICA. Using this on other
         analyses could result in aliasing.
+
+    data: Already-decimated data (e.g. from a cache) to use instead of
+          reading all the samples from `raw`
     """
     assert type(downsample_factor) is int
     assert downsample_factor > 1
-    d = raw.get_data()
-    decim_inx = np.arange(d.shape[1], step=downsample_factor)
-    d = d[:, decim_inx]
+    if data is None:
+        d = raw.get_data()
+        decim_inx = np.arange(d.shape[1], step=downsample_factor)
+        d = d[:, decim_inx]
+    else:
+        d = data
     info = raw.info.copy()
     info['sfreq'] /= downsample_factor
     first_samp = raw.first_samp / downsample_factor  # Adj for beg of recording
@@ -108,16 +108,30 @@ def downsample(raw, downsample_factor):
     return raw_downsamp
 
 
-def identify_manual(raw):
+def identify_manual(raw, subj_fname=None):
     """ Manually identify raw artifacts
-    First click on "Add label"
-    Edit the label -- glitch, jump, etc
-    Click and drag to set a new annotation (with some delay)
+
+    subj_fname: If given, browse the recording with `envelope.Browser`,
+        using the min/max envelope kept next to the annotations (made the
+        first time). Click and drag to mark a bad segment, right-click on
+        one to remove it, and scroll/zoom with the arrow keys.
+    Otherwise, the filtered recording is shown in mne's browser:
+        First click on "Add label"
+        Edit the label -- glitch, jump, etc
+        Click and drag to set a new annotation (with some delay)
+    The filtered data come from `filtered_cache`, so they're only computed
+    once, and aren't loaded into memory all at once.
     """
-    raw_annot = raw.copy()
-    raw_annot.load_data()
+    import filtered_cache
+    if subj_fname is not None:
+        import envelope
+        env = envelope.get(raw, subj_fname)
+        browser = envelope.Browser(raw, env)
+        input('Press ENTER when finished tagging artifacts')
+        return browser.annotations
+
+    raw_annot = filtered_cache.get(raw, 0.5, 40.0, ch_types=('meg', 'eog'))
     raw_annot.pick(['meg', 'eog', 'stim'])
-    raw_annot.filter(0.5, 40, picks=['meg', 'eog'])
     # Initialize an event
     raw_annot.annotations.append(onset=0,
                                  duration=0.001,
@@ -130,10 +144,10 @@ def identify_manual(raw):
     return raw_annot.annotations
 
 
-def identify_ica(raw):
-    """ Use ICA to reject artifacts
+@profiling.profiled('artifacts.fit_ica')
+def fit_ica(raw):
+    """ Fit ICA without any user interaction
     """
-    # Perform ICA
     ica = mne.preprocessing.ICA(
             n_components=20,  # Number of components to return
             max_pca_components=None,  # Don't reduce dimensionality too much
@@ -141,6 +155,17 @@ def identify_ica(raw):
             max_iter=800,
             verbose='INFO')
     ica.fit(raw, reject_by_annotation=True)
+    return ica
+
+
+def identify_ica(raw, ica=None):
+    """ Use ICA to reject artifacts
+
+    ica: An ICA that was already fit to `raw`. If None, fit a new one.
+    """
+    # Perform ICA
+    if ica is None:
+        ica = fit_ica(raw)
 
     # Plot ICA results
     ica.plot_components(inst=raw)  # Scalp topographies - Click for more info
@@ -0,0 +1,251 @@
+"""
+Benchmarks for the analysis pipeline
+
+Run them from the terminal: `python benchmarks.py <name> [arguments]`
+- `python benchmarks.py epochs <subject number>`: Epoch-first preprocessing
+  vs. filtering the whole recording (needs real data)
+- `python benchmarks.py suite [results.json]`: Time the main analysis steps
+  on synthetic data of a few different sizes (runs anywhere)
+- `python benchmarks.py imports [results.json]`: Time importing each
+  analysis module in a fresh process
+- `python benchmarks.py decoding [results.json]`: Time cross-validated
+  decoding of synthetic epochs with different numbers of processes
+"""
+
+import os
+import sys
+import json
+import time
+import tempfile
+import platform
+import subprocess
+import tracemalloc
+import numpy as np
+
+
+def _measure(fun, *args, **kwargs):
+    """ Run a function and measure its run time and peak memory use.
+    Returns the output of the function, the time (s) and peak memory (MB).
+    """
+    tracemalloc.start()
+    t_start = time.perf_counter()
+    out = fun(*args, **kwargs)
+    t = time.perf_counter() - t_start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return out, t, peak / 1e6
+
+
+def bench_epochs(n=0):
+    """ Compare epoch-first preprocessing (`preproc.read_epochs`) against
+    filtering the whole recording and applying ICA to it.
+    """
+    import mne
+    import config
+    import load_data
+    import preproc
+
+    d = load_data.load_data(n)
+    event_id = config.expt_info()['event_dict']['stimuli']
+    epoch_params = dict(tmin=-0.2, tmax=1.0, baseline=(None, 0))
+
+    # Epoch-first: read only the windows around the events
+    def epoch_first():
+        epochs = preproc.read_epochs(d['raw'], d['meg_events'], event_id,
+                                     l_freq=0.1, h_freq=40, ica=d['ica'],
+                                     **epoch_params)
+        return epochs.average()
+
+    # Current path: load, filter and clean the whole recording
+    def full_raw():
+        raw = d['raw'].copy()
+        raw.load_data()
+        raw.filter(0.1, 40)
+        d['ica'].apply(raw)
+        epochs = mne.Epochs(raw, d['meg_events'], event_id=event_id,
+                            **epoch_params)
+        return epochs.average()
+
+    evk_fast, t_fast, mem_fast = _measure(epoch_first)
+    evk_full, t_full, mem_full = _measure(full_raw)
+
+    print('Method        Time (s)  Peak memory (MB)')
+    print(f'Epoch-first   {t_fast:8.1f}  {mem_fast:16.0f}')
+    print(f'Full raw      {t_full:8.1f}  {mem_full:16.0f}')
+    diff = abs(evk_fast.data - evk_full.data).max()
+    print(f'Max difference between evoked responses: {diff:.3g}')
+
+
+def _time_it(fun, repeat):
+    """ Run a function several times.
+    Returns the output of the last run, and the median and minimum run time.
+    """
+    times = []
+    for _ in range(repeat):
+        t_start = time.perf_counter()
+        out = fun()
+        times.append(time.perf_counter() - t_start)
+    return out, float(np.median(times)), float(np.min(times))
+
+
+SUITE_SCALES = [25, 100, 400]  # Number of trials in each synthetic subject
+
+
+def bench_suite(out_fname=None, scales=SUITE_SCALES, repeat=3):
+    """ Time the main steps of the analysis on synthetic subjects with
+    different numbers of trials.
+
+    out_fname: Save the results to this JSON file, to compare across runs
+    """
+    import synthetic_data
+
+    import config
+    data_dir = tempfile.mkdtemp(prefix='synth_') + '/'
+    print(f'Making synthetic data in {data_dir}')
+    synthetic_data.make_cohort(data_dir, len(scales), n_trials=scales)
+    config.set_data_dir(data_dir)
+
+    import mne
+    import pandas as pd
+    import load_data
+    import eyelink_parser
+    import fixation_events
+    import artifacts
+    mne.set_log_level('WARNING')
+
+    results = []
+
+    def run(name, n, fun):
+        _, t_med, t_min = _time_it(fun, repeat)
+        results.append({'benchmark': name,
+                        'n_trials': scales[n],
+                        'median_s': t_med,
+                        'min_s': t_min})
+        print(f'{name:36s} {scales[n]:5d} trials  '
+              f'median {t_med:8.3f} s  min {t_min:8.3f} s')
+
+    info = config.subject_info()
+    for n in range(len(scales)):
+        eye_fname = f'{data_dir}eyelink/ascii/{info["eyelink"][n]}.asc'
+        behav_fname = f'{data_dir}logfiles/{info["behav"][n]}.csv'
+        raw_fname = f'{data_dir}raw/{info["meg_dir"][n]}/' \
+                    f'{info["meg_fname"][n]}'
+        raw = mne.io.read_raw_fif(raw_fname, preload=True)
+        meg_events = mne.find_events(raw, stim_channel='STI101',
+                                     mask=0b00111111, shortest_event=1)
+        eye_data = eyelink_parser.EyelinkData(eye_fname)
+        fixations = eye_data.fixations.copy()
+        behav = pd.read_csv(behav_fname, sep=';')
+
+        def get_fix():
+            # get_fixation_events adds columns to the fixation table
+            eye_data.fixations = fixations.copy()
+            return fixation_events.get_fixation_events(meg_events, eye_data,
+                                                       behav)
+
+        run('eyelink_parser.EyelinkData', n,
+            lambda: eyelink_parser.EyelinkData(eye_fname))
+        run('fixation_events.get_fixation_events', n, get_fix)
+        run('artifacts.downsample', n, lambda: artifacts.downsample(raw, 10))
+        run('load_data.load_data', n, lambda: load_data.load_data(n))
+
+    if out_fname is not None:
+        report = {'python': platform.python_version(),
+                  'machine': platform.machine(),
+                  'processor': platform.processor(),
+                  'n_cpus': os.cpu_count(),
+                  'numpy': np.__version__,
+                  'pandas': pd.__version__,
+                  'mne': mne.__version__,
+                  'results': results}
+        with open(out_fname, 'w') as f:
+            json.dump(report, f, indent=2)
+    return results
+
+
+IMPORT_MODULES = ['config', 'profiling', 'fixation_table', 'eyelink_parser',
+                  'trigger_match', 'fixation_events', 'load_data',
+                  'fixation_db', 'preproc', 'artifacts', 'decoding']
+HEAVY_MODULES = ['pandas', 'mne', 'sklearn', 'matplotlib']
+
+
+def bench_imports(out_fname=None, repeat=5):
+    """ Time how long it takes to import each analysis module in a fresh
+    Python process, started outside of the analysis directory, and check
+    which heavy libraries each one pulls in.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    code = ('import sys, time, json\n'
+            't = time.perf_counter()\n'
+            'import {mod}\n'
+            't = time.perf_counter() - t\n'
+            'heavy = [m for m in {heavy!r} if m in sys.modules]\n'
+            'print(json.dumps([t, heavy]))\n')
+    env = dict(os.environ, PYTHONPATH=here)
+    results = []
+    for mod in IMPORT_MODULES:
+        times = []
+        for _ in range(repeat):
+            proc = subprocess.run([sys.executable, '-c',
+                                   code.format(mod=mod, heavy=HEAVY_MODULES)],
+                                  cwd=tempfile.gettempdir(), env=env,
+                                  capture_output=True, text=True)
+            if proc.returncode != 0:
+                print(f'{mod:20s} failed to import:')
+                print(proc.stderr.strip().splitlines()[-1])
+                break
+            t, heavy = json.loads(proc.stdout.strip().splitlines()[-1])
+            times.append(t)
+        else:
+            results.append({'module': mod,
+                            'median_s': float(np.median(times)),
+                            'heavy_imports': heavy})
+            print(f'{mod:20s} median {np.median(times):8.3f} s  '
+                  f'imports: {", ".join(heavy) or "-"}')
+    if out_fname is not None:
+        with open(out_fname, 'w') as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+def bench_decoding(out_fname=None, n_epochs=400, n_channels=100,
+                   n_times=50, generalize=True):
+    """ Time `decoding.decode` on synthetic epochs with 1, 2, 4, ...
+    worker processes. There's a weak signal in the data at a few time
+    points, so the scores can be checked too.
+    """
+    import decoding
+    rng = np.random.default_rng(0)
+    y = rng.integers(3, size=n_epochs)
+    X = rng.standard_normal([n_epochs, n_channels, n_times])
+    X = X.astype(np.float32)
+    signal = rng.standard_normal([3, n_channels])
+    t_signal = slice(n_times // 3, 2 * n_times // 3)
+    X[:, :, t_signal] += 0.3 * signal[y][:, :, None]
+    results = decoding.scaling(X, y, generalize=generalize)
+    if out_fname is not None:
+        report = {'python': platform.python_version(),
+                  'machine': platform.machine(),
+                  'cpu_count': os.cpu_count(),
+                  'shape': list(X.shape),
+                  'generalize': generalize,
+                  'results': results}
+        with open(out_fname, 'w') as f:
+            json.dump(report, f, indent=2)
+    return results
+
+
+BENCHMARKS = {'epochs': bench_epochs,
+              'suite': bench_suite,
+              'imports': bench_imports,
+              'decoding': bench_decoding}
+
+
+def main():
+    name = sys.argv[1]
+    args = [int(a) if a.isdigit() else a for a in sys.argv[2:]]
+    BENCHMARKS[name](*args)
+
+
+if __name__ == '__main__':
+    main()
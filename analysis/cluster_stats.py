@@ -0,0 +1,306 @@
+"""
+Cluster-based permutation tests for group analyses
+
+Works on one result per subject, e.g. evoked responses (sensors x times),
+decoding accuracy over time, or temporal generalization matrices (train
+times x test times). At each point, a t-test across subjects is computed,
+neighboring points over the threshold are grouped into clusters, and each
+cluster's mass (sum of t) is compared against the largest cluster mass from
+data where the conditions were shuffled (Maris & Oostenveld, 2007).
+- One-sample tests (e.g. accuracy - chance) flip the sign of each subject
+- Two-sample tests (groups of subjects) shuffle the group labels
+
+Permutations are made in batches. Within a batch, the t-values of every
+permutation come from one matrix product, and the clusters of every
+permutation come from one connected-components call on a graph that holds
+a copy of the neighborhood structure for each permutation. Batches can run
+in parallel processes. Each batch gets its own seed from `seed`, so the
+results don't depend on the number of processes.
+
+Example:
+    X, adjacency = cluster_stats.evoked_data(evokeds, ch_type='mag')
+    res = cluster_stats.permutation_test(X, adjacency, n_perm=5000,
+                                         n_jobs=8)
+    cluster_stats.print_clusters(res)
+"""
+
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+import config
+
+_worker = {}  # Data for the permutations in each worker process
+
+
+def chain_adjacency(n):
+    """ Adjacency of `n` points in a row (e.g. time points)
+    """
+    return sparse.diags([np.ones(n - 1), np.ones(n - 1)], [-1, 1],
+                        shape=(n, n), format='csr')
+
+
+def combine_adjacency(*adjacencies):
+    """ Adjacency of the points of a grid, from the adjacency along each of
+    its dimensions (e.g. sensors and times). Points are neighbors if they
+    are neighbors along one dimension and the same along all the others.
+    The points are in the order of `array.ravel()`.
+    """
+    sizes = [a.shape[0] for a in adjacencies]
+    combined = sparse.csr_matrix((np.prod(sizes), np.prod(sizes)))
+    for i, adj in enumerate(adjacencies):
+        before = sparse.identity(int(np.prod(sizes[:i])), format='csr')
+        after = sparse.identity(int(np.prod(sizes[i + 1:])), format='csr')
+        adj = sparse.csr_matrix(adj, dtype=float)
+        combined = combined + sparse.kron(sparse.kron(before, adj), after)
+    return combined.tocsr()
+
+
+def sensor_adjacency(info, ch_type='mag'):
+    """ Which sensors are neighbors, as a sparse (sensors, sensors) matrix,
+    in the order of `evoked.get_data(picks=ch_type)`
+    """
+    import mne
+    if hasattr(mne.channels, 'find_ch_adjacency'):
+        find = mne.channels.find_ch_adjacency
+    else:  # Called 'connectivity' before mne 0.20
+        find = mne.channels.find_ch_connectivity
+    adjacency, _ = find(info, ch_type)
+    return sparse.csr_matrix(adjacency)
+
+
+def evoked_data(evokeds, ch_type='mag'):
+    """ Stack one evoked response per subject for a test over
+    sensors x times.
+
+    Returns X (subjects, sensors, times) and the adjacency of the points.
+    """
+    X = np.stack([ev.get_data(picks=ch_type) for ev in evokeds])
+    adjacency = combine_adjacency(sensor_adjacency(evokeds[0].info, ch_type),
+                                  chain_adjacency(X.shape[2]))
+    return X, adjacency
+
+
+def decoding_data(results, chance=None):
+    """ Stack one result of `decoding.decode()` per subject (averaged over
+    the folds), minus chance, for a one-sample test.
+
+    chance: Chance accuracy (default: the most common label of each subject)
+    Returns X (subjects, times) or (subjects, times, times), and the
+    adjacency of the points.
+    """
+    X = np.stack([r['scores'].mean(axis=0) -
+                  (r['chance'] if chance is None else chance)
+                  for r in results])
+    adjacency = combine_adjacency(*[chain_adjacency(n) for n in X.shape[1:]])
+    return X, adjacency
+
+
+def _edges(adjacency):
+    """ Pairs of neighboring points (i < j)
+    """
+    adj = sparse.triu(sparse.csr_matrix(adjacency), k=1).tocoo()
+    return adj.row.astype(np.int64), adj.col.astype(np.int64)
+
+
+def _t_values(X, X2, perms, one_sample):
+    """ t-values for a batch of permutations, at every point
+
+    X: Data (subjects, points); X2: X ** 2
+    perms: (permutations, subjects). For one-sample tests, the sign of
+           each subject (+1/-1). Otherwise, 1 for the first group and 0 for
+           the second.
+    Returns (permutations, points)
+    """
+    n = X.shape[0]
+    if one_sample:
+        # Flipping signs doesn't change the sum of squares
+        mean = perms @ X / n
+        var = (X2.sum(axis=0) - n * mean ** 2) / (n - 1)
+        return mean / np.sqrt(var / n)
+    # Welch's t-test between the groups
+    n1 = perms.sum(axis=1, keepdims=True)
+    n2 = n - n1
+    sum1 = perms @ X
+    sum2 = X.sum(axis=0) - sum1
+    sq1 = perms @ X2
+    sq2 = X2.sum(axis=0) - sq1
+    mean1, mean2 = sum1 / n1, sum2 / n2
+    var1 = (sq1 - n1 * mean1 ** 2) / (n1 - 1)
+    var2 = (sq2 - n2 * mean2 ** 2) / (n2 - 1)
+    return (mean1 - mean2) / np.sqrt(var1 / n1 + var2 / n2)
+
+
+def _clusters(T, threshold, edges, sign):
+    """ Clusters of neighboring points where sign * T > threshold, for every
+    row (permutation) of T at once.
+
+    Returns the cluster label of each point (permutations, points; -1 for
+    points below threshold), the mass of each cluster, and the row that
+    each cluster is in.
+    """
+    n_perm, n_points = T.shape
+    T = sign * T
+    mask = T > threshold
+    i, j = edges
+    # One graph with a copy of the neighborhood for each permutation, only
+    # keeping the edges between points that are both over the threshold
+    p, e = np.nonzero(mask[:, i] & mask[:, j])
+    offset = p * n_points
+    n_nodes = n_perm * n_points
+    graph = sparse.coo_matrix((np.ones(len(e), dtype=np.int8),
+                               (offset + i[e], offset + j[e])),
+                              shape=(n_nodes, n_nodes))
+    _, labels = connected_components(graph, directed=False)
+    labels = labels.reshape(n_perm, n_points)
+    # Renumber the clusters so that points below threshold don't count
+    inx = np.unique(labels[mask], return_inverse=True)[1]
+    cluster_labels = np.full(labels.shape, -1)
+    cluster_labels[mask] = inx.ravel()
+    masses = np.bincount(cluster_labels[mask], weights=T[mask])
+    rows = np.empty(len(masses), dtype=np.int64)
+    rows[cluster_labels[mask]] = np.nonzero(mask)[0]
+    return cluster_labels, masses, rows
+
+
+def _max_masses(T, threshold, edges, tail):
+    """ Largest cluster mass in each row of T
+    """
+    max_mass = np.zeros(T.shape[0])
+    signs = {0: (1, -1), 1: (1,), -1: (-1,)}[tail]
+    for sign in signs:
+        _, masses, rows = _clusters(T, threshold, edges, sign)
+        np.maximum.at(max_mass, rows, masses)
+    return max_mass
+
+
+def _init_worker(X, groups, edges, threshold, tail):
+    _worker.update(X=X, X2=X ** 2, groups=groups, edges=edges,
+                   threshold=threshold, tail=tail)
+
+
+def _null_batch(seed_seq, n_perm):
+    """ Largest cluster mass in each of `n_perm` random permutations
+    """
+    rng = np.random.default_rng(seed_seq)
+    X, groups = _worker['X'], _worker['groups']
+    if groups is None:
+        perms = rng.choice([-1.0, 1.0], size=(n_perm, X.shape[0]))
+    else:
+        # Shuffle each row by sorting random keys (`rng.permuted` needs
+        # numpy 1.20)
+        keys = rng.random((n_perm, len(groups)))
+        perms = groups[np.argsort(keys, axis=1)]
+    T = _t_values(X, _worker['X2'], perms, groups is None)
+    return _max_masses(T, _worker['threshold'], _worker['edges'],
+                       _worker['tail'])
+
+
+def permutation_test(X, adjacency=None, groups=None, n_perm=1000,
+                     p_thresh=0.05, threshold=None, tail=0,
+                     batch_size=100, n_jobs=1, seed=0, blas_threads=1):
+    """ Cluster-based permutation test
+
+    X: Data (subjects, ...), e.g. (subjects, sensors, times)
+    adjacency: Sparse matrix of which points are neighbors, over
+               `X[0].ravel()` (see `combine_adjacency()`). Default: each
+               point is next to its neighbors along every dimension.
+    groups: None for a one-sample test against 0 (sign flips). Otherwise,
+            the group (0 or 1) of each subject, for a two-sample test
+            (label permutations).
+    n_perm: Number of permutations
+    p_thresh: p-value of the t-test that points need to be in a cluster
+    threshold: t-value that points need to be in a cluster (overrides
+               p_thresh)
+    tail: 0 for two-sided, 1 for X > 0 (or group 1 > group 0), -1 for <
+    batch_size: Permutations computed together
+    n_jobs: Number of worker processes
+    seed: Seed for the random permutations
+    blas_threads: Number of BLAS/OpenMP threads in each worker
+
+    Returns a dict:
+        t: t-values (same shape as X[0])
+        clusters: List of dicts with the 'mask' (same shape as X[0]),
+                  'sign', 'mass' and 'p' of each cluster, by mass
+        null: Largest cluster mass in each permutation
+        threshold: The t threshold that was used
+        perm_per_sec: How many permutations were computed per second
+    """
+    from scipy.stats import t as t_dist
+    shape = X.shape[1:]
+    X = X.reshape(X.shape[0], -1).astype(float)
+    n_subj = X.shape[0]
+    if adjacency is None:
+        adjacency = combine_adjacency(*[chain_adjacency(n) for n in shape])
+    assert adjacency.shape[0] == X.shape[1], \
+        'The adjacency does not match the size of the data'
+    edges = _edges(adjacency)
+    if groups is not None:
+        groups = np.asarray(groups, dtype=float)
+        assert set(np.unique(groups)) <= {0.0, 1.0}, 'Groups must be 0 or 1'
+    if threshold is None:
+        dof = n_subj - 1 if groups is None else n_subj - 2
+        p = p_thresh / 2 if tail == 0 else p_thresh
+        threshold = t_dist.ppf(1 - p, dof)
+
+    # Observed clusters
+    _init_worker(X, groups, edges, threshold, tail)
+    obs_perm = np.ones([1, n_subj]) if groups is None else groups[None]
+    t_obs = _t_values(X, _worker['X2'], obs_perm, groups is None)
+    clusters = []
+    for sign in {0: (1, -1), 1: (1,), -1: (-1,)}[tail]:
+        labels, masses, _ = _clusters(t_obs, threshold, edges, sign)
+        for i_clust, mass in enumerate(masses):
+            clusters.append({'mask': (labels[0] == i_clust).reshape(shape),
+                             'sign': sign,
+                             'mass': mass})
+
+    # Null distribution of the largest cluster mass
+    t_start = time.perf_counter()
+    batches = [batch_size] * (n_perm // batch_size)
+    if n_perm % batch_size:
+        batches.append(n_perm % batch_size)
+    seeds = np.random.SeedSequence(seed).spawn(len(batches))
+    if n_jobs == 1:
+        null = [_null_batch(s, n) for s, n in zip(seeds, batches)]
+    else:
+        with config.thread_limit(blas_threads):
+            ctx = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(n_jobs, mp_context=ctx,
+                                     initializer=_init_worker,
+                                     initargs=(X, groups, edges, threshold,
+                                               tail)) as pool:
+                null = list(pool.map(_null_batch, seeds, batches))
+    null = np.concatenate(null)
+    t_perm = time.perf_counter() - t_start
+    perm_per_sec = n_perm / t_perm
+    print(f'{n_perm} permutations in {t_perm:.1f} s '
+          f'({perm_per_sec:.0f} per second)')
+
+    for c in clusters:
+        c['p'] = (np.sum(null >= c['mass']) + 1) / (n_perm + 1)
+    clusters = sorted(clusters, key=lambda c: -c['mass'])
+    return {'t': t_obs[0].reshape(shape),
+            'clusters': clusters,
+            'null': null,
+            'threshold': threshold,
+            'perm_per_sec': perm_per_sec}
+
+
+def print_clusters(res, alpha=0.05, times=None):
+    """ Print the significant clusters of `permutation_test()`
+
+    times: Times of the last dimension, to print the extent of each cluster
+    """
+    sig = [c for c in res['clusters'] if c['p'] < alpha]
+    print(f"{len(sig)} of {len(res['clusters'])} clusters with p < {alpha}")
+    for c in sig:
+        msg = f"  {'+' if c['sign'] > 0 else '-'} mass {c['mass']:8.1f}, " \
+              f"p = {c['p']:.4f}, {c['mask'].sum()} points"
+        if times is not None:
+            in_time = np.nonzero(c['mask'].reshape(-1, len(times))
+                                 .any(axis=0))[0]
+            msg += f", {times[in_time[0]]:.3f} to {times[in_time[-1]]:.3f} s"
+        print(msg)
@@ -0,0 +1,144 @@
+"""
+Experiment info, data directory and subject list for the analysis
+
+Nothing is read when this module is imported, so importing the analysis
+modules (e.g. in worker processes) is fast and works from any directory.
+Each item is read the first time it's needed, and then kept:
+- expt_info(): `expt_info.json` (next to this file)
+- data_dir(): Where the data are. This is the environment variable
+  `ANALYSIS_DATA_DIR` if it's set (e.g. with `set_data_dir()`). Otherwise
+  it's looked up by hostname in expt_info['data_dir'], falling back to
+  the 'rds' entry. Relative paths are relative to this directory.
+- subject_info(): `subject_info.csv` in the data directory (pd.DataFrame)
+- stim_info(): `exp-scripts/stimuli.yaml`, the stimulus IDs in each
+  category
+- dist_convert(): `exp-scripts/dist_convert.py`, without adding the
+  experiment scripts to sys.path
+
+`eyelink_fname(n)` gives the eye-tracker file that the analysis reads for
+a subject. `thread_limit()` sets how many BLAS/OpenMP threads worker
+processes use.
+"""
+
+import os
+import json
+import socket
+import contextlib
+import importlib.util
+
+_here = os.path.dirname(os.path.abspath(__file__))
+_cache = {}
+
+# Environment variables that set the number of threads used by BLAS/OpenMP
+THREAD_VARS = ['OMP_NUM_THREADS',
+               'OPENBLAS_NUM_THREADS',
+               'MKL_NUM_THREADS',
+               'NUMEXPR_NUM_THREADS',
+               'VECLIB_MAXIMUM_THREADS']
+
+
+def expt_info():
+    """ Info about the experiment (dict from `expt_info.json`)
+    """
+    if 'expt_info' not in _cache:
+        with open(os.path.join(_here, 'expt_info.json')) as f:
+            _cache['expt_info'] = json.load(f)
+    return _cache['expt_info']
+
+
+def _host_data_dir():
+    """ Data directory for this computer, from expt_info['data_dir']
+    """
+    if 'host_data_dir' not in _cache:
+        dirs = expt_info()['data_dir']
+        hostname = socket.gethostname().lower()
+        d = dirs.get(hostname, dirs['rds'])
+        d = os.path.normpath(os.path.join(_here, d))
+        _cache['host_data_dir'] = os.path.join(d, '')  # Trailing slash
+    return _cache['host_data_dir']
+
+
+def data_dir():
+    """ Directory with the data, ending in a slash
+    """
+    d = os.environ.get('ANALYSIS_DATA_DIR')
+    if d:
+        return os.path.join(d, '')
+    return _host_data_dir()
+
+
+def set_data_dir(d):
+    """ Use another data directory (e.g. synthetic data for benchmarks).
+    This sets `ANALYSIS_DATA_DIR`, so worker processes use it too.
+    """
+    os.environ['ANALYSIS_DATA_DIR'] = d
+
+
+def subject_info():
+    """ Table of subjects and their filenames (`subject_info.csv`)
+    """
+    key = ('subject_info', data_dir())
+    if key not in _cache:
+        import pandas as pd
+        _cache[key] = pd.read_csv(key[1] + 'subject_info.csv',
+                                  engine='python', sep=',')
+    return _cache[key]
+
+
+def stim_info():
+    """ Stimulus IDs in each category (`stimuli.yaml`)
+    """
+    if 'stim_info' not in _cache:
+        import yaml
+        fname = os.path.join(_here, '../exp-scripts/stimuli.yaml')
+        with open(fname) as f:
+            _cache['stim_info'] = yaml.load(f, Loader=yaml.SafeLoader)
+    return _cache['stim_info']
+
+
+def eyelink_fname(n):
+    """ Eye-tracker data of subject n: the data streamed from the link
+    during the recording (.npz) if there are any, or else the .asc file
+    """
+    name = subject_info()['eyelink'][n]
+    fname = f'{data_dir()}eyelink/stream/{name}.npz'
+    if os.path.exists(fname):
+        return fname
+    return f'{data_dir()}eyelink/ascii/{name}.asc'
+
+
+def dist_convert():
+    """ The `dist_convert` module from the experiment scripts
+    """
+    if 'dist_convert' not in _cache:
+        fname = os.path.join(_here, '../exp-scripts/dist_convert.py')
+        spec = importlib.util.spec_from_file_location('dist_convert', fname)
+        dc = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(dc)
+        _cache['dist_convert'] = dc
+    return _cache['dist_convert']
+
+
+def reset():
+    """ Forget everything that has been read (e.g. after editing
+    `subject_info.csv`)
+    """
+    _cache.clear()
+
+
+@contextlib.contextmanager
+def thread_limit(n_threads):
+    """ Use `n_threads` BLAS/OpenMP threads in processes started inside
+    this block. The limits are read when numpy is imported, so the workers
+    have to be fresh ('spawn') processes.
+    """
+    old_env = {v: os.environ.get(v) for v in THREAD_VARS}
+    os.environ.update({v: str(n_threads) for v in THREAD_VARS})
+    try:
+        yield
+    finally:
+        for v, val in old_env.items():
+            if val is None:
+                os.environ.pop(v, None)
+            else:
+                os.environ[v] = val
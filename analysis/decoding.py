@@ -0,0 +1,193 @@
+"""
+Time-resolved decoding of fixation-locked MEG data
+
+At each time point, a classifier (standardize + logistic regression) is
+trained to predict something about each fixation (e.g. `closest_stim` or
+`prev_stim` from the fixation table) from the MEG channels, and tested with
+stratified cross-validation. With `generalize=True`, each classifier is
+also tested at every other time point (temporal generalization), giving a
+train time x test time matrix.
+
+The work is split into (fold, chunk of time points) tasks, which run in a
+pool of processes. The data are saved once to a .npy file, and each worker
+opens it as a memory map, so the epochs aren't pickled and copied for every
+task.
+
+Example:
+    import load_data, decoding
+    d = load_data.load_data(0)
+    epochs = decoding.fixation_epochs(d, tmin=-0.2, tmax=0.5)
+    X, y = decoding.epochs_data(epochs, 'closest_stim')
+    res = decoding.decode(X, y, generalize=True)
+    scores = res['scores'].mean(axis=0)  # Average over the folds
+"""
+
+import os
+import time
+import shutil
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import config
+import profiling
+
+
+def fixation_epochs(d, tmin=-0.2, tmax=0.5, **kwargs):
+    """ Fixation-locked epochs with the fixation table as metadata
+
+    d: Data from `load_data.load_data(n)`
+    Other keyword arguments are passed on to `preproc.read_epochs`.
+    """
+    import fixation_events
+    import preproc
+    event_id = config.expt_info()['event_dict']['fix_on']
+    events, meta = fixation_events.make_events(
+        [(d['fix_info'], 'start_meg', 'fix_on')], metadata=True)
+    epochs = preproc.read_epochs(d['raw'], events, event_id, tmin, tmax,
+                                 ica=d['ica'], metadata=meta, **kwargs)
+    return epochs
+
+
+def epochs_data(epochs, target, picks='meg'):
+    """ Get the data and labels for decoding from epochs with metadata.
+    Epochs where the target is missing (e.g. no previous stimulus) are
+    left out.
+
+    Returns X: array (epochs, channels, times), float32
+            y: array of labels (epochs,)
+    """
+    labels = epochs.metadata[target]
+    keep = labels.notna().to_numpy()
+    X = epochs.get_data(picks=picks)[keep].astype(np.float32)
+    y = labels[keep].astype(object).to_numpy()
+    return X, y
+
+
+def _classifier(C):
+    from sklearn.pipeline import make_pipeline
+    from sklearn.preprocessing import StandardScaler
+    from sklearn.linear_model import LogisticRegression
+    return make_pipeline(StandardScaler(),
+                         LogisticRegression(C=C, max_iter=1000))
+
+
+def _score_task(X_fname, y, train, test, times, generalize, C):
+    """ Train a classifier at each time point in `times` on the `train`
+    epochs and test it on the `test` epochs.
+    Returns scores (len(times), n_times if generalize else 1).
+    """
+    X = np.load(X_fname, mmap_mode='r')
+    n_times = X.shape[2]
+    y_train = y[train]
+    y_test = y[test]
+    if generalize:
+        # Test data at every time point, as one (epochs * times, channels)
+        # matrix so that each classifier predicts them all at once
+        X_test = np.asarray(X[test]).transpose(0, 2, 1)
+        X_test = X_test.reshape(-1, X.shape[1])
+    scores = np.empty([len(times), n_times if generalize else 1])
+    for i, t in enumerate(times):
+        clf = _classifier(C)
+        clf.fit(X[train, :, t], y_train)
+        if generalize:
+            pred = clf.predict(X_test).reshape(len(test), n_times)
+            scores[i] = np.mean(pred == y_test[:, None], axis=0)
+        else:
+            scores[i, 0] = clf.score(X[test, :, t], y_test)
+    return scores
+
+
+@profiling.profiled('decoding.decode')
+def decode(X, y, n_jobs=None, cv=5, generalize=False, C=1.0,
+           chunk_size=None, seed=0, blas_threads=1):
+    """ Decode the labels `y` from the data `X` at each time point.
+
+    X: array (epochs, channels, times)
+    y: array of labels (epochs,)
+    n_jobs: Number of worker processes (default: all the cores).
+            With n_jobs=1 everything runs in this process.
+    cv: Number of cross-validation folds
+    generalize: Also test each classifier at every other time point
+    C: Inverse regularization strength of the logistic regression
+    chunk_size: Time points per task (default: about 4 tasks per worker)
+    blas_threads: Number of BLAS/OpenMP threads in each worker
+
+    Returns a dict:
+        scores: Accuracy, (folds, times) or (folds, train times, test times)
+        chance: Accuracy from always guessing the most common label
+        time: How long it took (s)
+    """
+    from sklearn.model_selection import StratifiedKFold
+    t_start = time.perf_counter()
+    y = np.asarray(y)
+    n_times = X.shape[2]
+    if n_jobs is None:
+        n_jobs = max(1, os.cpu_count() // blas_threads)
+    folds = list(StratifiedKFold(cv, shuffle=True,
+                                 random_state=seed).split(X[:, 0, 0], y))
+    if chunk_size is None:
+        n_chunks = int(np.ceil(4 * n_jobs / len(folds)))
+        chunk_size = int(np.ceil(n_times / n_chunks))
+    chunks = [np.arange(t, min(t + chunk_size, n_times))
+              for t in range(0, n_times, chunk_size)]
+
+    shape = [len(folds), n_times] + ([n_times] if generalize else [])
+    scores = np.empty(shape)
+    tmp_dir = tempfile.mkdtemp(prefix='decoding_')
+    try:
+        # Save the data once, for all the workers to memory-map
+        X_fname = os.path.join(tmp_dir, 'X.npy')
+        np.save(X_fname, X)
+        tasks = [(i_fold, times, (X_fname, y, train, test, times,
+                                  generalize, C))
+                 for i_fold, (train, test) in enumerate(folds)
+                 for times in chunks]
+        if n_jobs == 1:
+            results = [_score_task(*args) for _, _, args in tasks]
+        else:
+            with config.thread_limit(blas_threads):
+                ctx = multiprocessing.get_context('spawn')
+                with ProcessPoolExecutor(n_jobs, mp_context=ctx) as pool:
+                    futures = [pool.submit(_score_task, *args)
+                               for _, _, args in tasks]
+                    results = [fut.result() for fut in futures]
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    for (i_fold, times, _), res in zip(tasks, results):
+        if generalize:
+            scores[i_fold, times] = res
+        else:
+            scores[i_fold, times] = res[:, 0]
+
+    _, counts = np.unique(y, return_counts=True)
+    return {'scores': scores,
+            'chance': counts.max() / counts.sum(),
+            'time': time.perf_counter() - t_start}
+
+
+def scaling(X, y, n_jobs_list=None, **kwargs):
+    """ Time `decode` with different numbers of worker processes.
+    Keyword arguments are passed on to `decode`.
+
+    n_jobs_list: Numbers of processes to try (default: 1, 2, 4, ... cores)
+    Returns a list of dicts with the time and speed-up for each.
+    """
+    if n_jobs_list is None:
+        n_cpus = os.cpu_count()
+        n_jobs_list = sorted({min(2 ** k, n_cpus)
+                              for k in range(int(np.log2(n_cpus)) + 2)})
+    results = []
+    for n_jobs in n_jobs_list:
+        res = decode(X, y, n_jobs=n_jobs, **kwargs)
+        results.append({'n_jobs': n_jobs, 'time': res['time']})
+    t_serial = results[0]['time'] * results[0]['n_jobs']
+    print(f"{'Workers':>8s} {'Time (s)':>10s} {'Speed-up':>10s} "
+          f"{'Efficiency':>10s}")
+    for r in results:
+        r['speedup'] = t_serial / r['time']
+        r['efficiency'] = r['speedup'] / r['n_jobs']
+        print(f"{r['n_jobs']:8d} {r['time']:10.2f} {r['speedup']:10.2f} "
+              f"{r['efficiency']:10.2f}")
+    return results
@@ -0,0 +1,221 @@
+"""
+Regression-based deconvolution of overlapping event-related responses
+
+Fixations are only a few hundred ms apart, so fixation-locked averages mix
+the response to each fixation with the responses to the fixations around
+it and to the stimulus onset. Here, the continuous recording is modeled as
+the sum of a response to every event instead (as in the `unfold` toolbox):
+
+    data = X @ b
+
+Each term (e.g. fixation onset, fixation duration, stimulus onset) gets one
+coefficient per lag, per channel. The time-expanded design matrix X has one
+row per sample of the recording, but only (events x lags) nonzero entries,
+so it's kept as a sparse matrix. The data never have to be in memory all at
+once: X.T @ data is added up one stretch of the recording at a time (read,
+filtered and ICA-cleaned like in `preproc.py`), and then the normal
+equations are solved for all the channels together with the conjugate
+gradient method.
+
+Example:
+    import load_data, deconvolution
+    d = load_data.load_data(0)
+    terms = deconvolution.fixation_terms(d, covariates=['dur',
+                                                        'dist_to_stim'])
+    resp = deconvolution.fit(d['raw'], terms, tmin=-0.2, tmax=0.8,
+                             ica=d['ica'])
+    resp['fix_on'].plot(spatial_colors=True)
+"""
+
+import numpy as np
+import mne
+from mne.annotations import _annotations_starts_stops
+from scipy import sparse
+import config
+import preproc
+import profiling
+
+
+def fixation_terms(d, covariates=(), stimuli=True):
+    """ Terms of the model for one subject: a response to each fixation
+    onset, optionally scaled by columns of the fixation table, and a
+    response to each stimulus onset.
+
+    d: Data from `load_data.load_data(n)`
+    covariates: Columns of `d['fix_info']` (e.g. 'dur', 'dist_to_stim').
+                They're z-scored, so the fixation-onset response is the
+                response to a fixation with average values.
+    stimuli: Also model the response to the stimulus onsets
+
+    Returns a list of (name, onsets in MEG samples, weights)
+    """
+    event_dict = config.expt_info()['event_dict']
+    fix = d['fix_info']
+    fix = fix[fix['start_meg'].notna()]
+    onsets = fix['start_meg'].to_numpy(dtype=np.int64)
+    terms = [('fix_on', onsets, np.ones(len(onsets)))]
+    for col in covariates:
+        x = fix[col].to_numpy(dtype=float, na_value=np.nan)
+        x = (x - np.nanmean(x)) / np.nanstd(x)
+        x[np.isnan(x)] = 0  # Missing values get the average
+        terms.append((f'fix_on:{col}', onsets, x))
+    if stimuli:
+        ev = d['meg_events']
+        onsets = ev[ev[:, 2] == event_dict['stimuli'], 0]
+        terms.append(('stimuli', onsets, np.ones(len(onsets))))
+    return terms
+
+
+def design_matrix(terms, lags, n_samples, first_samp=0):
+    """ Time-expanded design matrix
+
+    terms: List of (name, onsets, weights), as from `fixation_terms()`
+    lags: Lags (in samples) at which to estimate each response
+    n_samples: Number of samples in the recording
+    first_samp: Sample number of the first sample (`raw.first_samp`)
+
+    Returns a sparse matrix (samples, terms * lags), in CSR format.
+    """
+    n_lags = len(lags)
+    rows, cols, vals = [], [], []
+    for i_term, (_, onsets, weights) in enumerate(terms):
+        r = np.asarray(onsets)[:, None] - first_samp + lags[None, :]
+        c = np.broadcast_to(i_term * n_lags + np.arange(n_lags), r.shape)
+        v = np.broadcast_to(np.asarray(weights, dtype=float)[:, None],
+                            r.shape)
+        keep = (r >= 0) & (r < n_samples) & (v != 0)
+        rows.append(r[keep])
+        cols.append(c[keep])
+        vals.append(v[keep])
+    # Entries that land on the same cell (e.g. overlapping events of the
+    # same term) are added together
+    X = sparse.coo_matrix((np.concatenate(vals),
+                           (np.concatenate(rows), np.concatenate(cols))),
+                          shape=(n_samples, len(terms) * n_lags))
+    return X.tocsr()
+
+
+def _good_samples(raw):
+    """ Boolean array: which samples are outside of the BAD annotations
+    """
+    good = np.ones(raw.n_times, dtype=bool)
+    bad_starts, bad_stops = _annotations_starts_stops(raw, 'BAD')
+    for start, stop in zip(bad_starts, bad_stops):
+        good[start:stop] = False
+    return good
+
+
+def _block_cg(A, B, tol=1e-6, maxiter=1000):
+    """ Solve A @ X = B for every column of B at once, with the conjugate
+    gradient method (A: sparse, symmetric positive (semi-)definite).
+    Each iteration is one sparse product with all the columns. The
+    diagonal of A is used as a preconditioner.
+
+    Returns X, the number of iterations, and the largest relative residual.
+    """
+    diag = A.diagonal()
+    m = np.divide(1, diag, out=np.ones_like(diag), where=diag > 0)[:, None]
+    b_norm = np.linalg.norm(B, axis=0)
+    b_norm[b_norm == 0] = 1
+    X = np.zeros_like(B)
+    R = B.copy()
+    Z = m * R
+    P = Z.copy()
+    rz = np.sum(R * Z, axis=0)
+    res = 0.0
+    for i_iter in range(1, maxiter + 1):
+        AP = A @ P
+        pap = np.sum(P * AP, axis=0)
+        alpha = np.divide(rz, pap, out=np.zeros_like(rz), where=pap > 0)
+        X += alpha * P
+        R -= alpha * AP
+        res = np.max(np.linalg.norm(R, axis=0) / b_norm)
+        if res < tol:
+            break
+        Z = m * R
+        rz_new = np.sum(R * Z, axis=0)
+        beta = np.divide(rz_new, rz, out=np.zeros_like(rz), where=rz > 0)
+        P = Z + beta * P
+        rz = rz_new
+    return X, i_iter, res
+
+
+@profiling.profiled('deconvolution.fit')
+def fit(raw, terms, tmin, tmax, l_freq=0.1, h_freq=40.0, ica=None,
+        picks='meg', alpha=0.0, reject_by_annotation=True,
+        chunk_sec=60.0, tol=1e-6, maxiter=1000):
+    """ Estimate the response to each term of the model, in every channel
+
+    raw: mne.io.Raw that has *not* been preloaded
+    terms: List of (name, onsets in MEG samples, weights), e.g. from
+           `fixation_terms()`
+    tmin, tmax: Time window of the responses, relative to the events (s)
+    l_freq, h_freq: Band-pass filter edges, as in raw.filter()
+    ica: ICA to apply to the data (or None)
+    picks: Channels to model ('meg', 'mag', 'grad', or channel indices)
+    alpha: Ridge regularization, relative to the average diagonal of X.T @ X
+    reject_by_annotation: Leave out the samples in BAD annotations
+    chunk_sec: How much of the recording to read and filter at once (s)
+    tol, maxiter: Convergence criteria of the conjugate gradient solver
+
+    Returns a dict of name: mne.EvokedArray with the response to each term.
+    """
+    sfreq = raw.info['sfreq']
+    lags = np.arange(int(np.round(tmin * sfreq)),
+                     int(np.round(tmax * sfreq)) + 1)
+    with profiling.stage('deconvolution.design_matrix'):
+        X = design_matrix(terms, lags, raw.n_times, raw.first_samp)
+        if reject_by_annotation:
+            good = _good_samples(raw)
+            X = sparse.diags(good.astype(float)) @ X
+            print(f'Left out {np.sum(~good) / sfreq:.1f} s of bad data')
+        X = X.tocsr()
+    print(f'Design matrix: {X.shape[0]} x {X.shape[1]}, '
+          f'{X.nnz} nonzero entries')
+
+    # Add up X.T @ data one stretch of the recording at a time
+    if isinstance(picks, str):  # 'meg', 'mag' or 'grad'
+        meg = True if picks == 'meg' else picks
+        picks = mne.pick_types(raw.info, meg=meg, exclude='bads')
+    picks_filt = mne.pick_types(raw.info, meg=True, eeg=True, exclude=[])
+    pad = preproc._filter_pad(sfreq, l_freq, h_freq)
+    chunk = int(chunk_sec * sfreq)
+    if ica is not None:
+        operator = preproc.ica_operator(ica, raw.ch_names)
+    XtY = np.zeros([X.shape[1], len(picks)])
+    for start in range(0, raw.n_times, chunk):
+        stop = min(start + chunk, raw.n_times)
+        X_chunk = X[start:stop]
+        if X_chunk.nnz == 0:
+            continue  # No events here, so the data don't matter
+        seg_start = max(start - pad, 0)
+        seg_stop = min(stop + pad, raw.n_times)
+        with profiling.stage('deconvolution.read_segment'):
+            seg = raw.get_data(start=seg_start, stop=seg_stop)
+        with profiling.stage('deconvolution.filter_segment'):
+            seg = mne.filter.filter_data(seg, sfreq, l_freq, h_freq,
+                                         picks=picks_filt, verbose=False)
+        seg = seg[:, start - seg_start:stop - seg_start]
+        if ica is not None:
+            with profiling.stage('deconvolution.apply_ica'):
+                preproc.apply_ica(seg[None], ica, raw.ch_names, operator)
+        XtY += X_chunk.T @ seg[picks].T
+
+    with profiling.stage('deconvolution.solve'):
+        XtX = (X.T @ X).tocsr()
+        if alpha > 0:
+            ridge = alpha * XtX.diagonal().mean()
+            XtX = XtX + ridge * sparse.identity(XtX.shape[0], format='csr')
+        coefs, n_iter, res = _block_cg(XtX, XtY, tol, maxiter)
+    print(f'Conjugate gradient: {n_iter} iterations, '
+          f'relative residual {res:.2g}')
+    if res > tol:
+        print('Warning: the solver did not converge; try alpha > 0')
+
+    info = mne.pick_info(raw.info, picks)
+    coefs = coefs.reshape(len(terms), len(lags), len(picks))
+    responses = {}
+    for (name, onsets, _), b in zip(terms, coefs):
+        responses[name] = mne.EvokedArray(b.T, info, tmin=lags[0] / sfreq,
+                                          comment=name, nave=len(onsets))
+    return responses
@@ -0,0 +1,307 @@
+"""
+Min/max envelope pyramid for browsing long recordings
+
+To mark artifacts, we scroll through the whole recording. Drawing every
+sample is slow to start and slow to scroll. Instead, the filtered data
+(from `filtered_cache.py`) are summarized once as a pyramid of min/max
+envelopes:
+level 0 has the min and max of every `BASE_FACTOR` samples, and each level
+above has the min and max of `LEVEL_FACTOR` bins of the level below. The
+levels are saved as .npy files next to the annotations, and opened as
+memory maps, so only the bins on the screen are read.
+
+To draw a window at any zoom level, the coarsest level that still has at
+least one bin per pixel is used, so the amount of data read and drawn
+doesn't depend on the length of the window or of the recording. When
+zoomed in further than level 0, the full-resolution data for the visible
+window are read from the filtered-data cache.
+
+Example:
+    env = envelope.get(raw, 'subj_fname')
+    times, lo, hi = env.window(100.0, 400.0, n_pixels=2000)
+"""
+
+import os
+import json
+import numpy as np
+import mne
+import config
+import filtered_cache
+import profiling
+
+BASE_FACTOR = 16  # Samples per bin in level 0
+LEVEL_FACTOR = 4  # Bins of one level per bin of the next level
+MIN_BINS = 2000  # Don't make levels with fewer bins than this
+CHUNK_SEC = 60.0  # How much data to read at once (s)
+L_FREQ = 0.5  # Band-pass filter for browsing (Hz)
+H_FREQ = 40.0
+CH_TYPES = ('meg', 'eog')  # Channels that are filtered and shown
+
+
+def envelope_dir(subj_fname):
+    """ Where the envelope of one subject's recording is kept
+    """
+    return f'{config.data_dir()}annotations/{subj_fname}-envelope/'
+
+
+def _data_id(raw, l_freq, h_freq):
+    """ Identify the raw data and filter settings without reading the data
+    """
+    fname = raw.filenames[0]
+    st = os.stat(fname)
+    return f'{os.path.basename(fname)}:{st.st_size}:{int(st.st_mtime)}:' \
+           f'{l_freq}:{h_freq}:{BASE_FACTOR}:{LEVEL_FACTOR}'
+
+
+def _minmax(x, factor):
+    """ Min and max of every `factor` rows of x (the last bin can be
+    shorter). Returns two arrays (bins, columns).
+    """
+    n_bins = int(np.ceil(len(x) / factor))
+    n_pad = n_bins * factor - len(x)
+    if n_pad:
+        x = np.concatenate([x, np.repeat(x[-1:], n_pad, axis=0)])
+    x = x.reshape(n_bins, factor, -1)
+    return x.min(axis=1), x.max(axis=1)
+
+
+@profiling.profiled('envelope.build')
+def build(raw, out_dir, l_freq=L_FREQ, h_freq=H_FREQ, chunk_sec=CHUNK_SEC):
+    """ Save the min/max pyramid of the filtered MEG and EOG channels of a
+    recording in `out_dir`, reading the filtered data one chunk at a time.
+    """
+    sfreq = raw.info['sfreq']
+    picks = mne.pick_types(raw.info, exclude=[], **{t: True for t in CH_TYPES})
+    raw_filt = filtered_cache.get(raw, l_freq, h_freq, CH_TYPES)
+    os.makedirs(out_dir, exist_ok=True)
+    info_fname = f'{out_dir}info.json'
+    if os.path.exists(info_fname):
+        os.remove(info_fname)  # Only there once the pyramid is complete
+
+    # Level 0, from the filtered data
+    n_bins = int(np.ceil(raw.n_times / BASE_FACTOR))
+    level = np.lib.format.open_memmap(f'{out_dir}level0.npy', mode='w+',
+                                      dtype=np.float32,
+                                      shape=(n_bins, 2, len(picks)))
+    chunk = max(int(chunk_sec * sfreq) // BASE_FACTOR, 1) * BASE_FACTOR
+    for start in range(0, raw.n_times, chunk):
+        stop = min(start + chunk, raw.n_times)
+        seg = raw_filt.get_data(picks=picks, start=start, stop=stop)
+        lo, hi = _minmax(seg.T, BASE_FACTOR)
+        b = start // BASE_FACTOR
+        level[b:b + len(lo), 0] = lo
+        level[b:b + len(lo), 1] = hi
+    level.flush()
+    factors = [BASE_FACTOR]
+
+    # Each level from the one below it
+    while len(level) // LEVEL_FACTOR >= MIN_BINS:
+        n_bins = int(np.ceil(len(level) / LEVEL_FACTOR))
+        fname = f'{out_dir}level{len(factors)}.npy'
+        upper = np.lib.format.open_memmap(fname, mode='w+',
+                                          dtype=np.float32,
+                                          shape=(n_bins, 2, len(picks)))
+        step = LEVEL_FACTOR * 100000
+        for start in range(0, len(level), step):
+            x = np.asarray(level[start:start + step])
+            b = start // LEVEL_FACTOR
+            lo, _ = _minmax(x[:, 0], LEVEL_FACTOR)
+            _, hi = _minmax(x[:, 1], LEVEL_FACTOR)
+            upper[b:b + len(lo), 0] = lo
+            upper[b:b + len(lo), 1] = hi
+        upper.flush()
+        level = upper
+        factors.append(factors[-1] * LEVEL_FACTOR)
+
+    info = {'data_id': _data_id(raw, l_freq, h_freq),
+            'sfreq': sfreq,
+            'n_times': raw.n_times,
+            'l_freq': l_freq,
+            'h_freq': h_freq,
+            'ch_names': [raw.ch_names[i] for i in picks],
+            'ch_types': raw.get_channel_types(picks=picks),
+            'factors': factors}
+    with open(info_fname, 'w') as f:
+        json.dump(info, f, indent=2)
+    print(f'Saved {len(factors)} envelope levels in {out_dir}')
+
+
+def get(raw, subj_fname, l_freq=L_FREQ, h_freq=H_FREQ):
+    """ Open the envelope of a recording, making it first if it doesn't
+    exist yet or the raw data have changed.
+    """
+    out_dir = envelope_dir(subj_fname)
+    info_fname = f'{out_dir}info.json'
+    if os.path.exists(info_fname):
+        with open(info_fname) as f:
+            old_id = json.load(f)['data_id']
+    else:
+        old_id = None
+    if old_id != _data_id(raw, l_freq, h_freq):
+        print('Making the envelope for browsing')
+        build(raw, out_dir, l_freq, h_freq)
+    return Envelope(out_dir)
+
+
+class Envelope(object):
+    """ Min/max envelope pyramid saved by `build()`
+    """
+
+    def __init__(self, out_dir):
+        with open(f'{out_dir}info.json') as f:
+            self.info = json.load(f)
+        self.sfreq = self.info['sfreq']
+        self.factors = self.info['factors']
+        self.levels = [np.load(f'{out_dir}level{i}.npy', mmap_mode='r')
+                       for i in range(len(self.factors))]
+        self.ch_names = self.info['ch_names']
+        self.ch_types = np.array(self.info['ch_types'])
+        self.duration = self.info['n_times'] / self.sfreq
+
+    def window(self, t_start, t_stop, n_pixels=2000):
+        """ Envelope of the data between two times (s from the start of the
+        recording), with at least one bin per pixel.
+
+        Returns the time of each bin, and the min and max of each channel
+        (bins, channels). Returns None if the window is so short that the
+        full-resolution data should be used instead.
+        """
+        n_samples = (t_stop - t_start) * self.sfreq
+        fits = [i for i, f in enumerate(self.factors)
+                if f <= n_samples / n_pixels]
+        if not fits:
+            return None
+        i_level = fits[-1]
+        f = self.factors[i_level]
+        level = self.levels[i_level]
+        b_start = max(int(t_start * self.sfreq) // f, 0)
+        b_stop = min(int(np.ceil(t_stop * self.sfreq / f)), len(level))
+        x = np.asarray(level[b_start:b_stop])
+        times = (np.arange(b_start, b_stop) + 0.5) * f / self.sfreq
+        return times, x[:, 0], x[:, 1]
+
+    def data_range(self, ch_type):
+        """ Typical min and max of one type of channel, for the y-axis
+        """
+        x = np.asarray(self.levels[-1])[:, :, self.ch_types == ch_type]
+        return np.percentile(x[:, 0], 1), np.percentile(x[:, 1], 99)
+
+
+def raw_window(raw, t_start, t_stop, picks):
+    """ Read the full-resolution data between two times (s from the start
+    of the recording). Returns the times and the data (channels, times).
+    """
+    sfreq = raw.info['sfreq']
+    start = max(int(t_start * sfreq), 0)
+    stop = min(int(np.ceil(t_stop * sfreq)), raw.n_times)
+    seg = raw.get_data(picks=picks, start=start, stop=stop)
+    return np.arange(start, stop) / sfreq, seg
+
+
+class Browser(object):
+    """ Scroll through a recording as a butterfly plot of each channel
+    type, drawn from the envelope, and mark bad segments.
+
+    Left/right arrows: Scroll
+    Up/down arrows: Zoom in/out
+    Click and drag: Mark a bad segment ('BAD_manual')
+    Right-click on a bad segment: Remove it
+    """
+
+    def __init__(self, raw, env, width=30.0, n_pixels=2000):
+        import matplotlib.pyplot as plt
+        from matplotlib.widgets import SpanSelector
+        self.raw = raw
+        self.raw_filt = filtered_cache.get(raw, env.info['l_freq'],
+                                           env.info['h_freq'], CH_TYPES)
+        self.env = env
+        self.annotations = raw.annotations.copy()
+        # Annotations tied to the measurement date count from the start of
+        # the acquisition, not from the first sample of the data
+        if self.annotations.orig_time is None:
+            self.t_offset = 0.0
+        else:
+            self.t_offset = raw.first_time
+        self.t_start = 0.0
+        self.width = width
+        self.n_pixels = n_pixels
+        self.types = [t for t in ('mag', 'grad', 'eog')
+                      if t in env.ch_types]
+        self.fig, axes = plt.subplots(len(self.types), 1, sharex=True,
+                                      squeeze=False, figsize=(14, 8))
+        self.axes = axes[:, 0]
+        self.ylims = [env.data_range(t) for t in self.types]
+        self.selectors = [SpanSelector(ax, self.add_bad, 'horizontal',
+                                       useblit=True, button=1)
+                          for ax in self.axes]
+        self.fig.canvas.mpl_connect('key_press_event', self.on_key)
+        self.fig.canvas.mpl_connect('button_press_event', self.on_click)
+        self.draw()
+        plt.show(block=False)
+
+    def draw(self):
+        t_start = self.t_start
+        t_stop = t_start + self.width
+        win = self.env.window(t_start, t_stop, self.n_pixels)
+        if win is None:  # Zoomed in past the envelope
+            picks = [self.raw.ch_names.index(ch) for ch in self.env.ch_names]
+            times, data = raw_window(self.raw_filt, t_start, t_stop, picks)
+        for ax, ch_type, ylim in zip(self.axes, self.types, self.ylims):
+            ax.clear()
+            chans = self.env.ch_types == ch_type
+            if win is None:
+                ax.plot(times, data[chans].T, color='k', linewidth=0.3)
+            else:
+                times, lo, hi = win
+                ax.fill_between(times, lo[:, chans].min(axis=1),
+                                hi[:, chans].max(axis=1),
+                                color='k', linewidth=0)
+            self.draw_annotations(ax, t_start, t_stop)
+            ax.set_xlim(t_start, t_stop)
+            ax.set_ylim(ylim)
+            ax.set_ylabel(ch_type)
+        self.axes[-1].set_xlabel('Time (s)')
+        self.fig.canvas.draw_idle()
+
+    def draw_annotations(self, ax, t_start, t_stop):
+        annot = self.annotations
+        onsets = annot.onset - self.t_offset
+        for onset, dur, desc in zip(onsets, annot.duration,
+                                    annot.description):
+            if onset + dur < t_start or onset > t_stop:
+                continue
+            color = 'red' if desc == 'BAD_out_of_trial' else 'orange'
+            ax.axvspan(onset, onset + dur, color=color, alpha=0.3)
+
+    def add_bad(self, t_min, t_max):
+        if t_max > t_min:
+            self.annotations.append(t_min + self.t_offset,
+                                    t_max - t_min, 'BAD_manual')
+            self.draw()
+
+    def on_click(self, event):
+        if event.button != 3 or event.xdata is None:
+            return
+        onsets = self.annotations.onset - self.t_offset
+        hit = np.nonzero((onsets <= event.xdata) &
+                         (event.xdata <= onsets + self.annotations.duration)
+                         & (self.annotations.description == 'BAD_manual'))
+        if len(hit[0]):
+            self.annotations.delete(hit[0])
+            self.draw()
+
+    def on_key(self, event):
+        if event.key == 'right':
+            self.t_start += self.width / 2
+        elif event.key == 'left':
+            self.t_start -= self.width / 2
+        elif event.key == 'up':
+            self.width /= 2
+        elif event.key == 'down':
+            self.width *= 2
+        else:
+            return
+        self.width = min(max(self.width, 0.1), self.env.duration)
+        self.t_start = min(max(self.t_start, 0.0),
+                           self.env.duration - self.width)
+        self.draw()
@@ -0,0 +1,197 @@
+"""
+Average epochs by condition without keeping the epochs in memory
+
+`EvokedAccumulator` keeps the number of epochs, the running mean and the
+running sum of squared deviations of each condition (Welford's method, with
+Chan et al.'s formula to combine batches). Epochs are added in batches as
+they are read from the raw data (`preproc.iter_epochs`) and then dropped,
+so the memory used is only conditions x channels x times. Accumulators from
+different subjects (or processes) can be merged.
+
+At the end, `evoked()` and `stderr()` give mne.EvokedArray objects with the
+mean and the standard error of the mean of each condition.
+
+Example: Fixation-related responses split by the category of the fixated
+stimulus, for each subject and across the cohort
+    res = evoked_accum.cohort([0, 1, 2], by='closest_category')
+    res['pooled'].evoked('human face').plot()  # All the fixations
+    evoked, se = evoked_accum.grand_average(res['subjects'], 'human face')
+"""
+
+import numpy as np
+import mne
+import config
+import preproc
+import profiling
+
+
+class EvokedAccumulator(object):
+    """ Running mean and variance of the epochs in each condition
+
+    info: mne Info of the epochs
+    tmin: Time of the first sample of each epoch (s)
+    baseline: Baseline correction for each epoch, as in mne.Epochs
+    """
+
+    def __init__(self, info, tmin, baseline=(None, 0)):
+        self.info = info
+        self.tmin = tmin
+        self.baseline = baseline
+        self.n = {}
+        self.mean = {}
+        self.m2 = {}  # Sum of squared deviations from the mean
+
+    def conditions(self):
+        return list(self.n)
+
+    def _combine(self, cond, n_b, mean_b, m2_b):
+        """ Add the summary of a batch of epochs to a condition
+        """
+        if cond not in self.n:
+            self.n[cond] = n_b
+            self.mean[cond] = mean_b.copy()
+            self.m2[cond] = m2_b.copy()
+            return
+        n_a = self.n[cond]
+        n = n_a + n_b
+        delta = mean_b - self.mean[cond]
+        self.mean[cond] += delta * (n_b / n)
+        self.m2[cond] += m2_b + delta ** 2 * (n_a * n_b / n)
+        self.n[cond] = n
+
+    def add(self, data, conditions):
+        """ Add a batch of epochs
+
+        data: Array (epochs, channels, times)
+        conditions: Condition of each epoch (epochs with None are skipped)
+        """
+        if self.baseline is not None:
+            times = self.tmin + np.arange(data.shape[2]) / self.info['sfreq']
+            data = mne.baseline.rescale(data, times, self.baseline,
+                                        mode='mean', copy=True,
+                                        verbose=False)
+        groups = {}
+        for i, cond in enumerate(conditions):
+            if cond is not None:
+                groups.setdefault(cond, []).append(i)
+        for cond, inx in groups.items():
+            x = data[inx]
+            mean = x.mean(axis=0)
+            m2 = ((x - mean) ** 2).sum(axis=0)
+            self._combine(cond, len(inx), mean, m2)
+
+    def merge(self, other):
+        """ Add all the epochs summarized in another accumulator
+        """
+        for cond in other.n:
+            self._combine(cond, other.n[cond], other.mean[cond],
+                          other.m2[cond])
+        return self
+
+    def evoked(self, cond):
+        """ Average of the epochs in one condition (mne.EvokedArray)
+        """
+        return mne.EvokedArray(self.mean[cond], self.info, tmin=self.tmin,
+                               nave=self.n[cond], comment=str(cond))
+
+    def stderr(self, cond):
+        """ Standard error of the mean of one condition (mne.EvokedArray)
+        """
+        n = self.n[cond]
+        se = np.sqrt(self.m2[cond] / max(n - 1, 1) / n)
+        return mne.EvokedArray(se, self.info, tmin=self.tmin, nave=n,
+                               comment=f'{cond} (SE)')
+
+
+def _labels(meta, by):
+    """ Condition of each epoch from one column of the metadata, or a tuple
+    from several columns. None where any of them is missing.
+    """
+    cols = [by] if isinstance(by, str) else list(by)
+    missing = meta[cols].isna().any(axis=1).to_numpy()
+    values = meta[cols].astype(object).to_numpy()
+    if isinstance(by, str):
+        labels = values[:, 0].tolist()
+    else:
+        labels = [tuple(v) for v in values]
+    return [None if m else lab for lab, m in zip(labels, missing)]
+
+
+def fixation_metadata(meta):
+    """ Add the stimulus category of the fixated and previous stimuli to the
+    fixation table (`closest_category` and `prev_category`)
+    """
+    from fixation_db import stim_category
+    category = stim_category()
+    meta = meta.copy()
+    for col in ('closest', 'prev'):
+        meta[f'{col}_category'] = meta[f'{col}_stim'].astype(object) \
+            .map(category)
+    return meta
+
+
+@profiling.profiled('evoked_accum.accumulate')
+def accumulate(d, by, tmin=-0.2, tmax=0.5, baseline=(None, 0),
+               reject_by_annotation=True, **kwargs):
+    """ Average the fixation-locked epochs of one subject by condition,
+    reading the epochs one stretch of data at a time.
+
+    d: Data from `load_data.load_data(n)`
+    by: Column of the fixation table to split the epochs by (e.g.
+        'closest_category', 'prev_category', 'closest_loc'), or a list
+    reject_by_annotation: Leave out epochs that overlap bad segments
+    Other keyword arguments are passed on to `preproc.iter_epochs`.
+
+    Returns an EvokedAccumulator.
+    """
+    import fixation_events
+    raw = d['raw']
+    event_id = config.expt_info()['event_dict']['fix_on']
+    events, meta = fixation_events.make_events(
+        [(d['fix_info'], 'start_meg', 'fix_on')], metadata=True)
+    meta = fixation_metadata(meta)
+    keep, starts, stops = preproc.epoch_windows(
+        raw, events, event_id, tmin, tmax,
+        reject_by_annotation=reject_by_annotation)
+    labels = _labels(meta.iloc[keep], by)
+    acc = EvokedAccumulator(raw.info, tmin, baseline)
+    for inx, data in preproc.iter_epochs(raw, starts, stops, ica=d['ica'],
+                                         **kwargs):
+        acc.add(data, [labels[i] for i in inx])
+    return acc
+
+
+def cohort(subjects, by, **kwargs):
+    """ Average the fixation-locked epochs of each subject by condition.
+    Only one subject's data are loaded at a time.
+
+    Keyword arguments are passed on to `accumulate()`.
+    Returns a dict:
+        subjects: One EvokedAccumulator per subject
+        pooled: All the epochs of all the subjects together
+    """
+    import load_data
+    accs = []
+    pooled = None
+    for n in subjects:
+        d = load_data.load_data(n)
+        acc = accumulate(d, by, **kwargs)
+        accs.append(acc)
+        if pooled is None:
+            pooled = EvokedAccumulator(acc.info, acc.tmin, acc.baseline)
+        pooled.merge(acc)
+        del d
+    return {'subjects': accs, 'pooled': pooled}
+
+
+def grand_average(accs, cond):
+    """ Mean and standard error across subjects of their average response
+    in one condition (subjects without that condition are left out)
+
+    Returns two mne.EvokedArray objects.
+    """
+    across = EvokedAccumulator(accs[0].info, accs[0].tmin, baseline=None)
+    for acc in accs:
+        if cond in acc.n:
+            across.add(acc.mean[cond][None], [cond])
+    return across.evoked(cond), across.stderr(cond)
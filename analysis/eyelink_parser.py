@@ -2,7 +2,8 @@
 Parse eye-link files. Construct pd.DataFrame objects for fixations and triggers
 """
 
-import pandas as pd
+import profiling
+# numpy, pandas and the fixation table are imported when a file is read
 
 
 def _get_entries(lines, start_str):
@@ -15,35 +16,62 @@ def _get_entries(lines, start_str):
 
 class EyelinkData(object):
     """
-    Initialized with the filename of the eyelink .asc file.
+    Initialized with the filename of the eyelink .asc file, or the .npz file
+    of data streamed from the link during the recording (saved by
+    `eye_wrapper.LinkRecorder` in the experiment scripts).
     Has the following attributes.
-    - lines: All lines from the data file
-    - fixations: pd.DataFrame of fixations
+    - lines: All lines from the data file (None for .npz files)
+    - fixations: pd.DataFrame of fixations (types in `fixation_table`)
     - triggers: pd.DataFrame of triggers
     """
 
+    @profiling.profiled('eyelink_parser.EyelinkData')
     def __init__(self, fname):
-        with open(fname, 'r') as f:
-            lines = f.readlines()
+        if fname.endswith('.npz'):
+            self._read_stream(fname)
+        else:
+            self._read_asc(fname)
+
+    def _read_asc(self, fname):
+        import pandas as pd
+        import fixation_table
+        with profiling.stage('eyelink_parser.read_lines'):
+            with open(fname, 'r') as f:
+                lines = f.readlines()
         self.lines = lines
 
         # Fixations
-        colnames = ['EFIX', 'eye_side', 'start', 'end',
-                    'dur', 'x_avg', 'y_avg', 'pupil']
-        fix = _get_entries(self.lines, 'EFIX')
-        fix = pd.DataFrame(fix, columns=colnames)
-        fix = fix.drop(columns='EFIX')
-        for col in ['start', 'end', 'dur', 'pupil']:
-            fix[col] = fix[col].astype(int)
-        for col in ['x_avg', 'y_avg']:
-            fix[col] = fix[col].astype(float)
+        with profiling.stage('eyelink_parser.fixations'):
+            colnames = ['EFIX', 'eye_side', 'start', 'end',
+                        'dur', 'x_avg', 'y_avg', 'pupil']
+            fix = _get_entries(self.lines, 'EFIX')
+            fix = pd.DataFrame(fix, columns=colnames)
+            fix = fix.drop(columns='EFIX')
+            fix = fixation_table.compact(fix)  # Convert to compact types
         self.fixations = fix
 
         # Triggers
-        colnames = ['MSG', 'time_stamp', 'type', 'value']
-        msg = _get_entries(self.lines, 'MSG')
-        msg = [m for m in msg if m[2] == 'Trigger']
-        msg = pd.DataFrame(msg, columns=colnames)
-        msg = msg.drop(columns=['MSG', 'type'])
-        msg = msg.astype(int)
+        with profiling.stage('eyelink_parser.triggers'):
+            colnames = ['MSG', 'time_stamp', 'type', 'value']
+            msg = _get_entries(self.lines, 'MSG')
+            msg = [m for m in msg if m[2] == 'Trigger']
+            msg = pd.DataFrame(msg, columns=colnames)
+            msg = msg.drop(columns=['MSG', 'type'])
+            msg = msg.astype(int)
         self.triggers = msg
+
+    def _read_stream(self, fname):
+        import numpy as np
+        import pandas as pd
+        import fixation_table
+        self.lines = None
+        with profiling.stage('eyelink_parser.read_stream'):
+            with np.load(fname) as d:
+                cols = ['eye_side', 'start', 'end',
+                        'dur', 'x_avg', 'y_avg', 'pupil']
+                fix = pd.DataFrame({c: d[f'fixations.{c}'] for c in cols})
+                trig = pd.DataFrame({'time_stamp': d['triggers.time_stamp'],
+                                     'value': d['triggers.value']})
+            fix = fixation_table.compact(fix)
+        self.fixations = fix
+        self.triggers = trig.astype(int)
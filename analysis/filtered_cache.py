@@ -0,0 +1,194 @@
+"""
+Cache of band-pass filtered recordings
+
+Several steps filter the whole continuous recording with the same settings
+every time they run (e.g. 0.5-40 Hz to look for artifacts, 0.1-40 Hz for
+the analysis). Here, each recording is filtered once per setting, and the
+result is saved in `data/filtered/` as a float32 .npy file (channels x
+samples). Only the channel types given to `get()` are filtered (by default
+MEG and EEG, as in `raw.filter()` and `preproc.read_epochs`), and the other
+channels are copied as they are. The cache is keyed by the raw file (name,
+size and modification time) and the filter settings, including the channel
+types, so it's remade when either changes.
+
+The filtering is done with overlap-add, one chunk of the recording at a
+time, with the same FIR filter as `mne.filter.filter_data` (zero phase,
+edges padded by reflection). Neither the raw data nor the filtered data
+are ever in memory all at once.
+
+`get()` returns the filtered data as an mne Raw object that reads from the
+memory-mapped file when data are requested, so it can be used like any
+other Raw that isn't preloaded (plotting, epoching, `get_data()`).
+
+Example:
+    raw_filt = filtered_cache.get(d['raw'], 0.1, 40.0)
+    epochs = mne.Epochs(raw_filt, d['fix_events'], ...)
+"""
+
+import os
+import json
+import hashlib
+import numpy as np
+import mne
+from scipy.signal import fftconvolve
+import config
+import profiling
+
+try:
+    from mne._fiff.utils import _mult_cal_one
+except ImportError:  # Older versions of mne
+    from mne.io.utils import _mult_cal_one
+
+CHUNK_SEC = 60.0  # How much data to read and filter at once (s)
+CH_TYPES = ('meg', 'eeg')  # Channel types that are filtered by default
+
+
+def _data_id(raw, l_freq, h_freq, ch_types):
+    """ Identify the raw data and filter settings without reading the data
+    """
+    fname = raw.filenames[0]
+    st = os.stat(fname)
+    return f'{os.path.basename(fname)}:{st.st_size}:{int(st.st_mtime)}:' \
+           f'{raw.first_samp}:{raw.n_times}:{l_freq}:{h_freq}:' \
+           f'{",".join(sorted(ch_types))}'
+
+
+def cache_fname(raw, l_freq, h_freq, ch_types=CH_TYPES):
+    """ Where the filtered data for this recording and filter are kept
+    (without the extension)
+    """
+    data_id = _data_id(raw, l_freq, h_freq, ch_types)
+    key = hashlib.sha1(data_id.encode()).hexdigest()[:12]
+    name = os.path.splitext(os.path.basename(raw.filenames[0]))[0]
+    return f'{config.data_dir()}filtered/{name}-{key}'
+
+
+def _filter_picks(info, ch_types):
+    """ Channels that are filtered (the others are copied as they are)
+    """
+    return mne.pick_types(info, exclude=[], **{t: True for t in ch_types})
+
+
+def _blocks(raw, picks, n_pad, chunk):
+    """ The data to filter, one block at a time: the start of the
+    recording reflected, the recording, and the end reflected.
+    Yields (block, start sample of the recording or None for the padding)
+    """
+    n = raw.n_times
+    if n_pad:
+        head = raw.get_data(picks=picks, start=1, stop=n_pad + 1)
+        yield head[:, ::-1], None
+    for start in range(0, n, chunk):
+        stop = min(start + chunk, n)
+        yield raw.get_data(start=start, stop=stop), start
+    if n_pad:
+        tail = raw.get_data(picks=picks, start=n - n_pad - 1, stop=n - 1)
+        yield tail[:, ::-1], None
+
+
+@profiling.profiled('filtered_cache.build')
+def build(raw, fname, l_freq, h_freq, ch_types=CH_TYPES,
+          chunk_sec=CHUNK_SEC):
+    """ Filter a recording chunk by chunk (overlap-add) and save it in
+    `fname`.npy, with info about it in `fname`.json.
+    """
+    sfreq = raw.info['sfreq']
+    n = raw.n_times
+    picks = _filter_picks(raw.info, ch_types)
+    h = mne.filter.create_filter(None, sfreq, l_freq, h_freq, verbose=False)
+    delay = (len(h) - 1) // 2  # Delay of the linear-phase filter
+    n_pad = min(delay, n - 2)  # Reflected padding at each edge
+    chunk = int(chunk_sec * sfreq)
+
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    if os.path.exists(f'{fname}.json'):
+        os.remove(f'{fname}.json')  # Only there once the cache is complete
+    out = np.lib.format.open_memmap(f'{fname}.npy', mode='w+',
+                                    dtype=np.float32,
+                                    shape=(raw.info['nchan'], n))
+
+    # Sample i of the padded data is at conv[i + delay] after convolving
+    # with h, and sample t of the recording is at i = t + n_pad
+    shift = n_pad + delay
+    other = np.setdiff1d(np.arange(raw.info['nchan']), picks)
+    overlap = np.zeros([len(picks), len(h) - 1])
+    pos = 0  # Position of the current block in the padded data
+
+    def write(conv, pos):
+        """ Write the finished part of the convolution that's inside the
+        recording
+        """
+        t0 = pos - shift
+        lo = max(t0, 0)
+        hi = min(t0 + conv.shape[1], n)
+        if hi > lo:
+            out[picks, lo:hi] = conv[:, lo - t0:hi - t0]
+
+    for block, start in _blocks(raw, picks, n_pad, chunk):
+        if start is not None:
+            # Channels that aren't filtered are copied as they are
+            out[other, start:start + block.shape[1]] = block[other]
+            block = block[picks]
+        n_block = block.shape[1]
+        with profiling.stage('filtered_cache.convolve'):
+            conv = fftconvolve(block, h[None, :], axes=1)
+        conv[:, :len(h) - 1] += overlap
+        overlap = conv[:, n_block:]
+        write(conv[:, :n_block], pos)
+        pos += n_block
+    write(overlap, pos)  # Only needed if the recording is very short
+    out.flush()
+
+    info = {'data_id': _data_id(raw, l_freq, h_freq, ch_types),
+            'l_freq': l_freq,
+            'h_freq': h_freq,
+            'ch_types': list(ch_types),
+            'filter_len': len(h)}
+    with open(f'{fname}.json', 'w') as f:
+        json.dump(info, f, indent=2)
+    print(f'Saved filtered data: {fname}.npy')
+
+
+def get(raw, l_freq, h_freq, ch_types=CH_TYPES):
+    """ Band-pass filtered copy of a recording, from the cache (filtering
+    it first if it isn't there yet). The annotations of `raw` are copied.
+
+    raw: mne.io.Raw read from a file (doesn't have to be preloaded)
+    ch_types: Channel types to filter, e.g. ('meg', 'eog') to look for
+              artifacts. The other channels are left as they are.
+    Returns a FilteredRaw.
+    """
+    fname = cache_fname(raw, l_freq, h_freq, ch_types)
+    if not os.path.exists(f'{fname}.json'):
+        print(f'Filtering {l_freq}-{h_freq} Hz for the cache')
+        build(raw, fname, l_freq, h_freq, ch_types)
+    raw_filt = FilteredRaw(f'{fname}.npy', raw.info, raw.first_samp,
+                           l_freq, h_freq)
+    raw_filt.set_annotations(raw.annotations)
+    return raw_filt
+
+
+class FilteredRaw(mne.io.BaseRaw):
+    """ Raw data read from a .npy file of filtered data, on demand
+
+    fname: .npy file (channels x samples), in SI units
+    info: Info of the original recording
+    first_samp: First sample of the original recording
+    """
+
+    def __init__(self, fname, info, first_samp, l_freq, h_freq):
+        n_times = np.load(fname, mmap_mode='r').shape[1]
+        info = info.copy()
+        for ch in info['chs']:  # The data are already in SI units
+            ch['cal'] = 1.0
+            ch['range'] = 1.0
+        info['highpass'] = l_freq
+        info['lowpass'] = h_freq
+        super(FilteredRaw, self).__init__(
+            info, preload=False, first_samps=[first_samp],
+            last_samps=[first_samp + n_times - 1], filenames=[fname],
+            raw_extras=[{'fname': fname}], verbose=False)
+
+    def _read_segment_file(self, data, idx, fi, start, stop, cals, mult):
+        x = np.load(self._raw_extras[fi]['fname'], mmap_mode='r')
+        _mult_cal_one(data, x[:, start:stop], idx, cals, mult)
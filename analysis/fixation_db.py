@@ -0,0 +1,254 @@
+"""
+Database of fixations and trials for all subjects
+
+Fixations (from `fixation_events.get_fixation_events`) and trials (from the
+behavioral logfiles) for every subject are kept in one SQLite file,
+`data/fixations.sqlite`. Queries across subjects then only touch this file,
+not the raw MEG data.
+
+Tables
+- fixations: One row per fixation, with the columns of the fixation table,
+  plus `subject`, `fix_index` (row in the subject's fixation table),
+  `closest_category`, `prev_loc` (location of the previously-fixated
+  stimulus: 0=left, 1=center, 2=right) and `prev_category`
+- trials: One row per trial, from the behavioral logfile
+- stimuli: Stimulus ID and category, from `stimuli.yaml`
+- sources: Which files each subject's rows were made from
+
+Example: Fixations on faces that came from the left-hand item
+    import fixation_db
+    fixation_db.update()  # Add any subjects that are new or have changed
+    fix = fixation_db.select(closest_category=['human face', 'animal face'],
+                             prev_loc=0)
+"""
+
+import os
+import pathlib
+import sqlite3
+import numpy as np
+import pandas as pd
+import config
+import load_data
+import fixation_table
+
+# Columns of the fixations table, and their SQL types
+FIX_COLUMNS = {'subject': 'INTEGER NOT NULL',
+               'fix_index': 'INTEGER NOT NULL',
+               'eye_side': 'TEXT',
+               'start': 'INTEGER',
+               'end': 'INTEGER',
+               'dur': 'INTEGER',
+               'x_avg': 'REAL',
+               'y_avg': 'REAL',
+               'pupil': 'INTEGER',
+               'trial_number': 'INTEGER',
+               'start_meg': 'INTEGER',
+               'end_meg': 'INTEGER',
+               'closest_loc': 'INTEGER',
+               'closest_stim': 'INTEGER',
+               'closest_category': 'TEXT',
+               'prev_stim': 'INTEGER',
+               'prev_loc': 'INTEGER',
+               'prev_category': 'TEXT',
+               'dist_to_stim': 'REAL',
+               'on_target': 'INTEGER'}
+
+TRIAL_COLUMNS = {'subject': 'INTEGER NOT NULL',
+                 'trial_number': 'INTEGER NOT NULL',
+                 'stim_left': 'INTEGER',
+                 'stim_center': 'INTEGER',
+                 'stim_right': 'INTEGER',
+                 'probe_word': 'TEXT',
+                 'resp': 'TEXT',
+                 'rt': 'REAL'}
+
+INDEXES = {'fixations': [['subject'],
+                         ['subject', 'trial_number'],
+                         ['closest_stim'],
+                         ['prev_stim'],
+                         ['closest_category', 'prev_loc'],
+                         ['prev_category']],
+           'trials': [['subject', 'trial_number']]}
+
+
+def stim_category():
+    """ Category of each stimulus ID
+    """
+    return {s: cat for cat, stims in config.stim_info().items()
+            for s in stims}
+
+
+def db_fname():
+    """ Default location of the database
+    """
+    return f'{config.data_dir()}fixations.sqlite'
+
+
+def connect(fname=None):
+    """ Open the database for writing, making the tables if they don't
+    exist yet
+    """
+    con = sqlite3.connect(fname or db_fname())
+    cols = ', '.join(f'"{c}" {t}' for c, t in FIX_COLUMNS.items())
+    con.execute(f'CREATE TABLE IF NOT EXISTS fixations ({cols}, '
+                'PRIMARY KEY (subject, fix_index))')
+    cols = ', '.join(f'"{c}" {t}' for c, t in TRIAL_COLUMNS.items())
+    con.execute(f'CREATE TABLE IF NOT EXISTS trials ({cols}, '
+                'PRIMARY KEY (subject, trial_number))')
+    con.execute('CREATE TABLE IF NOT EXISTS stimuli '
+                '(stim_id INTEGER PRIMARY KEY, category TEXT)')
+    con.execute('CREATE TABLE IF NOT EXISTS sources '
+                '(subject INTEGER PRIMARY KEY, files TEXT)')
+    for table, indexes in INDEXES.items():
+        for cols in indexes:
+            name = f'{table}_' + '_'.join(cols)
+            col_list = ', '.join(f'"{c}"' for c in cols)
+            con.execute(f'CREATE INDEX IF NOT EXISTS {name} '
+                        f'ON {table} ({col_list})')
+    con.executemany('INSERT OR REPLACE INTO stimuli VALUES (?, ?)',
+                    stim_category().items())
+    con.commit()
+    return con
+
+
+def connect_read(fname=None):
+    """ Open the database read-only, so queries (e.g. from parallel
+    workers) don't take write locks. Use `update()` to make it.
+    """
+    fname = fname or db_fname()
+    assert os.path.exists(fname), \
+        f'No fixation database at {fname}: run fixation_db.update()'
+    uri = pathlib.Path(fname).resolve().as_uri() + '?mode=ro'
+    return sqlite3.connect(uri, uri=True)
+
+
+def _source_files(n):
+    """ The files that subject n's rows are made from, with their sizes and
+    modification times, as one string.
+    """
+    data_dir = config.data_dir()
+    info = config.subject_info()
+    subj_fname = str(info['meg_dir'][n])
+    fnames = [f"{data_dir}raw/{subj_fname}/{info['meg_fname'][n]}",
+              config.eyelink_fname(n),
+              f"{data_dir}logfiles/{info['behav'][n]}.csv"]
+    out = []
+    for fname in fnames:
+        st = os.stat(fname)
+        out.append(f'{os.path.basename(fname)}:{st.st_size}:'
+                   f'{int(st.st_mtime)}')
+    return ';'.join(out)
+
+
+def _fixation_rows(n, fix, behav):
+    """ Convert a subject's fixation table to rows of the fixations table
+    """
+    fix = fixation_table.expand(fixation_table.compact(fix))
+    rows = pd.DataFrame({'subject': n, 'fix_index': np.arange(len(fix))})
+    for col in FIX_COLUMNS:
+        if col in fix.columns:
+            rows[col] = fix[col].to_numpy()
+    rows['on_target'] = fix['on_target'].map({True: 1, False: 0})
+    category = stim_category()
+    rows['closest_category'] = fix['closest_stim'].map(category)
+    rows['prev_category'] = fix['prev_stim'].map(category)
+
+    # Where was the previous stimulus on the screen in this trial?
+    rows['prev_loc'] = np.nan
+    has_prev = fix['prev_stim'].notna().to_numpy()
+    trial = fix['trial_number'].to_numpy()[has_prev].astype(int)
+    stims = behav[['stim_left', 'stim_center', 'stim_right']].to_numpy()
+    match = stims[trial] == fix['prev_stim'].to_numpy()[has_prev, None]
+    rows.loc[has_prev, 'prev_loc'] = np.argmax(match, axis=1)
+    return rows[list(FIX_COLUMNS)]
+
+
+def _trial_rows(n, behav):
+    """ Convert a behavioral logfile to rows of the trials table
+    """
+    rows = pd.DataFrame({'subject': n, 'trial_number': np.arange(len(behav))})
+    for col in TRIAL_COLUMNS:
+        if col in behav.columns:
+            rows[col] = behav[col].to_numpy()
+        elif col not in rows.columns:
+            rows[col] = None
+    return rows[list(TRIAL_COLUMNS)]
+
+
+def add_subject(con, n):
+    """ Load one subject's data and (re)write their rows in the database
+    """
+    d = load_data.load_data(n)
+    fix_rows = _fixation_rows(n, d['fix_info'], d['behav'])
+    trial_rows = _trial_rows(n, d['behav'])
+    with con:  # One transaction, so a subject is never half-written
+        con.execute('DELETE FROM fixations WHERE subject = ?', (n,))
+        con.execute('DELETE FROM trials WHERE subject = ?', (n,))
+        fix_rows.to_sql('fixations', con, if_exists='append', index=False)
+        trial_rows.to_sql('trials', con, if_exists='append', index=False)
+        con.execute('INSERT OR REPLACE INTO sources VALUES (?, ?)',
+                    (n, _source_files(n)))
+
+
+def update(subjects=None, force=False, fname=None):
+    """ Add subjects to the database. Subjects whose files haven't changed
+    since they were added are skipped, unless `force` is True.
+
+    subjects: List of subject numbers (default: everyone)
+    """
+    if subjects is None:
+        subjects = list(config.subject_info().index)
+    con = connect(fname)
+    sources = dict(con.execute('SELECT subject, files FROM sources'))
+    for n in subjects:
+        if not force and sources.get(n) == _source_files(n):
+            continue
+        print(f'Adding subject {n} to the fixation database')
+        add_subject(con, n)
+    con.execute('ANALYZE')
+    con.close()
+
+
+def query(sql, params=(), fname=None):
+    """ Run an SQL query on the database and return a pd.DataFrame
+    """
+    con = connect_read(fname)
+    try:
+        return pd.read_sql_query(sql, con, params=params)
+    finally:
+        con.close()
+
+
+def select(table='fixations', columns='*', fname=None, **where):
+    """ Get the rows of a table that match some conditions.
+
+    Each keyword argument is a column name, and the value it must have.
+    Use a list to allow several values, or None to look for missing values.
+    Fixations are returned with the column types from `fixation_table`.
+
+    Example: select(subject=[0, 1], on_target=True, prev_stim=None)
+    """
+    conds = []
+    params = []
+    for col, val in where.items():
+        if val is None:
+            conds.append(f'"{col}" IS NULL')
+        elif np.ndim(val) == 0:
+            conds.append(f'"{col}" = ?')
+            params.append(val)
+        else:
+            conds.append(f'"{col}" IN ({", ".join("?" * len(val))})')
+            params.extend(val)
+    if not isinstance(columns, str):
+        columns = ', '.join(f'"{c}"' for c in columns)
+    sql = f'SELECT {columns} FROM {table}'
+    if conds:
+        sql += ' WHERE ' + ' AND '.join(conds)
+    params = [int(p) if isinstance(p, (bool, np.integer)) else p
+              for p in params]
+    rows = query(sql, params, fname)
+    if table == 'fixations':
+        if 'on_target' in rows.columns:
+            rows['on_target'] = rows['on_target'].astype('boolean')
+        rows = fixation_table.compact(rows)
+    return rows
@@ -1,149 +1,238 @@
 """ Get an MEG-trigger--style event structure for each fixation
+
+A fixation is on a stimulus (`on_target`) if its average position is within
+half the stimulus size of the stimulus center, i.e. roughly inside the
+picture. `prev_stim` is the stimulus that was fixated before the current
+one: going back over the fixations on the current stimulus, it's the first
+one on a different stimulus. It's missing if a fixation off all the stimuli
+comes first. (`on_target` used to be left empty, so `prev_stim` was never
+set.)
 """
 
-import json
-import socket
 import numpy as np
-import pandas as pd
-import mne
-
-import eyelink_parser
-
-import sys
-sys.path.append('../exp-scripts')
-import dist_convert as dc
+import config
+import profiling
+import trigger_match
 
+# pandas, mne and the fixation table are only imported when they're used,
+# so this module is quick to import (e.g. in worker processes)
 
-expt_info = json.load(open('expt_info.json'))
 
-hostname = socket.gethostname().lower()
-if hostname.startswith('colles'):
-    data_dir = expt_info['data_dir'][hostname]
-else:
-    data_dir = expt_info['data_dir']['standard']
+def stim_locs():
+    """ Locations of the stimuli (left, center, right), in Eyelink pixels
+    """
+    dc = config.dist_convert()
+    stim_dist = int(dc.deg2pix(config.expt_info()['stim_dist_deg']))
+    locs = [(-stim_dist, 0),
+            (0, 0),
+            (stim_dist, 0)]
+    return [dc.origin_psychopy2eyelink(pos) for pos in locs]
 
 
-# Get the locations of the stimuli
-win_center = (0, 0)
-stim_dist = int(dc.deg2pix(expt_info['stim_dist_deg']))
-stim_locs = [(-stim_dist, 0),
-             (0, 0),
-             (stim_dist, 0)]
-stim_locs = [dc.origin_psychopy2eyelink(pos) for pos in stim_locs]
+def on_target_dist():
+    """ Fixations within this distance (in pixels) of the center of a
+    stimulus count as being on that stimulus: half the stimulus size
+    """
+    dc = config.dist_convert()
+    return dc.deg2pix(config.expt_info()['stim_size_deg']) / 2
 
 
-def _closest_stim(x, y):
+def _closest_stim(x, y, locs):
     """ Find the closest stimulus to the given position
     Return the index of the closest stim, and the distance to it
     """
     pos = np.array([x, y])
-    d = [np.linalg.norm(pos - np.array(s)) for s in stim_locs]
+    d = [np.linalg.norm(pos - np.array(s)) for s in locs]
     loc = np.argmin(d)
     min_d = np.min(d)
     return loc, min_d
 
 
+def make_events(sources, metadata=False):
+    """ Make one mne-compatible events array from several tables of events.
+
+    sources: List of (table, time_col, trigger)
+        table: pd.DataFrame with one row per event
+        time_col: Column holding the time of each event in MEG samples.
+                  Rows where this is missing are left out.
+        trigger: Name of the event in expt_info['event_dict'], or a number
+    metadata: If True, also return a pd.DataFrame with one row per event
+              (aligned with the events array) holding the row of the
+              source table it came from, e.g. for mne.Epochs(metadata=...).
+              Its first columns are the trigger ('event') and the index in
+              the source table ('source_row'); columns of a table with
+              these names are replaced.
+
+    The events are sorted by time, and exact duplicates (same sample and
+    trigger) are dropped.
+    """
+    # Find the valid rows of each table first, so the array can be
+    # allocated once and filled in
+    samples = []
+    for table, time_col, _ in sources:
+        t = table[time_col]
+        samples.append(t[t.notna()])
+    n_events = sum(len(t) for t in samples)
+    events = np.zeros([n_events, 3], dtype=np.int64)
+    i_start = 0
+    for (_, _, trigger), t in zip(sources, samples):
+        if isinstance(trigger, str):
+            trigger = config.expt_info()['event_dict'][trigger]
+        i_end = i_start + len(t)
+        events[i_start:i_end, 0] = t.to_numpy(dtype=np.int64)
+        events[i_start:i_end, 2] = trigger
+        i_start = i_end
+
+    # Sort by time (and trigger value, to break ties) and drop duplicates
+    order = np.lexsort((events[:, 2], events[:, 0]))
+    events = events[order]
+    keep = np.ones(n_events, dtype=bool)
+    keep[1:] = np.any(events[1:] != events[:-1], axis=1)
+    events = events[keep]
+    if not metadata:
+        return events
+
+    import pandas as pd
+    meta = []
+    for (table, time_col, trigger), t in zip(sources, samples):
+        m = table.loc[t.index].drop(columns=['event', 'source_row'],
+                                    errors='ignore')
+        m.insert(0, 'event', trigger)
+        m.insert(1, 'source_row', t.index)
+        meta.append(m)
+    meta = pd.concat(meta, ignore_index=True)
+    meta = meta.iloc[order[keep]].reset_index(drop=True)
+    return events, meta
+
+
+@profiling.profiled('fixation_events.get_fixation_events')
 def get_fixation_events(meg_events, eye_data, behav_data):
     """ Get an mne-compatible array of events (in units of MEG samples)
     """
+    import fixation_table
+    expt_info = config.expt_info()
+    locs = stim_locs()
+    max_dist = on_target_dist()
     trial_window_sec = 4.5  # length of the trial to analyze
     trial_window_samp = int(trial_window_sec * expt_info['fsample_eyelink'])
 
-    # Get the onset of each trial in MEG samples
-    row_inx = meg_events[:, 2] == expt_info['event_dict']['stimuli']
-    meg_events = meg_events[row_inx, :]
-    trial_onsets_meg = meg_events[:, 0]
-
-    # Get the onset of each trial in Eyelink samples
+    # Match up the triggers in the MEG and Eyelink data. Either one may
+    # have missed a few triggers, so they're matched by their timing.
+    trig_values = list(expt_info['event_dict'].values())
     trigs = eye_data.triggers
-    row_inx = trigs['value'] == expt_info['event_dict']['stimuli']
-    trial_onsets_eye = np.array(trigs.loc[row_inx, 'time_stamp'])
+    trigs = trigs[trigs['value'].isin(trig_values)]
+    meg_events = meg_events[np.isin(meg_events[:, 2], trig_values)]
+    match = trigger_match.match_triggers(trigs['time_stamp'].to_numpy(),
+                                         trigs['value'].to_numpy(),
+                                         meg_events[:, 0],
+                                         meg_events[:, 2])
+    trigger_match.print_match(match, 'Eyelink', 'MEG')
+
+    # Get the onset of each trial in Eyelink samples, and in MEG samples
+    # where the MEG trigger was found (-1 otherwise). The trials are
+    # counted on the merged timeline of both systems, so a trial onset that
+    # either one missed still counts as a trial, and the trial numbers
+    # (rows of the logfile) after it stay right. Where the Eyelink missed
+    # the onset, it's estimated from the MEG trigger.
+    onset_value = expt_info['event_dict']['stimuli']
+    trial_onsets_eye, trial_onsets_meg, found_eye, found_meg = \
+        trigger_match.merged_times(trigs['time_stamp'].to_numpy(),
+                                   trigs['value'].to_numpy(),
+                                   meg_events[:, 0], meg_events[:, 2],
+                                   match, onset_value)
+    assert len(trial_onsets_eye) <= len(behav_data), \
+        'More trial onsets than trials in the behavioral logfile'
     trial_offsets_eye = trial_onsets_eye + trial_window_samp
-
-    # Make sure MEG and Eyelink data have the same number of trials
-    assert trial_onsets_eye.size == trial_onsets_meg.size
-
-    # How much difference is there in the speed of the Eyelink and MEG clocks?
-    drift = np.diff(trial_onsets_meg) / np.diff(trial_onsets_eye)
-    msg = "Timing drift ratio = {:.5f} +/- {:.5f}"
-    print(msg.format(np.mean(drift), np.std(drift)))
+    trial_onsets_meg[~found_meg] = -1
+    if np.sum(~found_eye):
+        print(f'Estimated the Eyelink onset of {np.sum(~found_eye)} trials '
+              'from the MEG trigger')
+    if np.sum(~found_meg):
+        print(f'Leaving out {np.sum(~found_meg)} trials without an MEG '
+              'trigger')
 
     # Store timing data for each fixation
     fix = eye_data.fixations
-    fix['trial_number'] = np.nan  # Psychopy trial number
-    fix['start_meg'] = np.nan  # Time of fixation start in MEG samples
-    fix['end_meg'] = np.nan  # Time of fix end in MEG samples
-    for i_fix in range(fix.shape[0]):
-        t_start_fix = fix['start'][i_fix]
-        t_end_fix = fix['end'][i_fix]
+    n_fix = fix.shape[0]
+    fix_start = fix['start'].to_numpy(dtype=np.int64)
+    fix_end = fix['end'].to_numpy(dtype=np.int64)
+    trial_number = np.zeros(n_fix, dtype=int)  # Psychopy trial number
+    start_meg = np.zeros(n_fix, dtype=np.int64)  # Fix start in MEG samples
+    end_meg = np.zeros(n_fix, dtype=np.int64)  # Fix end in MEG samples
+    in_trial = np.zeros(n_fix, dtype=bool)  # Does this fix belong to a trial?
+    for i_fix in range(n_fix):
+        t_start_fix = fix_start[i_fix]
+        t_end_fix = fix_end[i_fix]
         # Which trial is this fixation in?
         # First, find trials with onsets before this fixation
         onset_before_fix = np.nonzero(trial_onsets_eye < t_start_fix)[0]
+        if onset_before_fix.size == 0:
+            continue
         # Then get the last trial that began before this fixation
-        try:
-            trial_inx = onset_before_fix.max()
-        except ValueError:
-            trial_inx = np.nan
-        # Is this fixation after the end of the trial?
-        # If so, store it as an NaN
-        if not np.isnan(trial_inx):
-            if (t_end_fix > trial_offsets_eye[trial_inx]):
-                trial_inx = np.nan
+        trial_inx = onset_before_fix.max()
+        # Is this fixation after the end of the trial? If so, leave it out
+        if t_end_fix > trial_offsets_eye[trial_inx]:
+            continue
+        # Leave it out if we can't tell when the trial began in the MEG
+        if trial_onsets_meg[trial_inx] < 0:
+            continue
         # Store the trial number
-        fix.loc[i_fix, 'trial_number'] = trial_inx
+        trial_number[i_fix] = trial_inx
+        in_trial[i_fix] = True
         # Store the time in MEG samples
-        if not np.isnan(trial_inx):
-            trial_start_meg = trial_onsets_meg[trial_inx]
-            trial_start_eye = trial_onsets_eye[trial_inx]
-            t_diff = trial_start_eye - trial_start_meg
-            fix.loc[i_fix, 'start_meg'] = t_start_fix - t_diff
-            fix.loc[i_fix, 'end_meg'] = t_end_fix - t_diff
+        trial_start_meg = trial_onsets_meg[trial_inx]
+        trial_start_eye = trial_onsets_eye[trial_inx]
+        t_diff = trial_start_eye - trial_start_meg
+        start_meg[i_fix] = t_start_fix - t_diff
+        end_meg[i_fix] = t_end_fix - t_diff
 
     # Check whether the subject looks at the objects that are on the screen
-    fix['closest_loc'] = np.nan  # New column for the closest stim location
-    fix['closest_stim'] = np.nan  # Stimulus at the fixated location
-    fix['prev_stim'] = np.nan  # Stimulus at the last fixation
-    fix['dist_to_stim'] = np.nan  # Distance to the center of closest stim
-    fix['on_target'] = None
-    for i_fix in range(fix.shape[0]):
-        f = fix.loc[i_fix]
-        trial_number = f['trial_number']
-        if np.isnan(trial_number):
-            continue
-        trial_info = behav_data.loc[trial_number]
-        if np.isnan(trial_number):
-            continue
-        closest_loc, dist = _closest_stim(f['x_avg'], f['y_avg'])
-        fix.loc[i_fix, 'closest_loc'] = closest_loc
-
-        if closest_loc == 0:
-            closest_stim = trial_info['stim_left']
-        elif closest_loc == 1:
-            closest_stim = trial_info['stim_center']
-        elif closest_loc == 2:
-            closest_stim = trial_info['stim_right']
-        else:
-            raise Exception('The code should never get here')
-
-        fix.loc[i_fix, 'closest_stim'] = closest_stim
-        fix.loc[i_fix, 'dist_to_stim'] = dist
+    stim_cols = ['stim_left', 'stim_center', 'stim_right']
+    x_avg = fix['x_avg'].to_numpy(dtype=float)
+    y_avg = fix['y_avg'].to_numpy(dtype=float)
+    closest_loc = np.zeros(n_fix, dtype=int)  # Closest stim location
+    closest_stim = np.zeros(n_fix, dtype=int)  # Stimulus at the fixated loc
+    prev_stim = np.zeros(n_fix, dtype=int)  # Stimulus at the last fixation
+    has_prev = np.zeros(n_fix, dtype=bool)  # Is there a previous stimulus?
+    dist_to_stim = np.full(n_fix, np.nan)  # Distance to center of closest
+    on_target = np.zeros(n_fix, dtype=bool)  # Close enough to a stimulus?
+    for i_fix in np.nonzero(in_trial)[0]:
+        trial_info = behav_data.loc[trial_number[i_fix]]
+        loc, dist = _closest_stim(x_avg[i_fix], y_avg[i_fix], locs)
+        closest_loc[i_fix] = loc
+        closest_stim[i_fix] = trial_info[stim_cols[loc]]
+        dist_to_stim[i_fix] = dist
+        on_target[i_fix] = dist <= max_dist
 
         # Check which stimulus was in the previous fixation
         back_counter = 1
         while True:
-            prev_row = fix.loc[i_fix - back_counter]
-            if not prev_row['on_target']:
-                fix.loc[i_fix, 'prev_stim'] = np.nan
+            i_prev = i_fix - back_counter
+            if i_prev < 0 or not on_target[i_prev]:
                 break
-            elif prev_row['closest_stim'] != fix.loc[i_fix, 'closest_stim']:
-                fix.loc[i_fix, 'prev_stim'] = prev_row['closest_stim']
+            elif closest_stim[i_prev] != closest_stim[i_fix]:
+                prev_stim[i_fix] = closest_stim[i_prev]
+                has_prev[i_fix] = True
                 break
             elif back_counter > 10:  # More than X fixations on one target?
-                fix.loc[i_fix, 'prev_stim'] = np.nan
                 break
             else:
                 back_counter += 1
 
+    # Add the new columns, with <NA> for fixations outside of trials
+    schema = fixation_table.schema()
+    new_cols = {'trial_number': trial_number,
+                'start_meg': start_meg,
+                'end_meg': end_meg,
+                'closest_loc': closest_loc,
+                'closest_stim': closest_stim,
+                'on_target': on_target}
+    for col, values in new_cols.items():
+        fix[col] = fixation_table.masked(values, in_trial, schema[col])
+    fix['prev_stim'] = fixation_table.masked(prev_stim, has_prev,
+                                             schema['prev_stim'])
+    fix['dist_to_stim'] = dist_to_stim.astype(schema['dist_to_stim'])
+
     #  # How far away were the fixations from their closest target?
     # distances_deg = [dc.pix2deg(d) for d in distances]
     # plt.hist(distances_deg, bins=100,
@@ -156,23 +245,8 @@ def get_fixation_events(meg_events, eye_data, behav_data):
     # Which item was in the previous fixation?
 
     # Make a new object of MEG-timed events for each fixation
-    events_fix = np.zeros([0, 3], dtype=int)
-    for event_type in ['start_meg', 'end_meg']:
-        if event_type == 'start_meg':
-            trig = 'fix_on'
-        elif event_type == 'end_meg':
-            trig = 'fix_off'
-        else:
-            trig = 'ERROR'
-        evt_samp = np.array(fix[event_type])
-        evt_samp = evt_samp[~np.isnan(evt_samp)]
-        evt_samp = np.reshape(evt_samp, [-1, 1])
-        evt_samp = np.int64(evt_samp)
-        evt_dur = np.zeros(evt_samp.shape, dtype=int)
-        trig_val = expt_info['event_dict'][trig]
-        evt_trig = np.ones(evt_samp.shape, dtype=int) * trig_val
-        evt = np.hstack((evt_samp, evt_dur, evt_trig))
-        events_fix = np.vstack((events_fix, evt))
+    events_fix = make_events([(fix, 'start_meg', 'fix_on'),
+                              (fix, 'end_meg', 'fix_off')])
 
     return fix, events_fix
 
@@ -180,6 +254,10 @@ def get_fixation_events(meg_events, eye_data, behav_data):
 def demo():
     """ Demo the script
     """
+    import pandas as pd
+    import mne
+    import eyelink_parser
+    data_dir = config.data_dir()
     fnames = {'meg': '191104/yalitest.fif',
               'eye': '19110415.asc',
               'behav': '2019-11-04-1527.csv'}
@@ -0,0 +1,130 @@
+"""
+Column types for the table of fixations
+
+The fixation table from `eyelink_parser` / `fixation_events` stores times as
+int32, IDs as small nullable integers (missing values are <NA> instead of
+turning the whole column into floats), eye side and stimulus IDs as
+categoricals, and `on_target` as a nullable boolean. This takes several
+times less memory than float64/object columns, and groupby on the
+categorical columns is much faster.
+
+All the stimulus ID columns share the same categories (every image in
+`stimuli.yaml`), so tables from different subjects can be concatenated
+without losing the categorical types. The stimuli are only read (through
+`config.stim_info()`) when the types are first needed.
+"""
+
+import numpy as np
+import pandas as pd
+import config
+
+eye_dtype = pd.CategoricalDtype(['L', 'R'])
+STIM_COLS = ('closest_stim', 'prev_stim')  # Columns with stimulus IDs
+
+
+def stim_ids():
+    """ Every stimulus ID in `stimuli.yaml`, sorted
+    """
+    return sorted(s for stims in config.stim_info().values() for s in stims)
+
+
+def stim_dtype():
+    """ Categorical type of the stimulus ID columns
+    """
+    return pd.CategoricalDtype(stim_ids())
+
+
+def schema():
+    """ Type of each column of the fixation table
+    """
+    stim = stim_dtype()
+    return {'eye_side': eye_dtype,
+            'start': 'int32',  # Eyelink samples
+            'end': 'int32',
+            'dur': 'int32',
+            'x_avg': 'float32',
+            'y_avg': 'float32',
+            'pupil': 'int32',
+            'trial_number': 'Int16',  # Psychopy trial number
+            'start_meg': 'Int32',  # MEG samples
+            'end_meg': 'Int32',
+            'closest_loc': 'Int8',  # 0: left, 1: center, 2: right
+            'closest_stim': stim,
+            'prev_stim': stim,
+            'dist_to_stim': 'float32',
+            'on_target': 'boolean'}
+
+
+def compact(fix):
+    """ Convert a fixation table to the compact column types.
+    Columns that aren't in `schema()` are left alone.
+    """
+    fix = fix.copy()
+    for col, dtype in schema().items():
+        if col not in fix.columns:
+            continue
+        if col in STIM_COLS and not isinstance(fix[col].dtype,
+                                               pd.CategoricalDtype):
+            # Stim IDs may be read in as floats (when there are NaNs)
+            fix[col] = pd.array(fix[col], dtype='Int16').astype(dtype)
+        else:
+            fix[col] = fix[col].astype(dtype)
+    return fix
+
+
+def masked(values, valid, dtype):
+    """ Make a column of type `dtype` from a numpy array of `values`,
+    with <NA> wherever `valid` is False.
+    """
+    missing = ~np.asarray(valid, dtype=bool)
+    if isinstance(dtype, pd.CategoricalDtype):
+        codes = dtype.categories.get_indexer(values)
+        assert np.all(codes[~missing] >= 0), 'Unknown category'
+        codes[missing] = -1
+        return pd.Categorical.from_codes(codes, dtype=dtype)
+    elif dtype == 'boolean':
+        values = np.asarray(values, dtype=bool)
+        return pd.arrays.BooleanArray(values, missing)
+    else:  # Nullable integers, e.g. 'Int16'
+        values = np.asarray(values).astype(dtype.lower())
+        return pd.arrays.IntegerArray(values, missing)
+
+
+def expand(fix):
+    """ Convert a compact fixation table to plain numpy types: integer
+    columns with missing values become float64 with NaNs, categoricals
+    become their values, and `on_target` becomes an object column.
+    """
+    fix = fix.copy()
+    for col in fix.columns:
+        dtype = fix[col].dtype
+        if isinstance(dtype, pd.CategoricalDtype):
+            values = fix[col].astype(object)
+            if pd.api.types.is_numeric_dtype(dtype.categories):
+                values = values.astype(float)
+            fix[col] = values
+        elif isinstance(dtype, pd.BooleanDtype):
+            fix[col] = fix[col].astype(object).where(fix[col].notna(), None)
+        elif pd.api.types.is_extension_array_dtype(dtype):
+            fix[col] = fix[col].astype('float64')
+    return fix
+
+
+def concat(tables, keys=None):
+    """ Concatenate fixation tables (e.g. across subjects) without losing
+    the compact column types.
+
+    keys: Labels for each table (e.g. subject numbers), stored in a new
+          column called 'subject'
+    """
+    tables = [compact(t) for t in tables]
+    if keys is not None:
+        for t, k in zip(tables, keys):
+            t.insert(0, 'subject', np.int16(k))
+    return pd.concat(tables, ignore_index=True)
+
+
+def memory_mb(fix):
+    """ Memory used by a table, in MB
+    """
+    return fix.memory_usage(deep=True).sum() / 1e6
@@ -0,0 +1,233 @@
+"""
+Gaze density maps and scanpath transitions across the cohort
+
+`GazeMaps` adds up, for each condition:
+- density: Total fixation duration in each bin of the screen (ms)
+- counts: Number of fixations in each bin
+- transitions: Number of times the eyes went from one stimulus location
+  (0=left, 1=center, 2=right, from `closest_loc`) to the next, within a
+  trial. Rows are the location of the earlier fixation.
+
+The maps have a fixed size (the screen in bins of `bin_size` pixels), so
+the memory used doesn't grow with the number of subjects or fixations.
+Subjects are added one at a time with `add()`, each with a few calls to
+`np.bincount`, and maps made separately (e.g. in parallel processes) are
+combined with `merge()`.
+
+Example:
+    maps = gaze_maps.cohort(condition='closest_category')
+    maps.plot('human face')
+    print(maps.transition_probs('human face'))
+"""
+
+import numpy as np
+import config
+
+BIN_SIZE = 10  # Size of the bins of the density maps (pix)
+N_LOCS = 3  # Number of stimulus locations
+ALL = 'all'  # Condition name when the maps aren't split by condition
+
+
+class GazeMaps(object):
+    """ Fixation density maps and transition matrices, added up over
+    subjects
+
+    bin_size: Size of the bins of the density maps (pix)
+    screen_res: Size of the screen (pix), default from `dist_convert`
+    """
+
+    def __init__(self, bin_size=BIN_SIZE, screen_res=None):
+        if screen_res is None:
+            screen_res = config.dist_convert().screen_res
+        self.bin_size = bin_size
+        self.screen_res = tuple(screen_res)
+        self.shape = (int(np.ceil(screen_res[1] / bin_size)),  # y
+                      int(np.ceil(screen_res[0] / bin_size)))  # x
+        self.density = {}
+        self.counts = {}
+        self.transitions = {}
+        self.subjects = set()
+        self.n_fix = 0
+
+    def _maps(self, cond):
+        if cond not in self.density:
+            self.density[cond] = np.zeros(self.shape)
+            self.counts[cond] = np.zeros(self.shape, dtype=np.int64)
+            self.transitions[cond] = np.zeros([N_LOCS, N_LOCS],
+                                              dtype=np.int64)
+        return self.density[cond], self.counts[cond], self.transitions[cond]
+
+    def add(self, fix, subject=None, condition=None):
+        """ Add fixations to the maps
+
+        fix: Table of fixations (`d['fix_info']`, or rows from
+             `fixation_db.select()`), with x_avg, y_avg, dur, trial_number
+             and closest_loc. Fixations of several subjects can be added
+             at once if there's a `subject` column.
+        subject: Subject number (if there's no `subject` column)
+        condition: Column of `fix` to split the maps by, e.g.
+                   'closest_category' or 'prev_loc'. Fixations where it's
+                   missing are left out. Default: one set of maps.
+        """
+        import pandas as pd
+        if 'subject' in fix.columns:
+            subj = fix['subject'].to_numpy(dtype=np.int64)
+            self.subjects.update(np.unique(subj).tolist())
+        else:
+            subj = np.full(len(fix), -1 if subject is None else subject)
+            if subject is not None:
+                self.subjects.add(subject)
+        if condition is None:
+            codes = np.zeros(len(fix), dtype=np.int64)
+            conds = [ALL]
+        else:
+            codes, conds = pd.factorize(fix[condition])
+            conds = list(conds)
+        maps = [self._maps(c) for c in conds]
+
+        # Density maps: one bincount over (condition, y bin, x bin)
+        x = fix['x_avg'].to_numpy(dtype=float, na_value=np.nan)
+        y = fix['y_avg'].to_numpy(dtype=float, na_value=np.nan)
+        dur = fix['dur'].to_numpy(dtype=float, na_value=np.nan)
+        ok = (codes >= 0) & (x >= 0) & (x < self.screen_res[0]) \
+            & (y >= 0) & (y < self.screen_res[1]) & np.isfinite(dur)
+        n_bins = self.shape[0] * self.shape[1]
+        flat = codes[ok] * n_bins \
+            + (y[ok] // self.bin_size).astype(np.int64) * self.shape[1] \
+            + (x[ok] // self.bin_size).astype(np.int64)
+        size = len(conds) * n_bins
+        density = np.bincount(flat, weights=dur[ok], minlength=size)
+        counts = np.bincount(flat, minlength=size)
+        for i, (d, c, _) in enumerate(maps):
+            d += density[i * n_bins:(i + 1) * n_bins].reshape(self.shape)
+            c += counts[i * n_bins:(i + 1) * n_bins].reshape(self.shape)
+        self.n_fix += int(ok.sum())
+
+        # Transitions between consecutive fixations in the same trial. The
+        # transition counts for the condition of the later fixation.
+        trial = fix['trial_number'].to_numpy(dtype=float, na_value=np.nan)
+        loc = fix['closest_loc'].to_numpy(dtype=float, na_value=np.nan)
+        order = np.lexsort([fix['start'].to_numpy(), trial, subj])
+        trial, loc, subj = trial[order], loc[order], subj[order]
+        codes = codes[order]
+        pair = (subj[1:] == subj[:-1]) & (trial[1:] == trial[:-1]) \
+            & np.isfinite(loc[1:]) & np.isfinite(loc[:-1]) & (codes[1:] >= 0)
+        flat = codes[1:][pair] * N_LOCS ** 2 \
+            + loc[:-1][pair].astype(np.int64) * N_LOCS \
+            + loc[1:][pair].astype(np.int64)
+        trans = np.bincount(flat, minlength=len(conds) * N_LOCS ** 2)
+        for i, (_, _, t) in enumerate(maps):
+            t += trans[i * N_LOCS ** 2:(i + 1) * N_LOCS ** 2] \
+                .reshape(N_LOCS, N_LOCS)
+
+    def merge(self, other):
+        """ Add the maps from another GazeMaps (with the same bins)
+        """
+        assert other.shape == self.shape and \
+            other.bin_size == self.bin_size, 'The maps have different bins'
+        for cond in other.density:
+            d, c, t = self._maps(cond)
+            d += other.density[cond]
+            c += other.counts[cond]
+            t += other.transitions[cond]
+        self.subjects.update(other.subjects)
+        self.n_fix += other.n_fix
+        return self
+
+    def transition_probs(self, cond=ALL):
+        """ Probability of each next location, given the current one
+        """
+        t = self.transitions[cond].astype(float)
+        return t / np.maximum(t.sum(axis=1, keepdims=True), 1)
+
+    def save(self, fname):
+        """ Save the maps in a .npz file
+        """
+        arrays = {'bin_size': self.bin_size,
+                  'screen_res': self.screen_res,
+                  'subjects': sorted(self.subjects),
+                  'n_fix': self.n_fix,
+                  'conditions': np.array([str(c) for c in self.density])}
+        for i, cond in enumerate(self.density):
+            arrays[f'density_{i}'] = self.density[cond]
+            arrays[f'counts_{i}'] = self.counts[cond]
+            arrays[f'transitions_{i}'] = self.transitions[cond]
+        np.savez_compressed(fname, **arrays)
+
+    @classmethod
+    def load(cls, fname):
+        """ Read maps saved with `save()` (condition names become strings)
+        """
+        f = np.load(fname)
+        maps = cls(int(f['bin_size']), f['screen_res'])
+        maps.subjects = set(f['subjects'].tolist())
+        maps.n_fix = int(f['n_fix'])
+        for i, cond in enumerate(f['conditions']):
+            cond = str(cond)
+            maps.density[cond] = f[f'density_{i}']
+            maps.counts[cond] = f[f'counts_{i}']
+            maps.transitions[cond] = f[f'transitions_{i}']
+        return maps
+
+    def plot(self, cond=ALL, smooth=1.0, ax=None):
+        """ Plot the duration-weighted density map of one condition, with
+        the centers of the stimuli
+        """
+        import matplotlib.pyplot as plt
+        from scipy.ndimage import gaussian_filter
+        import fixation_events
+        if ax is None:
+            ax = plt.gca()
+        d = self.density[cond]
+        if smooth:
+            d = gaussian_filter(d, smooth)
+        extent = [0, self.shape[1] * self.bin_size,
+                  self.shape[0] * self.bin_size, 0]
+        ax.imshow(d / 1000, extent=extent, cmap='viridis')
+        ax.plot(*np.transpose(fixation_events.stim_locs()), '+r')
+        ax.set_xlim(0, self.screen_res[0])
+        ax.set_ylim(self.screen_res[1], 0)
+        ax.set_title(f'{cond} ({len(self.subjects)} subjects)')
+        return ax
+
+
+# Columns needed from the fixation database
+DB_COLUMNS = ['subject', 'x_avg', 'y_avg', 'dur', 'start', 'trial_number',
+              'closest_loc']
+
+
+def _subject_maps(n, condition, bin_size):
+    import fixation_db
+    cols = DB_COLUMNS + ([condition] if condition else [])
+    maps = GazeMaps(bin_size)
+    maps.add(fixation_db.select(columns=cols, subject=n),
+             condition=condition)
+    return maps
+
+
+def cohort(subjects=None, condition=None, bin_size=BIN_SIZE, n_jobs=1):
+    """ Gaze maps of the whole cohort, from the fixation database (see
+    `fixation_db.update()`), one subject at a time.
+
+    subjects: List of subject numbers (default: everyone in the database)
+    condition: Column to split the maps by (see `GazeMaps.add()`)
+    n_jobs: Number of worker processes
+    """
+    if subjects is None:
+        import fixation_db
+        subjects = fixation_db.query('SELECT DISTINCT subject '
+                                     'FROM fixations')['subject'].tolist()
+    maps = GazeMaps(bin_size)
+    if n_jobs == 1:
+        for n in subjects:
+            maps.merge(_subject_maps(n, condition, bin_size))
+    else:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        ctx = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(n_jobs, mp_context=ctx) as pool:
+            futures = [pool.submit(_subject_maps, n, condition, bin_size)
+                       for n in subjects]
+            for fut in futures:
+                maps.merge(fut.result())
+    return maps
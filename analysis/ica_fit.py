@@ -0,0 +1,161 @@
+"""
+Fit ICA for many subjects in parallel
+
+Fits are kept in `data/ica/fits/` along with the downsampled data they were
+computed from and a small JSON file describing them. If neither the raw data
+nor the artifact annotations have changed, the old fit is reused. If only the
+annotations have changed, the downsampled data are read back from the cache
+and ICA is fit again from scratch.
+
+These fits have no components marked as bad. Marking happens afterwards in
+`artifacts.identify_artifacts(n)`, which picks up the fit from here.
+
+Run `python ica_fit.py` to fit every subject in `subject_info.csv`.
+"""
+
+import os
+import json
+import time
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import mne
+import config
+import artifacts
+
+DOWNSAMPLE_FACTOR = 10
+
+
+def _annot_hash(annotations):
+    """ Hash the onsets, durations and descriptions of some annotations
+    """
+    h = hashlib.sha1()
+    h.update(np.round(annotations.onset, 6).tobytes())
+    h.update(np.round(annotations.duration, 6).tobytes())
+    h.update('\n'.join(annotations.description).encode())
+    return h.hexdigest()
+
+
+def _data_id(raw_fname, downsample_factor):
+    """ Identify the raw data file without reading it
+    """
+    st = os.stat(raw_fname)
+    return f'{os.path.basename(raw_fname)}:{st.st_size}:' \
+           f'{int(st.st_mtime)}:{downsample_factor}'
+
+
+def fit_raw(raw, subj_fname, raw_fname, downsample_factor=DOWNSAMPLE_FACTOR):
+    """ Fit ICA to one subject's data, reusing earlier fits when possible.
+
+    raw: mne.io.Raw with the artifact annotations already set
+    subj_fname: Subject name used for the files in `ica/fits/`
+    raw_fname: File that `raw` was read from
+
+    Returns the ICA, the downsampled raw data it was fit to, and a dict of
+    info about the fit.
+    """
+    fit_dir = f'{config.data_dir()}ica/fits/'
+    os.makedirs(fit_dir, exist_ok=True)
+    ica_fname = f'{fit_dir}{subj_fname}-ica.fif'
+    info_fname = f'{fit_dir}{subj_fname}-fit.json'
+    data_fname = f'{fit_dir}{subj_fname}-downsamp.npy'
+
+    data_id = _data_id(raw_fname, downsample_factor)
+    annot_hash = _annot_hash(raw.annotations)
+    if os.path.isfile(info_fname):
+        old_info = json.load(open(info_fname))
+    else:
+        old_info = {}
+    same_data = (old_info.get('data_id') == data_id)
+
+    # Downsample the data, or read it back in if that was already done
+    if same_data and os.path.isfile(data_fname):
+        d = np.load(data_fname)
+        raw_downsamp = artifacts.downsample(raw, downsample_factor, data=d)
+    else:
+        raw_downsamp = artifacts.downsample(raw, downsample_factor)
+        np.save(data_fname, raw_downsamp.get_data())
+
+    # Nothing has changed -- use the old fit
+    if same_data and old_info.get('annot_hash') == annot_hash \
+            and os.path.isfile(ica_fname):
+        print(f'{subj_fname}: Using the existing ICA fit')
+        ica = mne.preprocessing.read_ica(ica_fname)
+        return ica, raw_downsamp, old_info
+
+    t_start = time.time()
+    ica = artifacts.fit_ica(raw_downsamp)
+    fit_info = {'data_id': data_id,
+                'annot_hash': annot_hash,
+                'n_iter': getattr(ica, 'n_iter_', None),
+                'fit_time': time.time() - t_start}
+    msg = '{}: ICA fit in {:.1f} s, {} iterations'
+    print(msg.format(subj_fname, fit_info['fit_time'], fit_info['n_iter']))
+
+    ica.save(ica_fname)
+    json.dump(fit_info, open(info_fname, 'w'), indent=4)
+    return ica, raw_downsamp, fit_info
+
+
+def fit_subject(n, downsample_factor=DOWNSAMPLE_FACTOR):
+    """ Read in the data for subject `n` and fit ICA.
+    The artifact annotations must already exist.
+    Returns a dict of info about the fit.
+    """
+    data_dir = config.data_dir()
+    subject_info = config.subject_info()
+    subj_fname = str(subject_info['meg_dir'][n])
+    meg_fname = subject_info['meg_fname'][n]
+    raw_fname = f"{data_dir}raw/{subj_fname}/{meg_fname}"
+    raw = mne.io.read_raw_fif(raw_fname)
+    subj_fname = subj_fname.replace('/', '_')
+    annot_fname = f'{data_dir}annotations/{subj_fname}.csv'
+    raw.set_annotations(mne.read_annotations(annot_fname))
+    _, _, fit_info = fit_raw(raw, subj_fname, raw_fname, downsample_factor)
+    return {'n': n, **fit_info}
+
+
+def fit_cohort(subjects, n_jobs=None, blas_threads=1,
+               downsample_factor=DOWNSAMPLE_FACTOR):
+    """ Fit ICA for several subjects in a pool of processes.
+
+    subjects: List of subject numbers from `subject_info.csv`
+    n_jobs: Number of worker processes (default: fill up the cores)
+    blas_threads: Number of BLAS/OpenMP threads in each worker
+
+    Returns a list of dicts with info about each fit.
+    """
+    if n_jobs is None:
+        n_jobs = max(1, os.cpu_count() // blas_threads)
+    n_jobs = min(n_jobs, len(subjects))
+
+    # The thread limits have to be in the environment before the workers
+    # import numpy, so set them here and start fresh ('spawn') processes.
+    results = []
+    with config.thread_limit(blas_threads):
+        ctx = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(n_jobs, mp_context=ctx) as pool:
+            futures = {pool.submit(fit_subject, n, downsample_factor): n
+                       for n in subjects}
+            for fut in as_completed(futures):
+                try:
+                    results.append(fut.result())
+                except Exception as e:
+                    print(f'Subject {futures[fut]}: ICA failed ({e!r})')
+
+    results = sorted(results, key=lambda r: r['n'])
+    for r in results:
+        msg = 'Subject {}: {:.1f} s, {} iterations'
+        print(msg.format(r['n'], r['fit_time'], r['n_iter']))
+    return results
+
+
+def main():
+    """ Fit ICA for every subject
+    """
+    fit_cohort(list(config.subject_info().index))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,56 +2,53 @@
 Load the data for one participant
 """
 
-import json
-import socket
-import pandas as pd
-import mne
+import os
+import config
 import eyelink_parser
 import fixation_events
-# import os
+import profiling
 # import re
 
-expt_info = json.load(open('expt_info.json'))
-
-hostname = socket.gethostname().lower()
-if hostname.startswith('colles'):
-    data_dir = expt_info['data_dir'][hostname]
-else:
-    data_dir = expt_info['data_dir']['standard']
-
-subject_info = pd.read_csv(data_dir + 'subject_info.csv',
-                           engine='python', sep=',')
-
 
+@profiling.profiled('load_data')
 def load_data(n):
+    import pandas as pd
+    import mne
+    profiling.set_subject(n)
+    data_dir = config.data_dir()
+    subject_info = config.subject_info()
     subj_fname = str(subject_info['meg_dir'][n])
     meg_fname = subject_info['meg_fname'][n]
     # Read in the MEG data
-    raw = mne.io.read_raw_fif(f"{data_dir}raw/{subj_fname}/{meg_fname}")
+    with profiling.stage('load_data.read_fif'):
+        raw = mne.io.read_raw_fif(f"{data_dir}raw/{subj_fname}/{meg_fname}")
     print('Finding MEG events')
-    meg_events = mne.find_events(raw,  # Segment out the MEG events
-                                 stim_channel='STI101',
-                                 mask=0b00111111,  # Ignore Nata button trigs
-                                 shortest_event=1)
+    with profiling.stage('load_data.find_events'):
+        meg_events = mne.find_events(raw,  # Segment out the MEG events
+                                     stim_channel='STI101',
+                                     mask=0b00111111,  # Ignore Nata trigs
+                                     shortest_event=1)
 
     # Read in artifact definitions
     print('Loading artifact definitions')
     subj_fname = subj_fname.replace('/', '_')
-    annot_fname = f'{data_dir}annotations/{subj_fname}.csv'
-    annotations = mne.read_annotations(annot_fname)
-    raw.set_annotations(annotations)
-    ica_fname = f'{data_dir}ica/{subj_fname}-ica.fif'
-    ica = mne.preprocessing.read_ica(ica_fname)
+    with profiling.stage('load_data.read_annotations'):
+        annot_fname = f'{data_dir}annotations/{subj_fname}.csv'
+        annotations = mne.read_annotations(annot_fname)
+        raw.set_annotations(annotations)
+    with profiling.stage('load_data.read_ica'):
+        ica_fname = f'{data_dir}ica/{subj_fname}-ica.fif'
+        ica = mne.preprocessing.read_ica(ica_fname)
 
     # Read in the EyeTracker data
     print('Loading eye-tracker data')
-    eye_fname = f'{data_dir}eyelink/ascii/{subject_info["eyelink"][n]}.asc'
-    eye_data = eyelink_parser.EyelinkData(eye_fname)
+    eye_data = eyelink_parser.EyelinkData(config.eyelink_fname(n))
 
     # Load behavioral data
     print('Loading behavioral data')
-    behav_fname = f'{data_dir}logfiles/{subject_info["behav"][n]}.csv'
-    behav = pd.read_csv(behav_fname, sep=';')
+    with profiling.stage('load_data.read_behav'):
+        behav_fname = f'{data_dir}logfiles/{subject_info["behav"][n]}.csv'
+        behav = pd.read_csv(behav_fname, sep=';')
 
     # Get the fixation events
     print('Loading fixation events')
@@ -0,0 +1,196 @@
+"""
+Epoch-first preprocessing
+
+Instead of loading, filtering and cleaning the whole continuous recording,
+read only the windows around the events (plus enough padding for the
+filter), filter those, and then apply the ICA to the epochs as a single
+matrix product. Nearby epochs are read and filtered together, so the
+padding is shared between them. `iter_epochs()` yields the epochs one such
+batch at a time, for code that doesn't need to keep all of them in memory.
+"""
+
+import numpy as np
+import mne
+from mne.annotations import _annotations_starts_stops
+import profiling
+
+
+def _filter_pad(sfreq, l_freq, h_freq):
+    """ Number of samples of padding needed on each side of a window
+    so that the edges of the filter don't reach the data we keep.
+    """
+    h = mne.filter.create_filter(None, sfreq, l_freq, h_freq, verbose=False)
+    return int(np.ceil(len(h) / 2))
+
+
+def _group_windows(starts, stops, max_span):
+    """ Split sorted windows into groups that each span at most `max_span`
+    samples, so that each group can be read and filtered in one go.
+    Returns a list of arrays of indices into `starts`/`stops`.
+    """
+    if len(starts) == 0:
+        return []
+    groups = []
+    current = [0]
+    for i in range(1, len(starts)):
+        if stops[i] - starts[current[0]] > max_span:
+            groups.append(np.array(current))
+            current = []
+        current.append(i)
+    groups.append(np.array(current))
+    return groups
+
+
+def ica_operator(ica, ch_names):
+    """ Express `ica.apply()` as an affine transform of the data.
+
+    Returns (A, b, picks): Cleaned data = A @ data[picks] + b, where `picks`
+    are the indices of the ICA channels in `ch_names`. The other channels
+    are not changed by the ICA.
+    """
+    picks = np.array([ch_names.index(ch) for ch in ica.ch_names])
+    n_ch = len(picks)
+    n_comp = ica.n_components_
+    n_pca = ica.n_pca_components
+    if n_pca is None:
+        n_pca = ica.pca_components_.shape[0]
+    elif isinstance(n_pca, float):
+        n_pca = ica._check_n_pca_components(n_pca)
+
+    # Keep the good ICs, and any PCA components beyond the ICA
+    keep = np.ones(n_comp)
+    keep[list(ica.exclude)] = 0
+    t = np.eye(n_pca)
+    t[:n_comp, :n_comp] = ica.mixing_matrix_ @ \
+        (keep[:, None] * ica.unmixing_matrix_)
+
+    pca = ica.pca_components_[:n_pca]
+    proj = pca.T @ t @ pca  # Whitened data -> cleaned whitened data
+    w = ica.pre_whitener_.ravel()
+    a = w[:, None] * proj / w[None, :]
+    if ica.pca_mean_ is None:
+        b = np.zeros(n_ch)
+    else:
+        b = w * (ica.pca_mean_ - proj @ ica.pca_mean_)
+    return a, b, picks
+
+
+def apply_ica(data, ica, ch_names, operator=None):
+    """ Apply ICA to epoched data (epochs x channels x times) in place
+
+    operator: Output of `ica_operator()`, if it was already computed
+    """
+    a, b, picks = operator or ica_operator(ica, ch_names)
+    n_epochs, _, n_times = data.shape
+    x = data[:, picks, :].transpose(1, 0, 2).reshape(len(picks), -1)
+    x = a @ x + b[:, None]
+    data[:, picks, :] = x.reshape(len(picks), n_epochs, n_times) \
+                         .transpose(1, 0, 2)
+    return data
+
+
+def epoch_windows(raw, events, event_id, tmin, tmax,
+                  reject_by_annotation=True):
+    """ Find the stretch of data for each epoch, leaving out epochs that run
+    off the end of the data or overlap bad segments.
+
+    Returns (keep, starts, stops): indices into `events` of the epochs that
+    are kept (in order of time), and the first and last+1 sample of each.
+    """
+    sfreq = raw.info['sfreq']
+    keep = np.flatnonzero(events[:, 2] == event_id)
+    keep = keep[np.argsort(events[keep, 0], kind='stable')]
+    onset = int(np.round(tmin * sfreq))
+    n_times = int(np.round((tmax - tmin) * sfreq)) + 1
+    starts = events[keep, 0] - raw.first_samp + onset
+    stops = starts + n_times
+
+    good = (starts >= 0) & (stops <= raw.n_times)
+    if reject_by_annotation:
+        bad_starts, bad_stops = _annotations_starts_stops(raw, 'bad')
+        for b_start, b_stop in zip(bad_starts, bad_stops):
+            good &= (stops <= b_start) | (starts >= b_stop)
+    print(f'Dropped {np.sum(~good)} of {len(good)} epochs')
+    return keep[good], starts[good], stops[good]
+
+
+def iter_epochs(raw, starts, stops, l_freq=0.1, h_freq=40.0, ica=None,
+                max_span_sec=60.0, cache=False):
+    """ Read filtered, ICA-cleaned epochs one stretch of data at a time.
+
+    raw: mne.io.Raw that has *not* been preloaded
+    starts, stops: Samples of each epoch, sorted (from `epoch_windows()`)
+    Other arguments are as in `read_epochs()`.
+
+    Yields (inx, data): indices into `starts` of a batch of epochs, and
+    their data (epochs, channels, times)
+    """
+    sfreq = raw.info['sfreq']
+    picks_filt = mne.pick_types(raw.info, meg=True, eeg=True, exclude=[])
+    if cache:
+        import filtered_cache
+        raw_filt = filtered_cache.get(raw, l_freq, h_freq)
+        pad = 0
+    else:
+        pad = _filter_pad(sfreq, l_freq, h_freq)
+    if ica is not None:
+        operator = ica_operator(ica, raw.ch_names)
+    max_span = int(max_span_sec * sfreq)
+    for inx in _group_windows(starts, stops, max_span):
+        # Read and filter one stretch of data, with padding on both sides
+        seg_start = max(starts[inx[0]] - pad, 0)
+        seg_stop = min(stops[inx[-1]] + pad, raw.n_times)
+        if cache:
+            with profiling.stage('preproc.read_cached_segment'):
+                seg = raw_filt.get_data(start=seg_start, stop=seg_stop)
+        else:
+            with profiling.stage('preproc.read_segment'):
+                seg = raw.get_data(start=seg_start, stop=seg_stop)
+            with profiling.stage('preproc.filter_segment'):
+                seg = mne.filter.filter_data(seg, sfreq, l_freq, h_freq,
+                                             picks=picks_filt, verbose=False)
+        data = np.stack([seg[:, starts[i] - seg_start:stops[i] - seg_start]
+                         for i in inx])
+        if ica is not None:
+            with profiling.stage('preproc.apply_ica'):
+                apply_ica(data, ica, raw.ch_names, operator)
+        yield inx, data
+
+
+@profiling.profiled('preproc.read_epochs')
+def read_epochs(raw, events, event_id, tmin, tmax,
+                l_freq=0.1, h_freq=40.0, ica=None,
+                baseline=(None, 0), reject_by_annotation=True,
+                max_span_sec=60.0, metadata=None, cache=False):
+    """ Make filtered, ICA-cleaned epochs without loading the whole recording
+
+    raw: mne.io.Raw that has *not* been preloaded
+    events, event_id, tmin, tmax, baseline, reject_by_annotation:
+        As in mne.Epochs
+    l_freq, h_freq: Band-pass filter edges, as in raw.filter()
+    ica: ICA to apply to the epochs (or None)
+    max_span_sec: Longest stretch of data to read and filter at once
+    metadata: pd.DataFrame with one row per event (e.g. from
+              `fixation_events.make_events(..., metadata=True)`), kept
+              for the epochs that aren't dropped
+    cache: Read the filtered data from `filtered_cache` (filtering the
+           whole recording the first time), instead of filtering the
+           windows around the events
+
+    Returns an mne.EpochsArray.
+    """
+    keep, starts, stops = epoch_windows(raw, events, event_id, tmin, tmax,
+                                        reject_by_annotation)
+    events = events[keep]
+    if metadata is not None:
+        metadata = metadata.iloc[keep].reset_index(drop=True)
+    n_times = int(np.round((tmax - tmin) * raw.info['sfreq'])) + 1
+    data = np.empty([len(events), raw.info['nchan'], n_times])
+    for inx, batch in iter_epochs(raw, starts, stops, l_freq, h_freq, ica,
+                                  max_span_sec, cache):
+        data[inx] = batch
+
+    epochs = mne.EpochsArray(data, raw.info, events=events, tmin=tmin,
+                             event_id=event_id, baseline=baseline,
+                             metadata=metadata)
+    return epochs
@@ -0,0 +1,218 @@
+"""
+Measure how long each stage of the analysis takes
+
+Wrap a stage in `with profiling.stage('name'):`, or decorate a function with
+`@profiling.profiled('name')`. Nothing is recorded unless profiling has been
+turned on, either with `profiling.enable()` or by setting the environment
+variable `ANALYSIS_PROFILE=1` (`ANALYSIS_PROFILE=mem` also tracks memory).
+When it's off, a stage costs one attribute lookup and a function call.
+
+For each stage, this records the wall-clock time, CPU time, and (optionally)
+the peak memory allocated above what was in use when the stage started.
+Stages can be nested. Records are tagged with the current subject, so they
+can be summarized across subjects with `summary()` or saved with `save()`.
+
+Example:
+    import profiling
+    profiling.enable(memory=True)
+    for n in range(5):
+        load_data.load_data(n)
+    profiling.print_summary()
+    profiling.save('profile.json')
+"""
+
+import os
+import time
+import json
+import functools
+import contextlib
+import tracemalloc
+
+_state = {'enabled': False,
+          'memory': False,
+          'subject': None}
+_records = []  # One dict per stage that was run
+_stack = []  # Stages that are currently running
+
+
+def enable(memory=False):
+    """ Start recording stages.
+    memory: Also track peak memory use (this slows down the analysis)
+    """
+    _state['enabled'] = True
+    _state['memory'] = memory
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def disable():
+    """ Stop recording stages.
+    """
+    _state['enabled'] = False
+    if _state['memory'] and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _state['memory'] = False
+
+
+def enabled():
+    """ Whether stages are being recorded
+    """
+    return _state['enabled']
+
+
+def set_subject(n):
+    """ Tag the following records with subject number `n`
+    """
+    _state['subject'] = n
+
+
+def reset():
+    """ Throw away everything that has been recorded
+    """
+    _records.clear()
+
+
+def _reset_peak(current):
+    """ Start measuring the peak memory use again, from `current` bytes.
+    `tracemalloc.reset_peak()` needs Python 3.9. Before that, tracing is
+    restarted, which also forgets the memory already in use, so the open
+    stages are shifted to the new zero. Returns the new `current`.
+    """
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+        return current
+    tracemalloc.stop()
+    tracemalloc.start()
+    for st in _stack:
+        if st.mem_start is not None:
+            st.mem_start -= current
+            st.peak -= current
+    return 0
+
+
+class _Stage(object):
+    """ Context manager that records one run of a stage
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.mem_start = None
+        self.peak = 0
+        if _state['memory']:
+            current, peak = tracemalloc.get_traced_memory()
+            if _stack:  # Keep the parent's peak before resetting it
+                _stack[-1].peak = max(_stack[-1].peak, peak)
+            self.mem_start = _reset_peak(current)
+        _stack.append(self)
+        self.cpu_start = time.process_time()
+        self.wall_start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self.wall_start
+        cpu = time.process_time() - self.cpu_start
+        _stack.pop()
+        rec = {'subject': _state['subject'],
+               'stage': self.name,
+               'wall': wall,
+               'cpu': cpu}
+        if self.mem_start is not None:
+            _, peak = tracemalloc.get_traced_memory()
+            peak = max(peak, self.peak)
+            if _stack:
+                _stack[-1].peak = max(_stack[-1].peak, peak)
+            rec['peak_mb'] = (peak - self.mem_start) / 1e6
+        _records.append(rec)
+        return False
+
+
+_null_stage = contextlib.nullcontext()
+
+
+def stage(name):
+    """ Context manager for one named stage of the analysis
+    """
+    if not _state['enabled']:
+        return _null_stage
+    return _Stage(name)
+
+
+def profiled(name=None):
+    """ Decorator that records every call to a function as a stage.
+    name: Name of the stage (default: module.function)
+    """
+    def decorator(fun):
+        stage_name = name or f'{fun.__module__}.{fun.__name__}'
+
+        @functools.wraps(fun)
+        def wrapper(*args, **kwargs):
+            if not _state['enabled']:
+                return fun(*args, **kwargs)
+            with _Stage(stage_name):
+                return fun(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def records():
+    """ List of all the records (one dict per stage run)
+    """
+    return list(_records)
+
+
+def summary():
+    """ Summarize each stage across subjects.
+    Returns a dict: {stage: {'n': number of runs,
+                             'n_subjects': number of subjects,
+                             'wall_total', 'wall_mean', 'wall_max',
+                             'cpu_total', 'cpu_mean',
+                             'peak_mb_max' (if memory was tracked)}}
+    """
+    out = {}
+    for rec in _records:
+        s = out.setdefault(rec['stage'], {'n': 0,
+                                          'subjects': set(),
+                                          'wall_total': 0.0,
+                                          'wall_max': 0.0,
+                                          'cpu_total': 0.0})
+        s['n'] += 1
+        s['subjects'].add(rec['subject'])
+        s['wall_total'] += rec['wall']
+        s['wall_max'] = max(s['wall_max'], rec['wall'])
+        s['cpu_total'] += rec['cpu']
+        if 'peak_mb' in rec:
+            s['peak_mb_max'] = max(s.get('peak_mb_max', 0.0), rec['peak_mb'])
+    for s in out.values():
+        s['n_subjects'] = len(s.pop('subjects'))
+        s['wall_mean'] = s['wall_total'] / s['n']
+        s['cpu_mean'] = s['cpu_total'] / s['n']
+    return out
+
+
+def print_summary():
+    """ Print a table of the summary, slowest stages first
+    """
+    summ = summary()
+    print(f"{'Stage':40s} {'N':>5s} {'Wall (s)':>10s} "
+          f"{'CPU (s)':>10s} {'Peak (MB)':>10s}")
+    for name, s in sorted(summ.items(), key=lambda x: -x[1]['wall_total']):
+        peak = s.get('peak_mb_max')
+        peak = '' if peak is None else f'{peak:.1f}'
+        print(f"{name:40s} {s['n']:5d} {s['wall_total']:10.2f} "
+              f"{s['cpu_total']:10.2f} {peak:>10s}")
+
+
+def save(fname):
+    """ Save the records and the summary to a JSON file
+    """
+    report = {'records': _records,
+              'summary': summary()}
+    with open(fname, 'w') as f:
+        json.dump(report, f, indent=2, default=str)
+
+
+_env = os.environ.get('ANALYSIS_PROFILE', '').lower()
+if _env not in ('', '0'):
+    enable(memory=(_env == 'mem'))
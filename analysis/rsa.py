@@ -0,0 +1,290 @@
+"""
+Representational similarity analysis of fixation-locked responses
+
+1. For each subject, the fixation-locked response to each of the 48
+   stimuli (`closest_stim`) is averaged with `evoked_accum`, and a
+   representational dissimilarity matrix (RDM) is computed at every time
+   point. The distances between all pairs of stimuli at all time points
+   come from one batched matrix product (times x stimuli x stimuli).
+2. The stack of RDMs is saved in `data/rsa/` (float32 .npy, with a .json
+   file of info), keyed by the subject's input files and the settings, so
+   it's only remade when either changes.
+3. The neural RDMs are compared with model RDMs made from the categories in
+   `stimuli.yaml` (Spearman correlation over the pairs of stimuli, at each
+   time point). Subjects, and chunks of time points, run in parallel
+   processes that read the RDMs from the memory-mapped files.
+
+Stimuli that a subject never fixated are NaN in their RDMs, and the pairs
+with them are left out of the correlations.
+
+Example:
+    res = rsa.cohort([0, 1, 2], n_jobs=4)
+    X = res['r'][:, res['models'].index('category')]  # Subjects x times
+    stats = cluster_stats.permutation_test(X)
+"""
+
+import os
+import json
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from scipy.stats import rankdata
+import config
+import profiling
+import fixation_table
+
+METRIC = 'correlation'  # Distance between response patterns
+CHUNK_TIMES = 50  # Time points per parallel task in `correlate()`
+
+
+def _input_files(n):
+    """ Files that the RDMs of a subject are computed from
+    """
+    data_dir = config.data_dir()
+    info = config.subject_info()
+    meg_dir = str(info['meg_dir'][n])
+    subj_fname = meg_dir.replace('/', '_')
+    return [f'{data_dir}raw/{meg_dir}/{info["meg_fname"][n]}',
+            f'{data_dir}annotations/{subj_fname}.csv',
+            f'{data_dir}ica/{subj_fname}-ica.fif',
+            config.eyelink_fname(n),
+            f'{data_dir}logfiles/{info["behav"][n]}.csv']
+
+
+def _data_id(n, params):
+    """ Identify the input files and settings without reading the data
+    """
+    parts = []
+    for fname in _input_files(n):
+        st = os.stat(fname)
+        parts.append(f'{os.path.basename(fname)}:{st.st_size}:'
+                     f'{int(st.st_mtime)}')
+    parts.append(json.dumps(params, sort_keys=True))
+    return '|'.join(parts)
+
+
+def rdm_fname(n, params):
+    """ Where the RDMs of a subject are kept (without the extension)
+    """
+    key = hashlib.sha1(_data_id(n, params).encode()).hexdigest()[:12]
+    subj_fname = str(config.subject_info()['meg_dir'][n]).replace('/', '_')
+    return f'{config.data_dir()}rsa/{subj_fname}-{key}'
+
+
+def stimulus_patterns(d, tmin=-0.2, tmax=0.5, ch_type='grad', **kwargs):
+    """ Average fixation-locked response to each stimulus
+
+    d: Data from `load_data.load_data(n)`
+    ch_type: Channels to use ('grad', 'mag' or True for both)
+    Other keyword arguments are passed on to `evoked_accum.accumulate()`.
+
+    Returns (patterns, counts, times): array (stimuli, channels, times) in
+    the order of `fixation_table.stim_ids()` (NaN for stimuli that were
+    never fixated), the number of fixations on each stimulus, and the times
+    of the samples
+    """
+    import mne
+    import evoked_accum
+    acc = evoked_accum.accumulate(d, 'closest_stim', tmin, tmax, **kwargs)
+    stim_ids = fixation_table.stim_ids()
+    picks = mne.pick_types(acc.info, meg=ch_type, exclude='bads')
+    n_times = next(iter(acc.mean.values())).shape[1]
+    patterns = np.full([len(stim_ids), len(picks), n_times], np.nan)
+    counts = np.zeros(len(stim_ids), dtype=np.int64)
+    for i, stim in enumerate(stim_ids):
+        if stim in acc.n:
+            patterns[i] = acc.mean[stim][picks]
+            counts[i] = acc.n[stim]
+    times = tmin + np.arange(n_times) / acc.info['sfreq']
+    return patterns, counts, times
+
+
+def rdms(patterns, metric=METRIC):
+    """ Dissimilarity between the responses to each pair of stimuli, at
+    each time point
+
+    patterns: Array (stimuli, channels, times)
+    metric: 'correlation' (1 - Pearson r across channels) or 'euclidean'
+            Channels are first scaled to the same standard deviation, so
+            they count equally.
+
+    Returns an array (times, stimuli, stimuli)
+    """
+    x = patterns / np.nanstd(patterns, axis=(0, 2), keepdims=True)
+    x = x.transpose(2, 0, 1)  # Times x stimuli x channels
+    if metric == 'correlation':
+        x = x - x.mean(axis=2, keepdims=True)
+        x /= np.linalg.norm(x, axis=2, keepdims=True)
+        return 1 - x @ x.transpose(0, 2, 1)
+    elif metric == 'euclidean':
+        sq = np.sum(x ** 2, axis=2)
+        d2 = sq[:, :, None] + sq[:, None, :] \
+            - 2 * (x @ x.transpose(0, 2, 1))
+        return np.sqrt(np.maximum(d2, 0))
+    else:
+        raise ValueError(f'Unknown metric: {metric}')
+
+
+def _subject_rdms(n, params):
+    import load_data
+    d = load_data.load_data(n)
+    patterns, counts, times = stimulus_patterns(
+        d, params['tmin'], params['tmax'], params['ch_type'],
+        l_freq=params['l_freq'], h_freq=params['h_freq'])
+    del d
+    with profiling.stage('rsa.rdms'):
+        return rdms(patterns, params['metric']), counts, times
+
+
+def subject_rdms(n, tmin=-0.2, tmax=0.5, ch_type='grad', metric=METRIC,
+                 l_freq=0.1, h_freq=40.0):
+    """ RDMs of one subject, from the cache (computing them first if they
+    aren't there yet)
+
+    Returns the name of the cached file (without the extension). Read it
+    with `load_rdms()`.
+    """
+    params = {'tmin': tmin, 'tmax': tmax, 'ch_type': ch_type,
+              'metric': metric, 'l_freq': l_freq, 'h_freq': h_freq}
+    fname = rdm_fname(n, params)
+    if os.path.exists(f'{fname}.json'):
+        return fname
+    print(f'Computing the RDMs of subject {n}')
+    x, counts, times = _subject_rdms(n, params)
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    np.save(f'{fname}.npy', x.astype(np.float32))
+    info = {'data_id': _data_id(n, params),
+            'params': params,
+            'stim_ids': fixation_table.stim_ids(),
+            'counts': counts.tolist(),
+            'times': times.tolist()}
+    with open(f'{fname}.json', 'w') as f:  # Written last: cache complete
+        json.dump(info, f, indent=2)
+    return fname
+
+
+def load_rdms(fname, mmap_mode='r'):
+    """ Read RDMs saved by `subject_rdms()`
+
+    Returns (rdms, info): array (times, stimuli, stimuli), and a dict with
+    the settings, stim_ids, counts and times
+    """
+    with open(f'{fname}.json') as f:
+        info = json.load(f)
+    return np.load(f'{fname}.npy', mmap_mode=mmap_mode), info
+
+
+def model_rdms():
+    """ Model RDMs from the categories in `stimuli.yaml`, in the order of
+    `fixation_table.stim_ids()`
+        category: 0 for pairs in the same category, 1 otherwise
+        <category>: That category against the others. 0 for pairs in the
+                    category, 1 for pairs with one stimulus in it, and NaN
+                    for pairs with neither (left out of the correlation).
+    """
+    stim_info = config.stim_info()
+    cats = {s: cat for cat, stims in stim_info.items() for s in stims}
+    cat = np.array([cats[s] for s in fixation_table.stim_ids()])
+    models = {'category': (cat[:, None] != cat[None, :]).astype(float)}
+    for name in stim_info:
+        inside = cat == name
+        m = (inside[:, None] != inside[None, :]).astype(float)
+        m[~inside[:, None] & ~inside[None, :]] = np.nan
+        models[name] = m
+    return models
+
+
+def _correlate_chunk(fname, t_start, t_stop, models):
+    """ Spearman correlation of the RDMs at some time points with each model
+
+    models: Array (models, stimuli, stimuli)
+    Returns an array (models, times)
+    """
+    x, _ = load_rdms(fname)
+    x = np.asarray(x[t_start:t_stop], dtype=float)
+    lower = np.tril_indices(x.shape[1], -1)
+    x = x[:, lower[0], lower[1]]  # Times x pairs
+    models = models[:, lower[0], lower[1]]  # Models x pairs
+    r = np.full([len(models), x.shape[0]], np.nan)
+    for i, m in enumerate(models):
+        # Pairs with missing stimuli are the same at every time point
+        ok = np.isfinite(m) & np.all(np.isfinite(x), axis=0)
+        if ok.sum() < 3:
+            continue
+        rx = rankdata(x[:, ok], axis=1)
+        rx -= rx.mean(axis=1, keepdims=True)
+        rm = rankdata(m[ok])
+        rm -= rm.mean()
+        r[i] = (rx @ rm) / (np.linalg.norm(rx, axis=1) * np.linalg.norm(rm))
+    return r
+
+
+def correlate(fnames, models=None, n_jobs=1, chunk_times=CHUNK_TIMES,
+              blas_threads=1):
+    """ Correlate the cached RDMs of each subject with the model RDMs
+
+    fnames: Files from `subject_rdms()`
+    models: Dict of model RDMs (default: `model_rdms()`)
+    n_jobs: Number of worker processes, each working on a chunk of time
+            points of one subject
+
+    Returns an array (subjects, models, times)
+    """
+    if models is None:
+        models = model_rdms()
+    models = np.stack(list(models.values()))
+    tasks = []  # (subject, file, first time point, last + 1)
+    for i, fname in enumerate(fnames):
+        n_times = len(load_rdms(fname)[1]['times'])
+        for t_start in range(0, n_times, chunk_times):
+            t_stop = min(t_start + chunk_times, n_times)
+            tasks.append((i, fname, t_start, t_stop))
+    args = [[t[k] for t in tasks] for k in (1, 2, 3)]
+    args.append([models] * len(tasks))
+    if n_jobs == 1:
+        r = list(map(_correlate_chunk, *args))
+    else:
+        with config.thread_limit(blas_threads):
+            ctx = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(n_jobs, mp_context=ctx) as pool:
+                r = list(pool.map(_correlate_chunk, *args))
+    out = [np.concatenate([r_t for t, r_t in zip(tasks, r) if t[0] == i],
+                          axis=1)
+           for i in range(len(fnames))]
+    return np.stack(out)
+
+
+@profiling.profiled('rsa.cohort')
+def cohort(subjects, models=None, n_jobs=1, blas_threads=1, **kwargs):
+    """ RSA of the whole cohort
+
+    subjects: List of subject numbers
+    models: Dict of model RDMs (default: `model_rdms()`)
+    n_jobs: Number of worker processes. Subjects whose RDMs aren't cached
+            yet are computed in parallel, one subject per process, so each
+            one needs enough memory to read a subject's data.
+    Other keyword arguments are passed on to `subject_rdms()`.
+
+    Returns a dict:
+        r: Spearman correlation with each model (subjects, models, times)
+        models: Names of the models
+        times: Times of the samples (s)
+        subjects: Subject numbers
+    """
+    if models is None:
+        models = model_rdms()
+    if n_jobs == 1:
+        fnames = [subject_rdms(n, **kwargs) for n in subjects]
+    else:
+        with config.thread_limit(blas_threads):
+            ctx = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(n_jobs, mp_context=ctx) as pool:
+                futures = [pool.submit(subject_rdms, n, **kwargs)
+                           for n in subjects]
+                fnames = [fut.result() for fut in futures]
+    r = correlate(fnames, models, n_jobs, blas_threads=blas_threads)
+    return {'r': r,
+            'models': list(models),
+            'times': np.array(load_rdms(fnames[0])[1]['times']),
+            'subjects': list(subjects)}
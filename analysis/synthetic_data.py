@@ -0,0 +1,403 @@
+"""
+Make synthetic data for fake subjects
+
+This writes files with the same layout and formats as the real data (see
+README.md), so the analysis can be run and benchmarked without the real
+recordings:
+- subject_info.csv
+- raw/<meg_dir>/<meg_fname>: MEG data with triggers on STI101
+- eyelink/ascii/<eyelink>.asc: Eye-tracker samples, fixations, saccades,
+  blinks, and trigger messages
+- logfiles/<behav>.csv: Behavioral logfile
+- annotations/<meg_dir>.csv: Artifact annotations
+- ica/<meg_dir>-ica.fif: ICA fit to the MEG data
+
+The Eyelink clock can run slightly faster or slower than the MEG clock
+(`drift_ppm`), like it does in the real recordings. The MEG can miss a
+few triggers (`n_dropped`), and the Eyelink a few trial onsets
+(`n_dropped_eye`). `check_trial_numbers()` makes a subject with both and
+checks that every fixation is still put in the right trial.
+
+Example:
+    import synthetic_data
+    synthetic_data.make_cohort('/tmp/synth/', n_subjects=2, n_trials=50)
+"""
+
+import os
+import numpy as np
+import pandas as pd
+import mne
+import config
+
+_here = os.path.dirname(os.path.abspath(__file__))
+MEG_SFREQ = 1000.0  # The analysis assumes MEG and Eyelink have the same rate
+
+
+def _triggers():
+    """ Trigger values sent by the experiment (the fixation triggers are
+    only made in the analysis)
+    """
+    return {k: v for k, v in config.expt_info()['event_dict'].items()
+            if k not in ('fix_on', 'fix_off')}
+
+
+def _stim_locs():
+    """ Centers of the three stimuli in Eyelink coordinates
+    """
+    dc = config.dist_convert()
+    stim_dist = int(dc.deg2pix(config.expt_info()['stim_dist_deg']))
+    locs = [(-stim_dist, 0), (0, 0), (stim_dist, 0)]
+    return np.array([dc.origin_psychopy2eyelink(pos) for pos in locs])
+
+
+def make_trials(n_trials, rng):
+    """ Make a list of trials like the ones in exp-scripts/main.py
+    """
+    stim_info = config.stim_info()
+    stim_ids = np.array([s for stims in stim_info.values() for s in stims])
+    with open(os.path.join(_here, '../exp-scripts/probes.txt')) as f:
+        probe_words = [w.strip() for w in f.readlines() if w.strip()]
+    trials = []
+    for _ in range(n_trials):
+        stim_left, stim_center, stim_right = rng.choice(stim_ids, 3,
+                                                        replace=False)
+        if rng.random() < 0.5:
+            probe_word = rng.choice(probe_words)
+        else:
+            probe_word = None
+        trials.append({'stim_left': stim_left,
+                       'stim_center': stim_center,
+                       'stim_right': stim_right,
+                       'probe_word': probe_word,
+                       'fix_dur': rng.uniform(0.5, 1.0)})
+    return trials
+
+
+def simulate_gaze(trials, rng, t_start=1000000):
+    """ Simulate the eye movements and triggers for a session.
+
+    Gaze stays on the fixation point until shortly after stimulus onset,
+    then jumps between the three stimuli until they disappear, and then
+    goes back to the center. Blinks happen now and then between trials.
+
+    Returns (events, triggers, t_end)
+    events: List of (type, start, end, x_start, y_start, x_end, y_end),
+            where type is 'fix', 'sacc' or 'blink'. Times in Eyelink ms.
+    triggers: List of (time, trigger value)
+    """
+    trig = _triggers()
+    stim_dur = config.expt_info()['stim_dur']
+    locs = _stim_locs()
+    center = locs[1]
+    events = []
+    triggers = []
+
+    def jitter(pos, sd=12.0):
+        return pos + rng.normal(0, sd, 2)
+
+    def saccade(t, pos_from, pos_to):
+        dur = int(rng.integers(25, 50))
+        events.append(('sacc', t, t + dur, *pos_from, *pos_to))
+        return t + dur + 1
+
+    def fixate(t, pos, dur):
+        events.append(('fix', t, t + dur, *pos, *pos))
+        return t + dur + 1
+
+    # Fixate the center before the first trial
+    pos = jitter(center)
+    t = fixate(t_start, pos, 1000)
+
+    for trial in trials:
+        # Fixation dot
+        new_pos = jitter(center)
+        t = saccade(t, pos, new_pos)  # Small corrective saccade
+        pos = new_pos
+        triggers.append((t, trig['fixation']))
+        t_stim = t + 200 + int(trial['fix_dur'] * 1000) + \
+            int(rng.integers(0, 50))
+        triggers.append((t_stim, trig['stimuli']))
+        t = fixate(t, pos, t_stim - t + int(rng.integers(150, 300)))
+
+        # Look around at the stimuli
+        t_stim_end = t_stim + int(stim_dur * 1000)
+        i_loc = 1
+        while t < t_stim_end:
+            i_loc = rng.choice([i for i in range(3) if i != i_loc])
+            new_pos = jitter(locs[i_loc], sd=25.0)
+            t = saccade(t, pos, new_pos)
+            pos = new_pos
+            t = fixate(t, pos, int(rng.integers(180, 500)))
+
+        # Back to the center for the probe and ITI
+        new_pos = jitter(center)
+        t = saccade(t, pos, new_pos)
+        pos = new_pos
+        t_end = max(t, t_stim_end) + 200
+        if trial['probe_word'] is not None:
+            triggers.append((t_stim_end, trig['probe']))
+            rt = int(rng.integers(400, 1500))
+            triggers.append((t_stim_end + rt, trig['response']))
+            t_end = max(t_end, t_stim_end + rt + 200)
+        if rng.random() < 0.2:  # Blink during the ITI
+            t_blink = t + int(rng.integers(20, 100))
+            t = fixate(t, pos, t_blink - t)
+            dur = int(rng.integers(80, 200))
+            events.append(('blink', t_blink, t_blink + dur, *pos, *pos))
+            t = t_blink + dur + 1
+            t_end = max(t_end, t + 50)
+        t = fixate(t, pos, t_end - t)
+
+    return events, triggers, t
+
+
+def _gaze_samples(events, t_first, t_last, rng):
+    """ Make gaze samples (x, y, pupil) at every ms from the list of events
+    """
+    n = t_last - t_first + 1
+    x = np.full(n, np.nan)
+    y = np.full(n, np.nan)
+    for typ, start, end, x0, y0, x1, y1 in events:
+        i0 = start - t_first
+        i1 = end - t_first + 1
+        if typ == 'fix':
+            x[i0:i1] = x0
+            y[i0:i1] = y0
+        elif typ == 'sacc':
+            frac = np.linspace(0, 1, i1 - i0)
+            x[i0:i1] = x0 + frac * (x1 - x0)
+            y[i0:i1] = y0 + frac * (y1 - y0)
+    missing = np.isnan(x)
+    x += rng.normal(0, 1.5, n)
+    y += rng.normal(0, 1.5, n)
+    pupil = 1000 + rng.normal(0, 20, n).cumsum() / 50
+    pupil[missing] = 0
+    return x, y, pupil, missing
+
+
+def write_asc(fname, events, triggers, rng, samples=True):
+    """ Write an Eyelink ASCII file like the ones from `edf2asc`
+    """
+    dc = config.dist_convert()
+    t_first = events[0][1]
+    t_last = events[-1][2]
+    lines = {}  # Event lines at each time point
+
+    def add(t, line):
+        lines.setdefault(t, []).append(line)
+
+    for typ, start, end, x0, y0, x1, y1 in events:
+        dur = end - start + 1
+        if typ == 'fix':
+            pupil_avg = int(rng.integers(900, 1100))
+            add(start, f'SFIX R   {start}\n')
+            add(end, f'EFIX R   {start}\t{end}\t{dur}\t'
+                     f'  {x0:.1f}\t  {y0:.1f}\t   {pupil_avg}\n')
+        elif typ == 'sacc':
+            ampl = dc.pix2deg(np.hypot(x1 - x0, y1 - y0))
+            pv = int(100 + 40 * ampl)
+            add(start, f'SSACC R  {start}\n')
+            add(end, f'ESACC R  {start}\t{end}\t{dur}\t'
+                     f'  {x0:.1f}\t  {y0:.1f}\t  {x1:.1f}\t  {y1:.1f}\t'
+                     f'{ampl:.2f}\t  {pv}\n')
+        elif typ == 'blink':
+            add(start, f'SBLINK R {start}\n')
+            add(end, f'EBLINK R {start}\t{end}\t{dur}\n')
+    for t, value in triggers:
+        add(t, f'MSG\t{t} Trigger {value}\n')
+
+    with open(fname, 'w') as f:
+        f.write('** CONVERTED FROM synthetic.edf using edfapi\n')
+        f.write('** SOURCE: synthetic_data.py\n')
+        f.write(f'MSG\t{t_first} DISPLAY_COORDS 0 0 '
+                f'{dc.screen_res[0] - 1} {dc.screen_res[1] - 1}\n')
+        f.write(f'START\t{t_first} \tRIGHT\tSAMPLES\tEVENTS\n')
+        f.write(f'MSG\t{t_first} SYNCTIME\n')
+        if samples:
+            x, y, pupil, missing = _gaze_samples(events, t_first, t_last, rng)
+        for i, t in enumerate(range(t_first, t_last + 1)):
+            if samples:
+                if missing[i]:
+                    f.write(f'{t}\t   .\t   .\t    0.0\t...\n')
+                else:
+                    f.write(f'{t}\t {x[i]:7.1f}\t {y[i]:7.1f}\t'
+                            f' {pupil[i]:7.1f}\t...\n')
+            if t in lines:
+                f.write(''.join(lines[t]))
+        f.write(f'END\t{t_last} \tSAMPLES\tEVENTS\tRES\t 38.00\t 34.00\n')
+
+
+def write_behav(fname, trials, rng):
+    """ Write a behavioral logfile like `TrialHandler.saveAsWideText`
+    """
+    behav = pd.DataFrame(trials)
+    behav['ran'] = 1
+    behav['order'] = np.arange(len(trials))
+    behav['stim_onset'] = np.cumsum(rng.uniform(3.0, 4.5, len(trials)))
+    has_probe = behav['probe_word'].notna()
+    behav['resp'] = np.where(has_probe, rng.choice(['7', '8'], len(trials)),
+                             '')
+    behav['rt'] = np.where(has_probe, rng.uniform(0.4, 1.5, len(trials)),
+                           np.nan)
+    behav.to_csv(fname, sep=';', index=False)
+
+
+def make_raw(events, triggers, rng, n_channels=8, drift_ppm=20.0,
+             first_samp=20000):
+    """ Make MEG data with triggers on STI101 and fixation-related responses
+
+    drift_ppm: How much faster the MEG clock runs than the Eyelink clock,
+               in parts per million
+    """
+    t0_eye = triggers[0][0] - 5000  # Start recording 5 s before 1st trigger
+    ratio = (MEG_SFREQ / 1000.0) * (1 + drift_ppm * 1e-6)
+
+    def eye2meg(t):
+        return np.round((np.asarray(t) - t0_eye) * ratio).astype(int)
+
+    n_times = int(eye2meg(events[-1][2])) + 5000
+    ch_names = [f'MEG{i + 1:04d}' for i in range(n_channels)] + ['STI101']
+    ch_types = ['mag'] * n_channels + ['stim']
+    info = mne.create_info(ch_names, MEG_SFREQ, ch_types)
+
+    # Background noise with some alpha
+    t = np.arange(n_times) / MEG_SFREQ
+    data = np.empty([n_channels + 1, n_times])
+    alpha = np.sin(2 * np.pi * 10 * t)
+    for i_chan in range(n_channels):
+        data[i_chan] = rng.normal(0, 1, n_times) + \
+            rng.uniform(0.5, 2) * alpha
+    # Add a response after each fixation starts
+    fix_on = eye2meg([e[1] for e in events if e[0] == 'fix'])
+    fix_on = fix_on[(fix_on >= 0) & (fix_on < n_times)]
+    impulses = np.zeros(n_times)
+    impulses[fix_on] = 1
+    kernel_t = np.arange(0, 0.3, 1 / MEG_SFREQ)
+    kernel = np.exp(-((kernel_t - 0.08) ** 2) / (2 * 0.02 ** 2))
+    response = np.convolve(impulses, kernel)[:n_times]
+    data[:n_channels] += rng.normal(0, 2, [n_channels, 1]) * response
+    data[:n_channels] *= 1e-13  # Tesla
+
+    # Triggers
+    stim = np.zeros(n_times)
+    for t_trig, value in triggers:
+        s = int(eye2meg(t_trig))
+        stim[s:s + 5] = value
+    data[-1] = stim
+
+    raw = mne.io.RawArray(data, info, first_samp=first_samp, verbose=False)
+    return raw
+
+
+def make_subject(data_dir, n=0, n_trials=100, drift_ppm=20.0,
+                 n_channels=8, samples=True, fit_ica=True, seed=None,
+                 n_dropped=0, n_dropped_eye=0, truth=None):
+    """ Write all the files for one synthetic subject.
+    n_dropped: Number of random triggers that are missing from the MEG data
+    n_dropped_eye: Number of random trial-onset triggers that are missing
+                   from the Eyelink data (never the same ones as the MEG)
+    truth: If a dict is given, the Eyelink times of all the trial onsets
+           are put in it ('onsets'), including the dropped ones
+    Returns a dict with the row for this subject in `subject_info.csv`.
+    """
+    rng = np.random.default_rng(n if seed is None else seed)
+    meg_dir = f'synth{n:02d}'
+    info_row = {'meg_dir': meg_dir,
+                'meg_fname': 'synthetic_raw.fif',
+                'eyelink': f'synth{n:02d}',
+                'behav': f'synth{n:02d}'}
+    for sub_dir in [f'raw/{meg_dir}', 'eyelink/ascii', 'logfiles',
+                    'annotations', 'ica']:
+        os.makedirs(f'{data_dir}{sub_dir}', exist_ok=True)
+
+    trials = make_trials(n_trials, rng)
+    events, triggers, _ = simulate_gaze(trials, rng)
+    onset_value = _triggers()['stimuli']
+    if truth is not None:
+        truth['onsets'] = np.array([t for t, value in triggers
+                                    if value == onset_value])
+
+    eye_triggers = triggers
+    drop_eye = set()
+    if n_dropped_eye:
+        onsets = [i for i, (_, value) in enumerate(triggers)
+                  if value == onset_value]
+        drop_eye = set(rng.choice(onsets, n_dropped_eye, replace=False))
+        eye_triggers = [t for i, t in enumerate(triggers)
+                        if i not in drop_eye]
+    write_asc(f'{data_dir}eyelink/ascii/{info_row["eyelink"]}.asc',
+              events, eye_triggers, rng, samples=samples)
+    write_behav(f'{data_dir}logfiles/{info_row["behav"]}.csv', trials, rng)
+
+    meg_triggers = triggers
+    if n_dropped:
+        keep = [i for i in range(len(triggers)) if i not in drop_eye]
+        drop = set(rng.choice(keep, n_dropped, replace=False))
+        meg_triggers = [t for i, t in enumerate(triggers) if i not in drop]
+    raw = make_raw(events, meg_triggers, rng, n_channels=n_channels,
+                   drift_ppm=drift_ppm)
+    raw.save(f'{data_dir}raw/{meg_dir}/{info_row["meg_fname"]}',
+             overwrite=True, verbose=False)
+
+    # One manually-marked artifact in the middle of the recording
+    annot = mne.Annotations(onset=[raw.times[-1] / 2],
+                            duration=[1.0],
+                            description=['BAD_manual'])
+    raw.set_annotations(annot)
+    raw.annotations.save(f'{data_dir}annotations/{meg_dir}.csv')
+
+    if fit_ica:
+        ica = mne.preprocessing.ICA(n_components=min(4, n_channels),
+                                    method='infomax',
+                                    random_state=0,
+                                    max_iter=200,
+                                    verbose=False)
+        ica.fit(raw, picks='mag', decim=10)
+        ica.save(f'{data_dir}ica/{meg_dir}-ica.fif')
+
+    return info_row
+
+
+def make_cohort(data_dir, n_subjects=1, n_trials=100, **kwargs):
+    """ Make synthetic data for several subjects, and `subject_info.csv`.
+    data_dir: Where to put the data (must end with '/')
+    n_trials: Number of trials per subject, or a list with one per subject
+    Other arguments are passed on to `make_subject()`.
+    """
+    if np.isscalar(n_trials):
+        n_trials = [n_trials] * n_subjects
+    rows = [make_subject(data_dir, n, n_trials=n_trials[n], **kwargs)
+            for n in range(n_subjects)]
+    subject_info = pd.DataFrame(rows)
+    subject_info.to_csv(f'{data_dir}subject_info.csv', index=False)
+    return subject_info
+
+
+def check_trial_numbers(data_dir, n_trials=60, n_dropped=3, n_dropped_eye=3,
+                        seed=0):
+    """ Make a subject whose MEG and Eyelink data both miss a few triggers,
+    and check that `get_fixation_events` puts every fixation in the trial
+    it really happened in.
+    Returns the number of fixations put in the wrong trial.
+    """
+    import eyelink_parser
+    import fixation_events
+    truth = {}
+    row = make_subject(data_dir, n_trials=n_trials, fit_ica=False,
+                       seed=seed, n_dropped=n_dropped,
+                       n_dropped_eye=n_dropped_eye, truth=truth)
+    raw = mne.io.read_raw_fif(
+        f'{data_dir}raw/{row["meg_dir"]}/{row["meg_fname"]}', verbose=False)
+    meg_events = mne.find_events(raw, stim_channel='STI101',
+                                 shortest_event=1, verbose=False)
+    eye_data = eyelink_parser.EyelinkData(
+        f'{data_dir}eyelink/ascii/{row["eyelink"]}.asc')
+    behav = pd.read_csv(f'{data_dir}logfiles/{row["behav"]}.csv', sep=';')
+    fix, _ = fixation_events.get_fixation_events(meg_events, eye_data, behav)
+    in_trial = fix['trial_number'].notna().to_numpy()
+    found = fix['trial_number'].to_numpy()[in_trial].astype(int)
+    start = fix['start'].to_numpy(dtype=np.int64)[in_trial]
+    true = np.searchsorted(truth['onsets'], start) - 1
+    n_wrong = int(np.sum(found != true))
+    print(f'{n_wrong} of {len(found)} fixations in the wrong trial')
+    return n_wrong
@@ -0,0 +1,171 @@
+"""
+Match the triggers recorded by the Eyelink to the triggers in the MEG data
+
+Each trigger is sent to both systems, but now and then one of them misses
+a trigger (or picks up an extra one), so the two sequences can't just be
+lined up by their order. Instead, the triggers are matched by their timing:
+the two clocks are offset by a (slowly drifting) constant, so matching
+triggers have the same value and the same intervals between them.
+
+1. The starting offset is found by trying every offset between a trigger
+   near the start of one sequence and a trigger with the same value near
+   the start of the other, and keeping the one that lines up the most
+   triggers in the first stretch of the recording.
+2. Then the sequences are walked through in order. Each Eyelink trigger is
+   matched to the MEG trigger with the same value that is closest to where
+   the current offset puts it (a binary search), and the offset is updated
+   from every match, so it follows the drift between the clocks.
+
+This takes O(n log n) time, so long sessions are matched in milliseconds.
+
+`merged_times()` then lists every trigger of one kind (e.g. trial onsets)
+that either system recorded, so a trigger missing from one side doesn't
+shift the count of the ones after it.
+Times are in samples of each system (both sampled at 1000 Hz here).
+"""
+
+import numpy as np
+
+TOLERANCE = 20  # Largest timing difference between matching triggers
+N_START = 20  # Triggers near the start used to find the starting offset
+N_CHECK = 100  # Triggers used to check each starting offset
+
+
+def _start_offset(t_a, v_a, t_b, v_b, tol, max_skip):
+    """ Offset (t_b - t_a) that lines up the most triggers near the start
+    """
+    n_check = min(N_CHECK, len(t_a))
+    cand_a = np.arange(min(N_START, len(t_a)))
+    cand_b = np.arange(min(N_START + max_skip, len(t_b)))
+    i, j = np.meshgrid(cand_a, cand_b, indexing='ij')
+    same = v_a[i] == v_b[j]
+    offsets = np.unique(t_b[j[same]] - t_a[i[same]])
+    assert len(offsets) > 0, 'No triggers in common'
+    # For each candidate offset, count the triggers with a match in time
+    shifted = t_a[None, :n_check] + offsets[:, None]
+    inx = np.clip(np.searchsorted(t_b, shifted), 1, len(t_b) - 1)
+    err = np.minimum(np.abs(t_b[inx - 1] - shifted),
+                     np.abs(t_b[inx] - shifted))
+    n_match = np.sum(err <= tol, axis=1)
+    return offsets[np.argmax(n_match)]
+
+
+def match_triggers(t_a, v_a, t_b, v_b, tol=TOLERANCE, max_skip=10):
+    """ Match two sequences of triggers by their values and timing.
+
+    t_a, v_a: Times and values of the triggers in one system (sorted by time)
+    t_b, v_b: Times and values of the triggers in the other system
+    tol: Largest timing difference between matching triggers, after taking
+         out the offset between the clocks
+    max_skip: Most triggers that one sequence may be missing at the start
+
+    Returns a dict:
+        pairs: (matches, 2) array of indices into a and b
+        unmatched_a, unmatched_b: Indices of triggers without a match
+        offset: Offset between the clocks at each match (t_b - t_a)
+        drift: Ratio of the clock speeds (b / a), from a line fit
+    """
+    t_a = np.asarray(t_a, dtype=np.int64)
+    t_b = np.asarray(t_b, dtype=np.int64)
+    v_a = np.asarray(v_a)
+    v_b = np.asarray(v_b)
+    offset = _start_offset(t_a, v_a, t_b, v_b, tol, max_skip)
+
+    # The triggers of each value in b, to search for matches
+    b_by_value = {}
+    for v in np.unique(v_b):
+        inx = np.nonzero(v_b == v)[0]
+        b_by_value[v] = (t_b[inx], inx)
+
+    pairs = []
+    used_b = np.zeros(len(t_b), dtype=bool)
+    for i in range(len(t_a)):
+        if v_a[i] not in b_by_value:
+            continue
+        times, inx = b_by_value[v_a[i]]
+        target = t_a[i] + offset
+        k = np.searchsorted(times, target)
+        best = None
+        for kk in (k - 1, k):
+            if 0 <= kk < len(times) and not used_b[inx[kk]]:
+                err = abs(times[kk] - target)
+                if err <= tol and (best is None or err < best[0]):
+                    best = (err, inx[kk])
+        if best is None:
+            continue
+        j = best[1]
+        used_b[j] = True
+        pairs.append((i, j))
+        offset = t_b[j] - t_a[i]  # Follow the drift between the clocks
+
+    pairs = np.array(pairs, dtype=np.int64).reshape(-1, 2)
+    matched_a = np.zeros(len(t_a), dtype=bool)
+    matched_a[pairs[:, 0]] = True
+    offsets = t_b[pairs[:, 1]] - t_a[pairs[:, 0]]
+    if len(pairs) > 1:
+        drift = np.polyfit(t_a[pairs[:, 0]], t_b[pairs[:, 1]], 1)[0]
+    else:
+        drift = np.nan
+    return {'pairs': pairs,
+            'unmatched_a': np.nonzero(~matched_a)[0],
+            'unmatched_b': np.nonzero(~used_b)[0],
+            'offset': offsets,
+            'drift': drift}
+
+
+def merged_times(t_a, v_a, t_b, v_b, match, value):
+    """ Times of every trigger with one value, in both systems, including
+    the ones that only one system recorded, in order of time. Where one
+    system missed the trigger, its time is estimated from the offset
+    between the clocks at the nearest matches.
+
+    match: Output of `match_triggers()` for these triggers
+    Returns (times_a, times_b, found_a, found_b): times of each trigger in
+    each system, and whether it was recorded (not estimated) in each
+    """
+    t_a = np.asarray(t_a, dtype=np.int64)
+    t_b = np.asarray(t_b, dtype=np.int64)
+    v_a = np.asarray(v_a)
+    v_b = np.asarray(v_b)
+    pairs = match['pairs']
+    assert len(pairs) > 0, 'No triggers were matched'
+    both = pairs[v_a[pairs[:, 0]] == value]
+    only_a = match['unmatched_a'][v_a[match['unmatched_a']] == value]
+    only_b = match['unmatched_b'][v_b[match['unmatched_b']] == value]
+
+    # Offset (t_b - t_a) at any time, from the matches around it
+    pair_a = t_a[pairs[:, 0]]
+    pair_b = t_b[pairs[:, 1]]
+    order_a = np.argsort(pair_a, kind='stable')
+    order_b = np.argsort(pair_b, kind='stable')
+    offset_a = np.interp(t_a[only_a], pair_a[order_a],
+                         match['offset'][order_a])
+    offset_b = np.interp(t_b[only_b], pair_b[order_b],
+                         match['offset'][order_b])
+
+    times_a = np.concatenate([t_a[both[:, 0]], t_a[only_a],
+                              np.round(t_b[only_b] - offset_b)])
+    times_b = np.concatenate([t_b[both[:, 1]],
+                              np.round(t_a[only_a] + offset_a), t_b[only_b]])
+    n = [len(both), len(only_a), len(only_b)]
+    found_a = np.repeat([True, True, False], n)
+    found_b = np.repeat([True, False, True], n)
+    order = np.argsort(times_a, kind='stable')
+    return (times_a[order].astype(np.int64), times_b[order].astype(np.int64),
+            found_a[order], found_b[order])
+
+
+def print_match(match, name_a='a', name_b='b'):
+    """ Summarize how well the triggers matched
+    """
+    n_a = len(match['pairs']) + len(match['unmatched_a'])
+    n_b = len(match['pairs']) + len(match['unmatched_b'])
+    print(f"Matched {len(match['pairs'])} triggers "
+          f"({n_a} in {name_a}, {n_b} in {name_b})")
+    if len(match['unmatched_a']) or len(match['unmatched_b']):
+        print(f"  Unmatched: {len(match['unmatched_a'])} in {name_a}, "
+              f"{len(match['unmatched_b'])} in {name_b}")
+    if len(match['pairs']) > 1:
+        jitter = np.diff(match['offset'])
+        print(f"  Timing drift ratio = {match['drift']:.5f}, "
+              f"jitter = {np.std(jitter):.2f} samples")
@@ -0,0 +1,139 @@
+""" Clocks, windows and keyboard input for running the experiment.
+
+The Psychopy versions are used for real sessions. The headless versions
+run in virtual time: the clock only moves forward when something waits or
+the screen flips, so a whole session can be simulated in a few seconds
+(e.g. to test the timing or the logfiles without a screen or a participant).
+"""
+
+import numpy as np
+
+
+class PsychopyClock(object):
+    """ Real time, from Psychopy's monotonic clock
+    """
+    def __init__(self):
+        from psychopy import core
+        self.core = core
+    def getTime(self):
+        return self.core.monotonicClock.getTime()
+    def wait(self, secs):
+        self.core.wait(secs)
+    def Clock(self):
+        """ Make a new clock that can be reset (e.g. for RTs) """
+        return self.core.Clock()
+
+
+class VirtualClock(object):
+    """ Time that only moves forward when something waits
+    """
+    def __init__(self, t_start=0.0):
+        self.t = t_start
+    def getTime(self):
+        return self.t
+    def wait(self, secs):
+        self.t += max(secs, 0.0)
+    def Clock(self):
+        """ Make a new clock that can be reset (e.g. for RTs) """
+        return VirtualTimer(self)
+
+
+class VirtualTimer(object):
+    """ Stand-in for psychopy.core.Clock that runs on a VirtualClock
+    """
+    def __init__(self, clock):
+        self.clock = clock
+        self.t_start = clock.getTime()
+    def reset(self):
+        self.t_start = self.clock.getTime()
+    def getTime(self):
+        return self.clock.getTime() - self.t_start
+
+
+class HeadlessWindow(object):
+    """ Stand-in for psychopy.visual.Window. Flipping waits until the
+    next frame on the clock instead of drawing anything.
+    """
+    def __init__(self, clock, refresh_rate):
+        self.clock = clock
+        self.monitorFramePeriod = 1.0 / refresh_rate
+        self.n_flips = 0
+    def flip(self, clearBuffer=True):
+        period = self.monitorFramePeriod
+        t = self.clock.getTime()
+        t_next_frame = (np.floor(t / period) + 1) * period
+        self.clock.wait(t_next_frame - t)
+        self.n_flips += 1
+        return self.clock.getTime()
+    def clearBuffer(self):
+        pass
+    def close(self):
+        pass
+
+
+class HeadlessStim(object):
+    """ Stand-in for Psychopy stimuli. Keeps its attributes, draws nothing.
+    """
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+    def draw(self):
+        pass
+
+
+class PsychopyInput(object):
+    """ Key presses from the keyboard, through psychopy.event
+    """
+    def __init__(self):
+        from psychopy import event
+        self.event = event
+    def getKeys(self, keyList=None):
+        return self.event.getKeys(keyList)
+    def waitKeys(self, **kwargs):
+        return self.event.waitKeys(**kwargs)
+    def clearEvents(self):
+        self.event.clearEvents()
+
+
+class ScriptedInput(object):
+    """ Key presses from a simulated participant and experimenter.
+    - When waiting for the response keys (a probe), answer one of them at
+      random after a random RT, or sometimes not at all.
+    - When waiting for any other keys (instructions, breaks), press the
+      first of them after `delay` seconds, or `default_key` if any key
+      will do.
+    - Never press anything unprompted, so getKeys() is always empty.
+    """
+    def __init__(self, clock, response_keys, seed=None, delay=0.5,
+                 rt_range=(0.4, 1.5), p_respond=0.95, default_key='space'):
+        self.clock = clock
+        self.response_keys = list(response_keys)
+        self.rng = np.random.default_rng(seed)
+        self.delay = delay
+        self.rt_range = rt_range
+        self.p_respond = p_respond
+        self.default_key = default_key
+    def getKeys(self, keyList=None):
+        return []
+    def clearEvents(self):
+        pass
+    def waitKeys(self, maxWait=float('inf'), keyList=None,
+                 timeStamped=False, **kwargs):
+        if keyList and set(self.response_keys) <= set(keyList):
+            if self.rng.random() > self.p_respond:
+                dur = float('inf') # No response
+            else:
+                dur = self.rng.uniform(*self.rt_range)
+            key = self.rng.choice(self.response_keys)
+        else:
+            dur = self.delay
+            key = keyList[0] if keyList else self.default_key
+        if dur > maxWait:
+            self.clock.wait(maxWait)
+            return None
+        self.clock.wait(dur)
+        if hasattr(timeStamped, 'getTime'):
+            return [(key, timeStamped.getTime())]
+        elif timeStamped:
+            return [(key, self.clock.getTime())]
+        else:
+            return [key]
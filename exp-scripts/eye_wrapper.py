@@ -2,18 +2,28 @@
 """
 
 import datetime
+import time
+import threading
 from time import sleep
+import numpy as np
 
 try:
     import pylink as pl
 except ImportError:
     print('pylink not found')
 
+# Types of link data returned by EyeLink.getNextData() (same as pylink)
+SAMPLE_TYPE = 200
+ENDBLINK = 4
+ENDSACC = 6
+ENDFIX = 8
+
 class DummyEyelink(object):
     """ Allows for testing scripts without using the Eyelink
+    wait: Function used to wait during the drift correction
     """
-    def __init__(self, *args, **kwargs):
-        pass
+    def __init__(self, *args, wait=sleep, **kwargs):
+        self.wait = wait
     def startup(self):
         pass
     def trigger(self, trig):
@@ -21,13 +31,520 @@ class DummyEyelink(object):
     def shutdown(self):
         pass
     def drift_correct(self, center_pos):
-        sleep(5)
+        self.wait(5)
+
+MISSING_DATA = -32768.0 # Value pylink gives when the eye is lost
+
+def read_asc_samples(fname):
+    """ Read the gaze samples from an Eyelink .asc file.
+    Returns arrays of time (ms), x and y (pix, Eyelink coords).
+    Missing samples (e.g. blinks) have x and y set to MISSING_DATA.
+    """
+    t, x, y = [], [], []
+    with open(fname) as f:
+        for line in f:
+            if not line[:1].isdigit():
+                continue
+            parts = line.split()
+            t.append(int(parts[0]))
+            try:
+                x.append(float(parts[1]))
+                y.append(float(parts[2]))
+            except ValueError: # '.' during blinks
+                x.append(MISSING_DATA)
+                y.append(MISSING_DATA)
+    return np.array(t), np.array(x), np.array(y)
+
+
+def synthetic_samples(screen_res, stim_dist, duration=60.0, seed=0):
+    """ Make up a gaze sequence that looks roughly like this experiment:
+    hold fixation at the center, then saccade between the three stimuli
+    (spaced `stim_dist` pix apart), then back to the center, and so on.
+    Returns arrays of time (ms), x and y (pix, Eyelink coords).
+    """
+    rng = np.random.default_rng(seed)
+    n = int(duration * 1000)
+    center = np.array(screen_res) / 2
+    locs = [center + [-stim_dist, 0], center, center + [stim_dist, 0]]
+    x = np.empty(n)
+    y = np.empty(n)
+    i = 0
+    while i < n:
+        # Fixate the center, then look around at the stimuli for ~2 s
+        targets = [(center, rng.integers(900, 1600))]
+        t_stim = 0
+        while t_stim < 2000:
+            dur = rng.integers(180, 500)
+            targets.append((locs[rng.integers(3)], dur))
+            t_stim += dur
+        for pos, dur in targets:
+            sacc = 30
+            pos = pos + rng.normal(0, 10, 2)
+            prev = np.array([x[i - 1], y[i - 1]]) if i > 0 else pos
+            frac = np.linspace(0, 1, sacc)[:, None]
+            seg = np.vstack([prev + frac * (pos - prev),
+                             np.tile(pos, (dur, 1))])
+            seg = seg[:n - i]
+            x[i:i + len(seg)] = seg[:, 0]
+            y[i:i + len(seg)] = seg[:, 1]
+            i += len(seg)
+            if i >= n:
+                break
+    x += rng.normal(0, 1, n)
+    y += rng.normal(0, 1, n)
+    return np.arange(n), x, y
+
+
+class _EyeData(object):
+    """ Stand-in for a pylink sample's data for one eye
+    """
+    def __init__(self, x, y, pupil=1000.0):
+        self.gaze = (x, y)
+        self.pupil = pupil
+    def getGaze(self):
+        return self.gaze
+    def getPupilSize(self):
+        return self.pupil
+
+
+class _Sample(object):
+    """ Stand-in for a pylink sample
+    """
+    def __init__(self, t, x, y):
+        self.t = t
+        self.eye = _EyeData(x, y)
+    def getTime(self):
+        return self.t
+    def isRightSample(self):
+        return True
+    def getRightEye(self):
+        return self.eye
+
+
+class _ReplayLink(object):
+    """ Stand-in for pylink.EyeLink that plays back recorded samples
+    """
+    def __init__(self, t, x, y, rate, speed, clock, loop):
+        self.t = t
+        self.x = x
+        self.y = y
+        self.rate = rate
+        self.speed = speed
+        self.clock = clock
+        self.loop = loop
+        self.t_start = None
+        self.n_requests = 0
+        self.request_dur = 0.0 # Total time spent in getNewestSample()
+
+    def start(self):
+        self.t_start = self.clock()
+
+    def sample_index(self):
+        """ Index of the newest sample at the current time
+        """
+        elapsed = (self.clock() - self.t_start) * self.speed
+        i = int(elapsed * self.rate)
+        if self.loop:
+            i = i % len(self.t)
+        return min(i, len(self.t) - 1)
+
+    def getNewestSample(self):
+        t_call = time.perf_counter()
+        i = self.sample_index()
+        s = _Sample(self.t[i], self.x[i], self.y[i])
+        self.n_requests += 1
+        self.request_dur += time.perf_counter() - t_call
+        return s
+
+
+class ReplayEyelink(object):
+    """ Plays back gaze samples through the same interface as SimpleEyelink,
+    for testing the gaze-contingent parts of the experiment without the
+    eye-tracker.
+
+    samples: (t, x, y) arrays from read_asc_samples() or synthetic_samples()
+    rate: Sampling rate of the samples (Hz)
+    speed: How much faster than real time to play the samples back
+    clock: Function that returns the current time in seconds
+    loop: Start again from the beginning when the samples run out
+    wait: Function used to wait during the drift correction
+    on_sample: Called with (time, x, y) of every sample that has been
+               played back, each time poll() is called (e.g.
+               GazeMonitor.add_sample)
+    """
+    def __init__(self, samples, rate=1000.0, speed=1.0,
+                 clock=time.perf_counter, loop=True, wait=sleep,
+                 on_sample=None):
+        t, x, y = samples
+        self.el = _ReplayLink(t, x, y, rate, speed, clock, loop)
+        self.speed = speed
+        self.wait = wait
+        self.on_sample = on_sample
+        self.n_polled = 0 # Samples already passed to on_sample
+        self.triggers = [] # (sample time, trigger value)
+
+    def startup(self):
+        self.el.start()
+
+    def newest_sample(self):
+        return self.el.getNewestSample()
+
+    def poll(self):
+        """ Pass the samples played back since the last call to on_sample.
+        This runs on the caller's thread, so it works in virtual time.
+        """
+        if self.on_sample is None:
+            return
+        link = self.el
+        elapsed = (link.clock() - link.t_start) * link.speed
+        n_now = int(elapsed * link.rate) + 1
+        if not link.loop:
+            n_now = min(n_now, len(link.t))
+        for i in range(self.n_polled, n_now):
+            i = i % len(link.t)
+            self.on_sample(link.t[i], link.x[i], link.y[i])
+        self.n_polled = max(self.n_polled, n_now)
+
+    def drift_correct(self, center_pos):
+        self.wait(5 / self.speed)
+
+    def trigger(self, trig):
+        i = self.el.sample_index()
+        self.triggers.append((self.el.t[i], trig))
+
+    def shutdown(self):
+        n = self.el.n_requests
+        if n > 0:
+            msg = 'Replayed gaze: {} samples requested, {:.1f} us per request'
+            print(msg.format(n, 1e6 * self.el.request_dur / n))
+
+
+class _LinkEvent(object):
+    """ Stand-in for the end of a pylink fixation, saccade or blink
+    """
+    def __init__(self, start, end, start_gaze, end_gaze, avg_gaze, pupil):
+        self.start = start
+        self.end = end
+        self.start_gaze = start_gaze
+        self.end_gaze = end_gaze
+        self.avg_gaze = avg_gaze
+        self.pupil = pupil
+    def getEye(self):
+        return 1 # Right eye
+    def getStartTime(self):
+        return self.start
+    def getEndTime(self):
+        return self.end
+    def getStartGaze(self):
+        return self.start_gaze
+    def getEndGaze(self):
+        return self.end_gaze
+    def getAverageGaze(self):
+        return self.avg_gaze
+    def getAveragePupilSize(self):
+        return self.pupil
+
+
+def _parse_gaze(t, x, y, step=5, thresh=3.0, min_fix=50):
+    """ Split gaze samples into fixations, saccades and blinks, roughly like
+    the tracker does online. A sample is part of a saccade when the gaze
+    moves more than `thresh` pix per sample over the next `step` samples.
+    Returns a list of (end index, type, _LinkEvent), sorted by end index.
+    """
+    missing = (x == MISSING_DATA) | (y == MISSING_DATA)
+    speed = np.zeros(len(t))
+    speed[:-step] = np.hypot(x[step:] - x[:-step], y[step:] - y[:-step])
+    speed /= step
+    state = np.where(missing, 2, np.where(speed > thresh, 1, 0))
+    # Runs of the same state
+    bounds = np.flatnonzero(np.diff(state)) + 1
+    starts = np.r_[0, bounds]
+    ends = np.r_[bounds, len(t)] - 1
+    events = []
+    for i0, i1 in zip(starts, ends):
+        kind = state[i0]
+        start_gaze = (x[i0], y[i0])
+        end_gaze = (x[i1], y[i1])
+        if kind == 0:
+            if i1 - i0 + 1 < min_fix:
+                continue
+            avg_gaze = (x[i0:i1 + 1].mean(), y[i0:i1 + 1].mean())
+            ev = _LinkEvent(t[i0], t[i1], start_gaze, end_gaze, avg_gaze,
+                            1000.0)
+            events.append((i1, ENDFIX, ev))
+        elif kind == 1:
+            ev = _LinkEvent(t[i0], t[i1], start_gaze, end_gaze, None, None)
+            events.append((i1, ENDSACC, ev))
+        else:
+            ev = _LinkEvent(t[i0], t[i1], None, None, None, None)
+            events.append((i1, ENDBLINK, ev))
+    return events
+
+
+class FakeLink(object):
+    """ Stand-in for pylink.EyeLink that sends samples and events over a
+    pretend link, for testing LinkRecorder without an eye-tracker.
+    Samples come out at `rate` Hz (times `speed`) after start() is called.
+    Fixations, saccades and blinks are parsed from the samples.
+
+    samples: (time, x, y) e.g. from `synthetic_samples` or `read_asc_samples`
+    """
+    def __init__(self, samples, rate=1000.0, speed=1.0,
+                 clock=time.perf_counter):
+        self.t, self.x, self.y = [np.asarray(a) for a in samples]
+        self.rate = rate
+        self.speed = speed
+        self.clock = clock
+        self.events = _parse_gaze(self.t, self.x, self.y)
+        self.t_start = None
+        self.i_sample = 0 # Next sample to send
+        self.i_event = 0 # Next event to send
+        self.data = None # Data from the last call to getNextData()
+
+    def start(self):
+        self.t_start = self.clock()
+
+    def sample_index(self):
+        """ Index of the newest sample at the current time
+        """
+        elapsed = (self.clock() - self.t_start) * self.speed
+        return min(int(elapsed * self.rate), len(self.t) - 1)
+
+    def done(self):
+        """ Whether everything has been sent
+        """
+        return (self.i_sample >= len(self.t)
+                and self.i_event >= len(self.events))
+
+    def trackerTime(self):
+        return self.t[self.sample_index()]
+
+    def getNewestSample(self):
+        i = self.sample_index()
+        return _Sample(self.t[i], self.x[i], self.y[i])
+
+    def getNextData(self):
+        """ Type of the next item of link data, or 0 if there isn't any
+        """
+        i_now = self.sample_index()
+        # Events go out after the last sample they include
+        if (self.i_event < len(self.events)
+                and self.events[self.i_event][0] < self.i_sample):
+            _, kind, self.data = self.events[self.i_event]
+            self.i_event += 1
+            return kind
+        if self.i_sample <= i_now and self.i_sample < len(self.t):
+            i = self.i_sample
+            self.data = _Sample(self.t[i], self.x[i], self.y[i])
+            self.i_sample += 1
+            return SAMPLE_TYPE
+        return 0
+
+    def getFloatData(self):
+        return self.data
+
+
+# Record types for the link data streamed to disk by LinkRecorder
+STREAM_DTYPES = {
+    'samples': np.dtype([('time', 'i4'), ('x', 'f4'), ('y', 'f4'),
+                         ('pupil', 'f4')]),
+    'fixations': np.dtype([('eye_side', 'S1'), ('start', 'i4'),
+                           ('end', 'i4'), ('dur', 'i4'), ('x_avg', 'f4'),
+                           ('y_avg', 'f4'), ('pupil', 'i4')]),
+    'saccades': np.dtype([('eye_side', 'S1'), ('start', 'i4'),
+                          ('end', 'i4'), ('dur', 'i4'), ('x_start', 'f4'),
+                          ('y_start', 'f4'), ('x_end', 'f4'),
+                          ('y_end', 'f4')]),
+    'blinks': np.dtype([('eye_side', 'S1'), ('start', 'i4'), ('end', 'i4'),
+                        ('dur', 'i4')]),
+    'triggers': np.dtype([('time_stamp', 'i4'), ('value', 'i4')])}
+
+EYE_SIDES = (b'L', b'R')
+
+
+class LinkRecorder(object):
+    """ Read samples and events from the link while recording, and write
+    them to disk on a background thread.
+
+    Each type of record is appended to its own binary file
+    (`<fname>-samples.bin`, `<fname>-fixations.bin`, etc) about once per
+    `flush_interval` seconds, so the data survive a crash. When recording
+    stops, the files are combined into `<fname>.npz`, with one array per
+    column (e.g. 'fixations.start'). The analysis reads this file directly,
+    instead of converting the EDF file with edf2asc and parsing it.
+
+    link: pylink.EyeLink (or FakeLink), already recording
+    fname: Where to save the data (without the extension), or None to only
+           pass the samples on to `on_sample`
+    link_lock: Lock that every other user of the link also holds while
+               calling it (pylink isn't thread-safe)
+    on_sample: Also called with (time, x, y) of every sample, on the
+               recorder's thread (e.g. GazeMonitor.add_sample)
+    """
+
+    def __init__(self, link, fname, flush_interval=1.0, link_lock=None,
+                 on_sample=None):
+        self.link = link
+        self.link_lock = link_lock or threading.Lock()
+        self.on_sample = on_sample
+        self.fname = fname
+        self.flush_interval = flush_interval
+        self.buffers = {k: [] for k in STREAM_DTYPES}
+        self.lock = threading.Lock() # Triggers come from the main thread
+        self.files = {}
+        if fname is not None:
+            self.files = {k: open(f'{fname}-{k}.bin', 'wb')
+                          for k in STREAM_DTYPES}
+        self.n_records = {k: 0 for k in STREAM_DTYPES}
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def add_trigger(self, time_stamp, value):
+        """ Log a trigger at a time on the tracker's clock
+        """
+        if self.fname is None:
+            return
+        with self.lock:
+            self.buffers['triggers'].append((time_stamp, value))
+
+    def _add(self, kind, item):
+        """ Convert one item of link data to a record
+        """
+        if kind == SAMPLE_TYPE:
+            if not item.isRightSample():
+                return
+            eye = item.getRightEye()
+            x, y = eye.getGaze()
+            rec = ('samples', (item.getTime(), x, y, eye.getPupilSize()))
+            if self.on_sample is not None:
+                self.on_sample(item.getTime(), x, y)
+            if self.fname is None:
+                return
+        elif kind in (ENDFIX, ENDSACC, ENDBLINK) and self.fname is None:
+            return
+        elif kind in (ENDFIX, ENDSACC, ENDBLINK):
+            eye = EYE_SIDES[item.getEye()]
+            start = item.getStartTime()
+            end = item.getEndTime()
+            dur = end - start + 1 # Same as in the .asc files
+            if kind == ENDFIX:
+                x, y = item.getAverageGaze()
+                pupil = item.getAveragePupilSize()
+                rec = ('fixations', (eye, start, end, dur, x, y, pupil))
+            elif kind == ENDSACC:
+                x0, y0 = item.getStartGaze()
+                x1, y1 = item.getEndGaze()
+                rec = ('saccades', (eye, start, end, dur, x0, y0, x1, y1))
+            else:
+                rec = ('blinks', (eye, start, end, dur))
+        else: # Other events aren't saved
+            return
+        with self.lock:
+            self.buffers[rec[0]].append(rec[1])
+
+    def _poll(self, max_items=1000):
+        """ Read whatever is waiting on the link. Returns how many items
+        were read.
+        """
+        n = 0
+        while n < max_items:
+            # getFloatData() belongs to the item from getNextData(), so no
+            # other thread may use the link in between
+            with self.link_lock:
+                kind = self.link.getNextData()
+                item = self.link.getFloatData() if kind else None
+            if not kind:
+                break
+            self._add(kind, item)
+            n += 1
+        return n
+
+    def flush(self):
+        """ Append the buffered records to the files
+        """
+        with self.lock:
+            buffers = self.buffers
+            self.buffers = {k: [] for k in STREAM_DTYPES}
+        for k, rows in buffers.items():
+            if not rows:
+                continue
+            np.array(rows, dtype=STREAM_DTYPES[k]).tofile(self.files[k])
+            self.files[k].flush()
+            self.n_records[k] += len(rows)
+
+    def _run(self):
+        t_flush = time.perf_counter()
+        while not self.stop_event.is_set():
+            n = self._poll()
+            if time.perf_counter() - t_flush > self.flush_interval:
+                self.flush()
+                t_flush = time.perf_counter()
+            if n == 0:
+                sleep(0.001) # Wait for more data
+        self._poll(max_items=float('inf'))
+        self.flush()
+
+    def stop(self):
+        """ Stop recording, write everything that's left, and save the
+        data as `<fname>.npz`. Returns the name of the .npz file (None if
+        nothing was saved).
+        """
+        self.stop_event.set()
+        self.thread.join()
+        if self.fname is None:
+            return None
+        for f in self.files.values():
+            f.close()
+        print('Streamed from the link:',
+              ', '.join(f'{n} {k}' for k, n in self.n_records.items()))
+        return stream_to_npz(self.fname)
+
+
+def stream_to_npz(fname):
+    """ Combine the binary files written by LinkRecorder into `<fname>.npz`.
+    This also works on the files from a session that crashed: a record that
+    was only partly written is dropped.
+    """
+    columns = {}
+    for k, dtype in STREAM_DTYPES.items():
+        with open(f'{fname}-{k}.bin', 'rb') as f:
+            buf = f.read()
+        n = len(buf) // dtype.itemsize
+        recs = np.frombuffer(buf[:n * dtype.itemsize], dtype=dtype)
+        for col in dtype.names:
+            vals = recs[col]
+            if col == 'eye_side':
+                vals = vals.astype('U1')
+            columns[f'{k}.{col}'] = vals
+    out_fname = f'{fname}.npz'
+    np.savez(out_fname, **columns)
+    return out_fname
+
 
 class SimpleEyelink(object):
+    """ stream: Also save the samples and events from the link during the
+    recording (see LinkRecorder), so the data can be analyzed without
+    converting the EDF file.
+
+    on_sample: Called with (time, x, y) of every sample on the link. The
+               samples are read by a LinkRecorder, which only saves them
+               to disk with `stream`.
+
+    While streaming, the link is used from two threads. Every call to the
+    link after startup() goes through `self.lock`, so use the methods here
+    (e.g. `newest_sample()`) instead of calling `self.el` directly.
+    """
 
-    def __init__(self, screen_res):
+    def __init__(self, screen_res, stream=False, on_sample=None):
         self.screen_res = screen_res
         self.fname = datetime.datetime.now().strftime("%y%m%d%H")
+        self.stream = stream
+        self.on_sample = on_sample
+        self.recorder = None
+        self.lock = threading.Lock() # Shared with the LinkRecorder
 
     def startup(self):
         # Open the calibration screen
@@ -95,19 +612,42 @@ class SimpleEyelink(object):
 
         self.el = el # Hold onto the object
 
+        if self.stream or self.on_sample is not None:
+            self.recorder = LinkRecorder(el,
+                                         self.fname if self.stream else None,
+                                         link_lock=self.lock,
+                                         on_sample=self.on_sample)
+            self.recorder.start()
+
     def drift_correct(self, center_pos):
         """ Drift correction with a manually-drawn fixation
         Press ENTER on the Eyelink computer to accept the new fixation
         """
-        self.el.doDriftCorrect(center_pos[0], center_pos[1], 0, 0)
-        self.el.applyDriftCorrect()
-        error = self.el.startRecording(1,1,1,1)
+        with self.lock:
+            self.el.doDriftCorrect(center_pos[0], center_pos[1], 0, 0)
+            self.el.applyDriftCorrect()
+            error = self.el.startRecording(1,1,1,1)
         return error
 
+    def newest_sample(self):
+        with self.lock:
+            return self.el.getNewestSample()
+
+    def poll(self):
+        """ The samples are passed to on_sample on the recorder's thread as
+        they arrive, so there's nothing to do here
+        """
+        pass
+
     def trigger(self, trig):
-        self.el.sendMessage('Trigger %d' % trig)
+        with self.lock:
+            self.el.sendMessage('Trigger %d' % trig)
+            if self.recorder is not None:
+                self.recorder.add_trigger(self.el.trackerTime(), trig)
 
     def shutdown(self):
+        if self.recorder is not None:
+            self.recorder.stop()
         self.el.stopData()
         self.el.stopRecording() # Might be redundant?
         self.el.closeDataFile()
@@ -0,0 +1,156 @@
+"""
+Keep track of the gaze while the stimuli are on the screen
+
+Every sample that `eye_wrapper.LinkRecorder` reads from the link is passed
+to `add_sample()`, which updates a few statistics for the current trial.
+This happens whether or not the samples are also saved to disk. With
+replayed gaze, `ReplayEyelink.poll()` passes on the samples instead. The
+monitor doesn't use the link itself, so it sees every sample and the link
+only has one reader. The presentation code only has to call
+`start_trial()` and `end_trial()`, after `poll()` on the eye-tracker. At
+block breaks, `print_summary()` shows how the last block went on the
+experimenter's console:
+- Fixations per trial (fixations that began while the stimuli were shown)
+- Proportion of samples on one of the stimuli
+- Proportion of samples where the tracker lost the eye
+"""
+
+import threading
+import numpy as np
+
+MISSING_DATA = -32768.0 # Value pylink gives when the eye is lost
+
+
+class GazeMonitor(object):
+    """ Per-trial gaze statistics from the live sample stream
+
+    stim_locs: (x, y) of the stimuli in Eyelink coordinates, left to right,
+               evenly spaced along a horizontal line
+    on_target_dist: Samples closer than this to a stimulus center are on
+                    target (pix)
+    vel_thresh: Faster eye movements than this are saccades (pix/ms)
+    min_fix: Shortest fixation (ms)
+    """
+
+    def __init__(self, stim_locs, on_target_dist, vel_thresh, min_fix=50):
+        self.stim_x0 = stim_locs[0][0]
+        self.stim_y = stim_locs[0][1]
+        self.stim_spacing = (stim_locs[-1][0] - stim_locs[0][0]) / \
+                            (len(stim_locs) - 1)
+        self.n_stims = len(stim_locs)
+        self.on_target_dist = on_target_dist
+        self.vel_thresh = vel_thresh
+        self.min_fix = min_fix
+        self.lock = threading.Lock() # Samples come from the recorder thread
+        self.trials = [] # Stats for each finished trial
+        self.current = None # Stats for the trial that's running
+        # State of the sample stream
+        self.t_prev = None
+        self.pos_prev = None
+        self.vel = 0.0 # Smoothed eye velocity (pix/ms)
+        self.t_still = None # When the eye stopped moving
+        self.in_fix = False
+
+    def start_trial(self, trial_number):
+        """ Start counting (call when the stimuli come on)
+        """
+        with self.lock:
+            self.current = {'trial': trial_number,
+                            'n_samples': 0,
+                            'n_lost': 0,
+                            'n_on_target': 0,
+                            'n_fix': 0,
+                            'fix_locs': [0] * self.n_stims}
+
+    def end_trial(self):
+        """ Stop counting (call when the stimuli go off)
+        """
+        with self.lock:
+            if self.current is not None:
+                self.trials.append(self.current)
+            self.current = None
+
+    def add_sample(self, t, x, y):
+        """ Update the statistics with one sample (time in ms, Eyelink pix)
+        """
+        with self.lock:
+            stats = self.current
+            if x == MISSING_DATA or y == MISSING_DATA:
+                self.t_prev = None
+                self.in_fix = False
+                if stats is not None:
+                    stats['n_samples'] += 1
+                    stats['n_lost'] += 1
+                return
+
+            # Smoothed velocity, to tell fixations from saccades
+            if self.t_prev is not None and t > self.t_prev:
+                dist = ((x - self.pos_prev[0]) ** 2 +
+                        (y - self.pos_prev[1]) ** 2) ** 0.5
+                vel = dist / (t - self.t_prev)
+                self.vel = 0.7 * self.vel + 0.3 * vel
+            else:
+                self.vel = 0.0
+            self.t_prev = t
+            self.pos_prev = (x, y)
+
+            # Closest stimulus: they're evenly spaced on one line
+            i_stim = int(round((x - self.stim_x0) / self.stim_spacing))
+            i_stim = min(max(i_stim, 0), self.n_stims - 1)
+            dx = x - (self.stim_x0 + i_stim * self.stim_spacing)
+            dy = y - self.stim_y
+            on_target = (dx * dx + dy * dy) <= self.on_target_dist ** 2
+
+            # A fixation starts once the eye has been still for min_fix ms
+            new_fix = False
+            if self.vel > self.vel_thresh:
+                self.t_still = None
+                self.in_fix = False
+            elif self.t_still is None:
+                self.t_still = t
+            elif not self.in_fix and (t - self.t_still) >= self.min_fix:
+                self.in_fix = True
+                new_fix = True
+
+            if stats is None:
+                return
+            stats['n_samples'] += 1
+            stats['n_on_target'] += on_target
+            if new_fix:
+                stats['n_fix'] += 1
+                if on_target:
+                    stats['fix_locs'][i_stim] += 1
+
+    def summary(self, n_trials=None):
+        """ Summarize the last `n_trials` trials (default: all of them)
+        """
+        with self.lock:
+            trials = self.trials[-n_trials:] if n_trials else self.trials[:]
+        n_samples = sum(tr['n_samples'] for tr in trials)
+        if n_samples == 0:
+            return None
+        n_fix = np.array([tr['n_fix'] for tr in trials])
+        summ = {'n_trials': len(trials),
+                'fix_per_trial': n_fix.mean(),
+                'no_saccades': int(np.sum(n_fix < 2)),
+                'on_target': sum(tr['n_on_target'] for tr in trials)
+                             / n_samples,
+                'lost': sum(tr['n_lost'] for tr in trials) / n_samples,
+                'fix_locs': np.sum([tr['fix_locs'] for tr in trials],
+                                   axis=0).tolist()}
+        return summ
+
+    def print_summary(self, n_trials=None):
+        """ Print the summary on the experimenter's console
+        """
+        summ = self.summary(n_trials)
+        if summ is None:
+            print('Gaze monitor: no samples yet')
+            return
+        print('Gaze over the last {} trials:'.format(summ['n_trials']))
+        print('  {:.1f} fixations per trial ({} trials with fewer than 2)'
+              .format(summ['fix_per_trial'], summ['no_saccades']))
+        print('  Fixations on left/center/right: {}'.format(
+              '/'.join(str(n) for n in summ['fix_locs'])))
+        print('  {:.0f}% of samples on a stimulus, {:.1f}% tracking loss'
+              .format(100 * summ['on_target'], 100 * summ['lost']))
@@ -26,19 +26,19 @@ Things to test
 
 # Standard libraries
 import os
+import time
 import datetime
 import numpy as np
 import scipy.io as sio
 import yaml
 
-# Psychopy
-from psychopy import parallel
-from psychopy import visual, core, data, event, monitors
-
 # Custom modules
 import refcheck
 import dist_convert as dc
 import eye_wrapper
+import backends
+import trial_log
+import gaze_monitor
 
 
 ############
@@ -50,8 +50,21 @@ IN_MEG_LAB = True
 
 FULL_SCREEN = True
 
-START_TIME = datetime.datetime.now().strftime('%Y-%m-%d-%H%M')
-RT_CLOCK = core.Clock() # for measuring response times
+# Simulate the whole session in virtual time, without a screen, keyboard,
+# triggers or eye-tracker. Also see `run_headless.py`.
+HEADLESS = False
+
+# Gaze to play back when not using the eye-tracker (IN_MEG_LAB = False).
+# None: always look at the center, 'synthetic': made-up saccades between
+# the stimuli, or the filename of an Eyelink .asc file to replay.
+REPLAY_GAZE = None
+REPLAY_SPEED = 1.0 # Play back the gaze this many times faster than real time
+
+# Save the eye-tracker data from the link during the recording, so it can be
+# analyzed right after the session (see eye_wrapper.LinkRecorder). Off
+# until the recorder has been tested with the real tracker.
+STREAM_GAZE = False
+
 
 TRIGGERS = {'response': 1,
             'fixation': 2,
@@ -82,232 +95,144 @@ STIM_SIZE_DEG = 2.0 # Stim size in visual degrees
 STIM_DIST_DEG = 5.0 # Distance b/w centers of stimuli in vis deg
 STIM_SIZE = int(dc.deg2pix(STIM_SIZE_DEG)) # Size in pixels
 STIM_DIST = int(dc.deg2pix(STIM_DIST_DEG)) # Distance b/w stimuli
+STIM_LOCS = {'left': (SCREEN_CENTER[0] - STIM_DIST, SCREEN_CENTER[1]),
+             'center': tuple(SCREEN_CENTER),
+             'right': (SCREEN_CENTER[0] + STIM_DIST, SCREEN_CENTER[1])}
 STIM_DUR = 2.0 # Duration the stimuli stay on screen
 RESPONSE_CUTOFF = 4.0 # Respond within this time
 ITI = 0.2 # Inter-trial interval
 FIX_DUR = (0.5, 1.0) # Hold fixation for X seconds before starting trial
 FIX_THRESH_DEG = 1.0 # Subject must fixate w/in this distance to start trial
 FIX_THRESH = int(dc.deg2pix(FIX_THRESH_DEG))
+SACCADE_VEL = 30.0 # Eye movements faster than this (deg/s) are saccades
 P_PROBE = 0.5 # Probability of getting a word probe on this trial
 N_REPS_PER_LOC = 15 # How many times each object appears in each location
 BLOCK_LENGTH = 25 # Number of trials per block
 
+# Render each trial's stimuli into one image during the previous ITI, so
+# stimulus onset only has to draw that image
+PRERENDER = True
+
 END_EXPERIMENT = 9999 # Numeric tag signals stopping expt early
 
 LOG_DIR = '../logfiles/'
-assert os.path.exists(LOG_DIR), 'Logfile directory does not exist'
-
 STIM_DIR = '../stimuli/'
-assert os.path.exists(STIM_DIR), 'Stimuli directory does not exist'
-
-# Load instructions
-with open('instruct.txt') as f:
-    instruct_text = f.readlines()
-
-# Load the list of probe words
-with open('probes.txt') as f:
-    probe_words = [w.strip() for w in f.readlines()]
-
-# Load info about which images to use
-with open(f"stimuli.yaml") as f:
-    stim_info = yaml.load(f, Loader=yaml.SafeLoader)
-stims_to_show = []
-for stims in stim_info.values():
-    stims_to_show.extend(stims)
-stims_to_show = np.array(stims_to_show)
-
-# Initialize external equipment
-if IN_MEG_LAB:
-    refresh_rate = 120.0
-    port = parallel.ParallelPort(address=0xBFF8)
-    port.setData(0)
-    el = eye_wrapper.SimpleEyelink(SCREEN_RES)
-    el.startup()
-
-    def eye_pos():
-        """ Get the eye position
-        """
-        pos = el.el.getNewestSample()
-        pos = pos.getRightEye()
-        pos = pos.getGaze() # eye position in pix (origin: bottom right)
-        return pos
-
-    def send_trigger(trig):
-        """ Send triggers to the MEG acquisition computer
-        and the EyeLink computer.
-        """
-        t = TRIGGERS[trig]
-        port.setData(t)
-        el.trigger(t)
-
-    def reset_port():
-        """ Reset the parallel port to avoid overlapping triggers
-        """
-        wait_time = 0.003
-        core.wait(wait_time)
-        port.setData(0)
-        core.wait(wait_time)
-
-else: # Dummy functions for dry-runs on my office desktop
-    refresh_rate = 120.0
-    el = eye_wrapper.DummyEyelink()
-
-    def eye_pos():
-        pos = win_center
-        pos = np.int64(dc.origin_psychopy2eyelink(pos))
-        return pos
-
-    def send_trigger(trig):
-        print('Trigger: {}'.format(trig))
-
-    def reset_port():
-        pass
-
-
-######################
-# Window and Stimuli #
-######################
-
-win_center = (0, 0)
-
-mon = monitors.Monitor('propixxMonitor',
-                       width=dc.screen_width, # in cm
-                       distance=dc.eye_screen) # in cm
-mon.setSizePix(SCREEN_RES)
-
-win = visual.Window(SCREEN_RES,
-                    monitor=mon,
-                    fullscr=FULL_SCREEN,
-                    color=COLORS['grey'], colorSpace=COLORS['cs'],
-                    allowGUI=False)
-
-# parameters used across stimuli
-stim_params = {'win': win, 'units': 'pix'}
-circle_params = {'fillColor': COLORS['white'],
-                 'lineColor': COLORS['white'],
-                 'fillColorSpace': COLORS['cs'],
-                 'lineColorSpace': COLORS['cs'],
-                 **stim_params}
-
-text_stim = visual.TextStim(pos=win_center, text='hello', # For instructions
-                            color=COLORS['white'], colorSpace=COLORS['cs'],
-                            height=32,
-                            **stim_params)
-
-fixation = visual.Circle(radius=10, pos=win_center, **circle_params)
-drift_fixation = visual.Circle(radius=5, pos=win_center, **circle_params)
-
-# For marking the gaze position
-eye_marker = visual.Circle(radius=20, pos=win_center, **circle_params)
-eye_marker.fillColor = COLORS['pink']
-
-# Make psychopy stimulus objects
-pic_stims = {}
-for n in stims_to_show:
-    stim_fname = f'{STIM_DIR}{n}.jpg'
-    s = visual.ImageStim(image=stim_fname,
-                         size=(STIM_SIZE, STIM_SIZE),
-                         colorSpace=COLORS['cs'],
-                         **stim_params)
-    pic_stims[n] = s
 
 
 ###################
 # Make the trials #
 ###################
 
-stim_locations = ('left', 'center', 'right')
-
-# Make the lists of stimuli at each location
-# Every image is shown once at each location before repeating the images
-# Images are not duplicated within a trial
-stim_list_by_loc = {loc: [] for loc in stim_locations}
-for i_rep in range(N_REPS_PER_LOC):
-    stims_temp = {}
-    for loc in stim_locations:
-        stims_temp[loc] = stims_to_show.copy()
-        np.random.shuffle(stims_temp[loc])
-    # Check for duplicates within a trial
-    i_iter = 0
-    max_iter = 100
-    while True:
-        i_iter += 1
-        if i_iter > max_iter:
-            print("Couldn't make a version without duplicates")
-            import sys; sys.exit()
-
-        stims_by_trial = np.array([stims_temp[loc] for loc in stim_locations])
-        n_unique = np.apply_along_axis(lambda x: len(set(x)),
-                                       axis=0,
-                                       arr=stims_by_trial)
-        dups = np.nonzero(n_unique != len(stim_locations))[0] # inx of dups
-        # Break out of this loop when there are no more duplicates
-        if len(dups) == 0:
-            break
+def load_stimulus_list():
+    """ Load info about which images to use
+    """
+    with open(f"stimuli.yaml") as f:
+        stim_info = yaml.load(f, Loader=yaml.SafeLoader)
+    stims_to_show = []
+    for stims in stim_info.values():
+        stims_to_show.extend(stims)
+    stims_to_show = np.array(stims_to_show)
+    return stims_to_show
+
+
+def make_trials(stims_to_show, probe_words):
+    """ Make the list of trial info dictionaries
+    """
+    stim_locations = ('left', 'center', 'right')
+
+    # Make the lists of stimuli at each location
+    # Every image is shown once at each location before repeating the images
+    # Images are not duplicated within a trial
+    stim_list_by_loc = {loc: [] for loc in stim_locations}
+    for i_rep in range(N_REPS_PER_LOC):
+        stims_temp = {}
+        for loc in stim_locations:
+            stims_temp[loc] = stims_to_show.copy()
+            np.random.shuffle(stims_temp[loc])
+        # Check for duplicates within a trial
+        i_iter = 0
+        max_iter = 100
+        while True:
+            i_iter += 1
+            if i_iter > max_iter:
+                print("Couldn't make a version without duplicates")
+                import sys; sys.exit()
+
+            stims_by_trial = np.array([stims_temp[loc] for loc in stim_locations])
+            n_unique = np.apply_along_axis(lambda x: len(set(x)),
+                                           axis=0,
+                                           arr=stims_by_trial)
+            dups = np.nonzero(n_unique != len(stim_locations))[0] # inx of dups
+            # Break out of this loop when there are no more duplicates
+            if len(dups) == 0:
+                break
+            else:
+                print('Fixing trials to avoid duplicates')
+                # Shuffle any duplicates
+                for inx in dups:
+                    s_l = stims_temp['left']
+                    s_c = stims_temp['center']
+                    s_r = stims_temp['right']
+                    # Decide which stimulus to switch
+                    # Switch the left stim if it's duplicated in the others
+                    if stims_temp['left'][inx] in (stims_temp['center'][inx],
+                                                   stims_temp['right'][inx]):
+                        s_switch = stims_temp['left']
+                        s_keep_1 = stims_temp['center']
+                        s_keep_2 = stims_temp['right']
+                    # Switch the center stim if it's the same as the right stim
+                    else:
+                        s_switch = stims_temp['center']
+                        s_keep_1 = stims_temp['left']
+                        s_keep_2 = stims_temp['right']
+                    # Find the closest place where switching the stims won't
+                    # introduce another trial with duplicated stimuli
+                    switch_inx = inx 
+                    while True:
+                        switch_inx += 1
+                        # Wrap the indices when you get to the end of the list
+                        switch_inx = switch_inx % len(stims_to_show)
+                        # Does switching here introduce a duplicate?
+                        if s_switch[inx] in (s_keep_1[switch_inx],
+                                             s_keep_2[switch_inx]):
+                            continue
+                        if s_switch[switch_inx] in (s_keep_1[inx],
+                                                    s_keep_2[inx]):
+                            continue
+                        # If there's no dup here, break the loop and keep this index
+                        break
+                    # Switch the stimuli
+                    s_switch[inx], s_switch[switch_inx] = \
+                            s_switch[switch_inx], s_switch[inx]
+
+        # Add the stimulus lists to the trial order
+        for loc in stim_locations:
+            stim_list_by_loc[loc].extend(stims_temp[loc])
+
+    # Build the list of trial info dictionaries
+    choice = np.random.choice
+    trial_info = []
+    for s_left, s_center, s_right in zip(*stim_list_by_loc.values()):
+        d = {}
+        d['stim_left'] = s_left
+        d['stim_center'] = s_center
+        d['stim_right'] = s_right
+        if choice([True, False], p=(P_PROBE, 1 - P_PROBE)):
+            d['probe_word'] = choice(probe_words)
         else:
-            print('Fixing trials to avoid duplicates')
-            # Shuffle any duplicates
-            for inx in dups:
-                s_l = stims_temp['left']
-                s_c = stims_temp['center']
-                s_r = stims_temp['right']
-                # Decide which stimulus to switch
-                # Switch the left stim if it's duplicated in the others
-                if stims_temp['left'][inx] in (stims_temp['center'][inx],
-                                               stims_temp['right'][inx]):
-                    s_switch = stims_temp['left']
-                    s_keep_1 = stims_temp['center']
-                    s_keep_2 = stims_temp['right']
-                # Switch the center stim if it's the same as the right stim
-                else:
-                    s_switch = stims_temp['center']
-                    s_keep_1 = stims_temp['left']
-                    s_keep_2 = stims_temp['right']
-                # Find the closest place where switching the stims won't
-                # introduce another trial with duplicated stimuli
-                switch_inx = inx 
-                while True:
-                    switch_inx += 1
-                    # Wrap the indices when you get to the end of the list
-                    switch_inx = switch_inx % len(stims_to_show)
-                    # Does switching here introduce a duplicate?
-                    if s_switch[inx] in (s_keep_1[switch_inx],
-                                         s_keep_2[switch_inx]):
-                        continue
-                    if s_switch[switch_inx] in (s_keep_1[inx],
-                                                s_keep_2[inx]):
-                        continue
-                    # If there's no dup here, break the loop and keep this index
-                    break
-                # Switch the stimuli
-                s_switch[inx], s_switch[switch_inx] = \
-                        s_switch[switch_inx], s_switch[inx]
-
-    # Add the stimulus lists to the trial order
-    for loc in stim_locations:
-        stim_list_by_loc[loc].extend(stims_temp[loc])
-
-# Build the list of trial info dictionaries
-choice = np.random.choice
-trial_info = []
-for s_left, s_center, s_right in zip(*stim_list_by_loc.values()):
-    d = {}
-    d['stim_left'] = s_left
-    d['stim_center'] = s_center
-    d['stim_right'] = s_right
-    if choice([True, False], p=(P_PROBE, 1 - P_PROBE)):
-        d['probe_word'] = choice(probe_words)
-    else:
-        d['probe_word'] = None
-    d['fix_dur'] = np.random.uniform(*FIX_DUR)
-    trial_info.append(d)
-
-trials = data.TrialHandler(trial_info, nReps=1, method='sequential')
+            d['probe_word'] = None
+        d['fix_dur'] = np.random.uniform(*FIX_DUR)
+        trial_info.append(d)
 
+    return trial_info
+
+
+def trial_layout(trial, pic_stims):
+    """ List of the stimuli to draw in a trial, already in place
+    pic_stims: Dict of stimuli, keyed by (image ID, location)
+    """
+    return [pic_stims[trial[f'stim_{loc}'], loc] for loc in STIM_LOCS]
 
-#########################
-# Stimulus presentation #
-#########################
 
 def euc_dist(a, b):
     """ Euclidean distance between two (x,y) pairs
@@ -316,191 +241,511 @@ def euc_dist(a, b):
     return d
 
 
-def show_text(text):
-    """ Show text at the center of the screen
-    """
-    text_stim.text = text
-    text_stim.draw()
-    win.flip()
-
+#########################
+# Stimulus presentation #
+#########################
 
-def instructions(text):
-    """ Show instructions and go on after pressing space
+class Session(object):
+    """ One session of the experiment.
+
+    All the setup happens here instead of at import time. The clock, window
+    and keyboard input can be swapped out: with `headless=True`, the session
+    runs in virtual time with no screen, keyboard, triggers or eye-tracker,
+    and scripted responses (see `backends.py`). It still writes the
+    behavioral logfile and the trigger log.
+
+    in_meg_lab: Use the parallel port and the Eyelink
+    headless: Run in virtual time without any hardware
+    replay_gaze: None, 'synthetic', or an .asc file (see REPLAY_GAZE)
+    replay_speed: Speed-up for replaying gaze in real time
+    n_trials: Only run this many trials (default: all of them)
+    log_dir: Where to save the logfiles
+    seed: Random seed for the trial order and scripted responses
     """
-    show_text(text)
-    event.waitKeys(keyList=['space'])
-    win.flip(clearBuffer=True) # clear the screen
-    core.wait(0.2)
 
+    def __init__(self, in_meg_lab=IN_MEG_LAB, headless=HEADLESS,
+                 replay_gaze=REPLAY_GAZE, replay_speed=REPLAY_SPEED,
+                 n_trials=None, log_dir=LOG_DIR, seed=None):
+        self.headless = headless
+        self.in_meg_lab = in_meg_lab and not headless
+        self.replay_gaze = replay_gaze
+        self.log_dir = log_dir
+        start_time = datetime.datetime.now().strftime('%Y-%m-%d-%H%M')
+        self.start_time = trial_log.session_name(log_dir, start_time)
+        self.log_fname = '{}/{}.csv'.format(log_dir, self.start_time)
+        self.refresh_rate = 120.0
+        self.trial_log = None # Opened when the session starts
+        self.trigger_log = None
+
+        assert os.path.exists(log_dir), 'Logfile directory does not exist'
+        assert os.path.exists(STIM_DIR), 'Stimuli directory does not exist'
+        if seed is not None:
+            np.random.seed(seed)
+
+        # Clock and keyboard
+        if headless:
+            self.clock = backends.VirtualClock()
+            self.input = backends.ScriptedInput(self.clock,
+                                                [KEYS['yes'], KEYS['no']],
+                                                seed=seed)
+        else:
+            self.clock = backends.PsychopyClock()
+            self.input = backends.PsychopyInput()
+        self.rt_clock = self.clock.Clock() # for measuring response times
+
+        # Load instructions
+        with open('instruct.txt') as f:
+            self.instruct_text = f.readlines()
+
+        # Load the list of probe words
+        with open('probes.txt') as f:
+            self.probe_words = [w.strip() for w in f.readlines()]
+
+        self.stims_to_show = load_stimulus_list()
+
+        # Watch the gaze during the trials, using every sample from the
+        # link (or from the replayed gaze). Gaze within half a stimulus
+        # width of its center is on it.
+        self.gaze_monitor = None
+        if self.in_meg_lab or replay_gaze is not None:
+            stim_locs = [dc.origin_psychopy2eyelink(list(pos))
+                         for pos in STIM_LOCS.values()]
+            vel_thresh = dc.deg2pix(SACCADE_VEL) / 1000 # pix/ms
+            self.gaze_monitor = gaze_monitor.GazeMonitor(stim_locs,
+                                                         STIM_SIZE / 2,
+                                                         vel_thresh)
+        on_sample = None
+        if self.gaze_monitor is not None:
+            on_sample = self.gaze_monitor.add_sample
+
+        # Initialize external equipment
+        if self.in_meg_lab:
+            from psychopy import parallel
+            self.port = parallel.ParallelPort(address=0xBFF8)
+            self.port.setData(0)
+            self.el = eye_wrapper.SimpleEyelink(SCREEN_RES,
+                                                stream=STREAM_GAZE,
+                                                on_sample=on_sample)
+            self.el.startup()
+        elif replay_gaze is not None:
+            if replay_gaze == 'synthetic':
+                samples = eye_wrapper.synthetic_samples(SCREEN_RES, STIM_DIST)
+            else:
+                samples = eye_wrapper.read_asc_samples(replay_gaze)
+            if headless: # Virtual time is already as fast as possible
+                replay_speed = 1.0
+            self.el = eye_wrapper.ReplayEyelink(samples,
+                                                speed=replay_speed,
+                                                clock=self.clock.getTime,
+                                                wait=self.clock.wait,
+                                                on_sample=on_sample)
+            self.el.startup()
+        else: # Dummy eye-tracker for dry-runs on my office desktop
+            self.el = eye_wrapper.DummyEyelink(wait=self.clock.wait)
+
+        self.make_window()
+        self.make_stimuli()
+
+        self.trial_info = make_trials(self.stims_to_show, self.probe_words)
+        if n_trials is not None:
+            self.trial_info = self.trial_info[:n_trials]
+        # What to draw in each trial
+        self.layouts = [trial_layout(trial, self.pic_stims)
+                        for trial in self.trial_info]
+        self.draw_durs = [] # Time to draw the stimuli in each trial
+        self.onset_durs = [] # Time from drawing to the flip at onset
+        self.prerendered = {} # Trial number: image of the stimuli
+
+    ######################
+    # Window and Stimuli #
+    ######################
+
+    def make_window(self):
+        self.win_center = (0, 0)
+        if self.headless:
+            self.win = backends.HeadlessWindow(self.clock, self.refresh_rate)
+            return
+        from psychopy import visual, monitors
+        mon = monitors.Monitor('propixxMonitor',
+                               width=dc.screen_width, # in cm
+                               distance=dc.eye_screen) # in cm
+        mon.setSizePix(SCREEN_RES)
+        self.win = visual.Window(SCREEN_RES,
+                                 monitor=mon,
+                                 fullscr=FULL_SCREEN,
+                                 color=COLORS['grey'],
+                                 colorSpace=COLORS['cs'],
+                                 allowGUI=False)
+
+    def prerender(self, i_trial):
+        """ Draw the stimuli of a trial into one image, before the trial.
+        Only the part of the screen with the stimuli is captured.
+        """
+        self.prerendered.clear() # Only hold onto one trial at a time
+        if i_trial >= len(self.layouts):
+            return
+        stims = self.layouts[i_trial]
+        if self.headless:
+            self.prerendered[i_trial] = backends.HeadlessStim(stim=stims)
+            return
+        from psychopy import visual
+        # Rectangle around the stimuli, in normalized units
+        half_w = (STIM_DIST + STIM_SIZE / 2) / (SCREEN_RES[0] / 2)
+        half_h = (STIM_SIZE / 2) / (SCREEN_RES[1] / 2)
+        rect = [-half_w, half_h, half_w, -half_h]
+        buf = visual.BufferImageStim(self.win, stim=stims, rect=rect)
+        self.win.clearBuffer() # Don't show the stimuli on the next flip
+        self.prerendered[i_trial] = buf
+
+    def make_stim(self, kind, **kwargs):
+        """ Make a psychopy.visual stimulus of type `kind` (e.g. 'Circle')
+        """
+        if self.headless:
+            return backends.HeadlessStim(**kwargs)
+        from psychopy import visual
+        return getattr(visual, kind)(win=self.win, units='pix', **kwargs)
+
+    def make_stimuli(self):
+        win_center = self.win_center
+        # parameters used across stimuli
+        circle_params = {'fillColor': COLORS['white'],
+                         'lineColor': COLORS['white'],
+                         'fillColorSpace': COLORS['cs'],
+                         'lineColorSpace': COLORS['cs']}
+
+        self.text_stim = self.make_stim('TextStim', # For instructions
+                                        pos=win_center, text='hello',
+                                        color=COLORS['white'],
+                                        colorSpace=COLORS['cs'],
+                                        height=32)
+
+        self.fixation = self.make_stim('Circle', radius=10, pos=win_center,
+                                       **circle_params)
+        self.drift_fixation = self.make_stim('Circle', radius=5,
+                                             pos=win_center,
+                                             **circle_params)
+
+        # For marking the gaze position
+        self.eye_marker = self.make_stim('Circle', radius=20,
+                                         pos=win_center, **circle_params)
+        self.eye_marker.fillColor = COLORS['pink']
+        self.eye_testers = [self.fixation] # Drawn during eye_pos_check()
+
+        # Make psychopy stimulus objects: one for each image at each
+        # location, so they never have to be moved during the session
+        self.pic_stims = {}
+        for n in self.stims_to_show:
+            stim_fname = f'{STIM_DIR}{n}.jpg'
+            for loc, pos in STIM_LOCS.items():
+                s = self.make_stim('ImageStim',
+                                   image=stim_fname,
+                                   pos=pos,
+                                   size=(STIM_SIZE, STIM_SIZE),
+                                   colorSpace=COLORS['cs'])
+                self.pic_stims[n, loc] = s
+
+    ###############
+    # Peripherals #
+    ###############
+
+    def eye_pos(self):
+        """ Get the eye position
+        """
+        if self.in_meg_lab or self.replay_gaze is not None:
+            pos = self.el.newest_sample()
+            pos = pos.getRightEye()
+            pos = pos.getGaze() # eye position in pix (origin: bottom right)
+            return pos
+        pos = self.win_center
+        pos = np.int64(dc.origin_psychopy2eyelink(pos))
+        return pos
 
-def drift_correct():
-    """ Eye-tracker drift correction.
-    Press SPACE on the Eyelink machine to accept the current position.
-    """
-    reset_port()
-    core.wait(0.2)
-    # Draw a fixation dot
-    drift_fixation.draw()
-    win.flip()
-    send_trigger('drift_correct_start')
-    reset_port()
-    # Do the drift correction
-    fix_pos = np.int64(dc.origin_psychopy2eyelink(drift_fixation.pos))
-    el.drift_correct(fix_pos)
-    send_trigger('drift_correct_end')
-    reset_port()
-
-
-def experimenter_control():
-    """ Check for experimenter key-presses to pause/exit the experiment or
-    correct drift in the eye-tracker.
-    """
-    r = event.getKeys(KEYS.values())
-    if KEYS['break'] in r:
-        show_text('End experiment? (y/n)')
-        core.wait(1.0)
-        event.clearEvents()
-        r = event.waitKeys(keyList=['y', 'n'])
-        if 'y' in r:
-            return END_EXPERIMENT
-    elif KEYS['drift'] in r:
-        drift_correct()
-
-
-def run_trial(trial):
-    reset_port()
-    event.clearEvents()
-
-    # Wait for fixation and check for experimenter input
-    fixation.draw()
-    win.flip()
-    send_trigger('fixation')
-    reset_port()
-    t_fix = core.monotonicClock.getTime() # Start a timer
-    core.wait(0.2)
-    while True:
-        # Check for experimenter control to end or correct drift
-        if experimenter_control() == END_EXPERIMENT:
-            return END_EXPERIMENT
-        d = euc_dist(dc.origin_eyelink2psychopy(eye_pos()), win_center)
-        t_now = core.monotonicClock.getTime()
-        # Reset timer if not looking at fixation
-        if (d > FIX_THRESH):
-            t_fix = t_now
-        # If they are looking at the fixation, and have looked long enough
-        elif (t_now - t_fix) > trial['fix_dur']:
-            break
-        # If they are looking, but haven't held fixation long enough
+    def send_trigger(self, trig):
+        """ Send triggers to the MEG acquisition computer
+        and the EyeLink computer.
+        """
+        t = TRIGGERS[trig]
+        if self.in_meg_lab:
+            self.port.setData(t)
+            self.el.trigger(t)
         else:
-            fixation.draw()
-            win.flip()
-
-    # Present the stimuli
-
-    stim_left = pic_stims[trial['stim_left']]
-    stim_left.pos = (SCREEN_CENTER[0] - STIM_DIST, SCREEN_CENTER[1])
-    stim_left.draw()
-
-    stim_center = pic_stims[trial['stim_center']]
-    stim_center.pos = SCREEN_CENTER
-    stim_center.draw()
-
-    stim_right = pic_stims[trial['stim_right']]
-    stim_right.pos = (SCREEN_CENTER[0] + STIM_DIST, SCREEN_CENTER[1])
-    stim_right.draw()
-
-    win.flip()
-    send_trigger('stimuli')
-    trials.addData('stim_onset', core.monotonicClock.getTime())
-    reset_port()
-    core.wait(STIM_DUR)
-    
-    # Show the probe
-    if trial['probe_word'] is not None:
-        show_text(trial['probe_word'])
-        send_trigger('probe')
-        RT_CLOCK.reset()
-        reset_port()
-
-        # Wait for a key press
-        event.clearEvents()
-        r = event.waitKeys(maxWait=RESPONSE_CUTOFF,
-                           keyList=[KEYS['yes'], KEYS['no']],
-                           timeStamped=RT_CLOCK)
-        if r is not None:
-            send_trigger('response')
-            reset_port()
-            keypress, rt = r[0]
-            trials.addData('resp', keypress)
-            trials.addData('rt', rt)
-
-    win.flip(clearBuffer=True)
-    core.wait(ITI)
-
-    return experimenter_control()
-
-
-def eye_pos_check():
-    """ Check whether the dot is following the eye position
-    """
-    event.clearEvents()
-    while True:
-        # Check for control keypreses
-        r = event.getKeys(KEYS.values())
-        if KEYS['break'] in r:
-            break
-        elif KEYS['accept'] in r:
-            drift_correct()
+            self.el.trigger(t)
+            if not self.headless:
+                print('Trigger: {}'.format(trig))
+        self.trigger_log.write({'time': self.clock.getTime(),
+                                'trigger': trig,
+                                'value': t})
+
+    def reset_port(self):
+        """ Reset the parallel port to avoid overlapping triggers
+        """
+        if self.in_meg_lab:
+            wait_time = 0.003
+            self.clock.wait(wait_time)
+            self.port.setData(0)
+            self.clock.wait(wait_time)
+
+    #######################
+    # Parts of the session #
+    #######################
+
+    def show_text(self, text):
+        """ Show text at the center of the screen
+        """
+        self.text_stim.text = text
+        self.text_stim.draw()
+        self.win.flip()
 
-        pos = eye_pos()
-        pos = dc.origin_eyelink2psychopy(pos)
-        eye_marker.pos = pos # Mark the current fixation
+    def instructions(self, text):
+        """ Show instructions and go on after pressing space
+        """
+        self.show_text(text)
+        self.input.waitKeys(keyList=['space'])
+        self.win.flip(clearBuffer=True) # clear the screen
+        self.clock.wait(0.2)
+
+    def drift_correct(self):
+        """ Eye-tracker drift correction.
+        Press SPACE on the Eyelink machine to accept the current position.
+        """
+        self.reset_port()
+        self.clock.wait(0.2)
+        # Draw a fixation dot
+        self.drift_fixation.draw()
+        self.win.flip()
+        self.send_trigger('drift_correct_start')
+        self.reset_port()
+        # Do the drift correction
+        fix_pos = np.int64(dc.origin_psychopy2eyelink(self.drift_fixation.pos))
+        self.el.drift_correct(fix_pos)
+        self.send_trigger('drift_correct_end')
+        self.reset_port()
+
+    def experimenter_control(self):
+        """ Check for experimenter key-presses to pause/exit the experiment or
+        correct drift in the eye-tracker.
+        """
+        r = self.input.getKeys(list(KEYS.values()))
+        if KEYS['break'] in r:
+            self.show_text('End experiment? (y/n)')
+            self.clock.wait(1.0)
+            self.input.clearEvents()
+            r = self.input.waitKeys(keyList=['y', 'n'])
+            if 'y' in r:
+                return END_EXPERIMENT
+        elif KEYS['drift'] in r:
+            self.drift_correct()
+
+    def run_trial(self, i_trial, trial):
+        self.reset_port()
+        self.input.clearEvents()
+
+        # Wait for fixation and check for experimenter input
+        self.fixation.draw()
+        self.win.flip()
+        self.send_trigger('fixation')
+        self.reset_port()
+        t_fix = self.clock.getTime() # Start a timer
+        self.clock.wait(0.2)
+        while True:
+            # Check for experimenter control to end or correct drift
+            if self.experimenter_control() == END_EXPERIMENT:
+                return END_EXPERIMENT
+            d = euc_dist(dc.origin_eyelink2psychopy(self.eye_pos()),
+                         self.win_center)
+            t_now = self.clock.getTime()
+            # Reset timer if not looking at fixation
+            if (d > FIX_THRESH):
+                t_fix = t_now
+            # If they are looking at the fixation, and have looked long enough
+            elif (t_now - t_fix) > trial['fix_dur']:
+                break
+            # Keep the dot on the screen (each flip clears the back buffer),
+            # and run the loop at the frame rate
+            self.fixation.draw()
+            self.win.flip()
+
+        # Present the stimuli
+        t_draw = time.perf_counter()
+        if i_trial in self.prerendered:
+            self.prerendered[i_trial].draw()
+        else:
+            for stim in self.layouts[i_trial]:
+                stim.draw()
+        draw_dur = time.perf_counter() - t_draw
+        self.win.flip()
+        onset_dur = time.perf_counter() - t_draw
+        self.send_trigger('stimuli')
+        if self.gaze_monitor is not None:
+            self.el.poll() # Samples from before the onset
+            self.gaze_monitor.start_trial(i_trial)
+        row = dict(trial, ran=1, order=i_trial)
+        row['stim_onset'] = self.clock.getTime()
+        row['draw_dur'] = draw_dur
+        row['onset_dur'] = onset_dur
+        self.check_draw_dur(draw_dur, onset_dur)
+        self.reset_port()
+        self.clock.wait(STIM_DUR)
+        if self.gaze_monitor is not None:
+            self.el.poll()
+            self.gaze_monitor.end_trial()
+
+        # Show the probe
+        if trial['probe_word'] is not None:
+            self.show_text(trial['probe_word'])
+            self.send_trigger('probe')
+            self.rt_clock.reset()
+            self.reset_port()
+
+            # Wait for a key press
+            self.input.clearEvents()
+            r = self.input.waitKeys(maxWait=RESPONSE_CUTOFF,
+                                    keyList=[KEYS['yes'], KEYS['no']],
+                                    timeStamped=self.rt_clock)
+            if r is not None:
+                self.send_trigger('response')
+                self.reset_port()
+                keypress, rt = r[0]
+                row['resp'] = keypress
+                row['rt'] = rt
+
+        self.win.flip(clearBuffer=True)
+        t_iti = self.clock.getTime()
+        self.trial_log.write(row) # Written to disk during the ITI
+        if PRERENDER:
+            self.prerender(i_trial + 1)
+        self.clock.wait(ITI - (self.clock.getTime() - t_iti))
+
+        return self.experimenter_control()
+
+    def check_draw_dur(self, draw_dur, onset_dur):
+        """ Keep track of how long it takes to draw the stimuli, and warn
+        if it takes more than half a frame
+        """
+        self.draw_durs.append(draw_dur)
+        self.onset_durs.append(onset_dur)
+        if draw_dur > self.win.monitorFramePeriod / 2:
+            print('Slow stimulus drawing: {:.1f} ms'.format(1000 * draw_dur))
+
+    def print_draw_durs(self):
+        durs = 1000 * np.array(self.draw_durs)
+        if len(durs) == 0:
+            return
+        msg = 'Stimulus drawing: {:.2f} ms median, {:.2f} ms max ' \
+              '(frame: {:.2f} ms)'
+        print(msg.format(np.median(durs), durs.max(),
+                         1000 * self.win.monitorFramePeriod))
+        durs = 1000 * np.array(self.onset_durs)
+        msg = 'Draw to onset flip: {:.2f} ms mean, {:.2f} ms SD'
+        print(msg.format(durs.mean(), durs.std()))
+
+    def eye_pos_check(self):
+        """ Check whether the dot is following the eye position
+        """
+        self.input.clearEvents()
+        while True:
+            # Check for control keypreses
+            r = self.input.getKeys(list(KEYS.values()))
+            if KEYS['break'] in r:
+                break
+            elif KEYS['accept'] in r:
+                self.drift_correct()
+
+            pos = self.eye_pos()
+            pos = dc.origin_eyelink2psychopy(pos)
+            self.eye_marker.pos = pos # Mark the current fixation
+
+            # Draw the stimuli
+            for s in self.eye_testers:
+                s.draw()
+            self.eye_marker.draw()
+            self.win.flip()
+
+    def open_logs(self):
+        """ Start the behavioral logfile and the log of triggers. Rows are
+        written as the session goes on (see `trial_log.py`).
+        """
+        trial_log.write_plan(self.log_fname, self.trial_info)
+        self.trial_log = trial_log.LogWriter(self.log_fname,
+                                             trial_log.TRIAL_COLUMNS)
+        trig_fname = '{}/{}-triggers.csv'.format(self.log_dir,
+                                                 self.start_time)
+        self.trigger_log = trial_log.LogWriter(trig_fname,
+                                               trial_log.TRIGGER_COLUMNS)
+
+    def sync_logs(self):
+        """ Make sure everything logged so far is on the disk
+        """
+        self.trial_log.sync()
+        self.trigger_log.sync()
 
-        # Draw the stimuli
-        for s in eye_testers:
-            s.draw()
-        eye_marker.draw()
-        win.flip()
+    def close_logs(self):
+        try:
+            self.trial_log.close()
+        finally:
+            self.trigger_log.close()
 
+    def close_devices(self):
+        """ Close the window and stop the eye-tracker
+        """
+        try:
+            self.win.close()
+        finally:
+            if self.in_meg_lab or self.replay_gaze is not None:
+                self.el.shutdown()
+
+    def run(self):
+        """ Coordinate the different parts of the experiment
+        """
 
-def run_exp():
-    """ Coordinate the different parts of the experiment
+        # A few tests before beginning the experiment
+        refcheck.check_refresh_rate(self.win, self.refresh_rate)
+        # self.eye_pos_check()
+
+        self.open_logs()
+        try:
+            # Instructions
+            for line in self.instruct_text:
+                self.instructions(line)
+
+            # Run the trials
+            if PRERENDER:
+                self.prerender(0)
+            for i_trial, trial in enumerate(self.trial_info):
+                status = self.run_trial(i_trial, trial)
+                if status == END_EXPERIMENT:
+                    break
+                # Prompt to take a break between blocks
+                if (i_trial > 0) and (i_trial % BLOCK_LENGTH == 0):
+                    self.sync_logs()
+                    if self.gaze_monitor is not None:
+                        self.gaze_monitor.print_summary(BLOCK_LENGTH)
+                    msg = "Take a brief break and let the experimenter " \
+                          "know when you're ready to go on."
+                    self.show_text(msg)
+                    self.input.waitKeys(keyList=['return'], maxWait=9999)
+                    self.show_text('Ready?')
+                    self.input.waitKeys(keyList=['return'], maxWait=9999)
+                    self.drift_correct()
+
+            self.print_draw_durs()
+            self.show_text('That was it -- thanks!')
+            self.input.waitKeys(keyList=['escape'], maxWait=30)
+        finally:
+            # Whatever happens, save what's been logged so far and close
+            # everything down
+            try:
+                self.close_logs()
+            finally:
+                self.close_devices()
+
+
+def run_exp(**kwargs):
+    """ Run one session. Keyword arguments are passed on to Session().
     """
-
-    # A few tests before beginning the experiment
-    refcheck.check_refresh_rate(win, refresh_rate)
-    # eye_pos_check()
-
-    # Instructions
-    for line in instruct_text:
-        instructions(line)
-
-    # Run the trials
-    for i_trial, trial in enumerate(trials):
-        status = run_trial(trial)
-        if status == END_EXPERIMENT:
-            break
-        # Prompt to take a break between blocks
-        if (i_trial > 0) and (i_trial % BLOCK_LENGTH == 0):
-            msg = "Take a brief break and let the experimenter " \
-                  "know when you're ready to go on."
-            show_text(msg)
-            event.waitKeys(keyList=['return'], maxWait=9999)
-            show_text('Ready?')
-            event.waitKeys(keyList=['return'], maxWait=9999)
-            drift_correct()
-
-    # Save the data
-    fname = '{}/{}.csv'.format(LOG_DIR, START_TIME)
-    trials.saveAsWideText(fname, encoding='ASCII',
-                          delim=';', fileCollisionMethod='rename')
-
-    show_text('That was it -- thanks!')
-    event.waitKeys(keyList=['escape'], maxWait=30)
-
-    # Close everything down
-    win.close()
-    if IN_MEG_LAB:
-        el.shutdown()
-    core.quit()
-
+    session = Session(**kwargs)
+    session.run()
+    if not session.headless:
+        from psychopy import core
+        core.quit()
+    return session
@@ -1,33 +1,124 @@
 """
 Plot the images used in this study
+
+All the images are put together into one contact sheet. The images are
+decoded at reduced size (JPEG draft mode) in parallel threads, shrunk to
+thumbnails, and pasted into a single array, which is plotted once.
+Thumbnails are cached in `stimuli/thumbnails/`, keyed by a hash of the
+image file, so they're only remade when an image changes.
+
+Usage: python plot_stimuli.py [category ...]
+  With no categories, all the images in `stimuli.yaml` are plotted.
 """
 
 import os
+import sys
+import hashlib
 import yaml
 import numpy as np
 import matplotlib.pyplot as plt
-
-plt.ion()
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
 
 STIM_DIR = '../stimuli/'
-assert os.path.exists(STIM_DIR), 'Stimuli directory does not exist'
-
-# Load info about which images to use
-with open(f"stimuli.yaml") as f:
-    stim_info = yaml.load(f, Loader=yaml.SafeLoader)
-stims_to_show = []
-for stims in stim_info.values():
-    stims_to_show.extend(stims)
-stims_to_show = np.array(stims_to_show)
-
-plt.clf()
-for i_plot, i_stim in enumerate(stims_to_show):
-    img_fname = f'{STIM_DIR}{i_stim}.jpg'
-    img = plt.imread(img_fname)
-    plt.subplot(7, 7, i_plot + 1)
-    plt.imshow(img)
+THUMB_DIR = f'{STIM_DIR}thumbnails/'
+THUMB_SIZE = 150 # Size of each image on the contact sheet (pix)
+BACKGROUND = 255 # Fill around images that aren't square
+
+
+def load_stim_info():
+    """ Load info about which images are in each category
+    """
+    with open(f"stimuli.yaml") as f:
+        stim_info = yaml.load(f, Loader=yaml.SafeLoader)
+    return stim_info
+
+
+def select_stims(categories=None):
+    """ List of image IDs in the given categories (default: all of them)
+    """
+    stim_info = load_stim_info()
+    if categories is None:
+        categories = list(stim_info.keys())
+    for cat in categories:
+        assert cat in stim_info, f'Unknown category: {cat}'
+    stims_to_show = []
+    for cat in categories:
+        stims_to_show.extend(stim_info[cat])
+    return stims_to_show
+
+
+def thumbnail(img_fname, size=THUMB_SIZE, use_cache=True):
+    """ Read an image and shrink it to fit in a square of `size` pix.
+    Returns a (size, size, 3) uint8 array.
+    """
+    with open(img_fname, 'rb') as f:
+        img_bytes = f.read()
+    img_hash = hashlib.sha1(img_bytes).hexdigest()[:16]
+    cache_fname = f'{THUMB_DIR}{img_hash}-{size}.npy'
+    if use_cache and os.path.exists(cache_fname):
+        return np.load(cache_fname)
+
+    img = Image.open(img_fname)
+    img.draft('RGB', (size, size)) # Decode JPEGs at a smaller scale
+    img = img.convert('RGB')
+    img.thumbnail((size, size), Image.LANCZOS)
+    thumb = np.full((size, size, 3), BACKGROUND, dtype=np.uint8)
+    h, w = img.height, img.width
+    top = (size - h) // 2
+    left = (size - w) // 2
+    thumb[top:top + h, left:left + w] = np.asarray(img)
+
+    if use_cache:
+        os.makedirs(THUMB_DIR, exist_ok=True)
+        np.save(cache_fname, thumb)
+    return thumb
+
+
+def contact_sheet(stim_ids, size=THUMB_SIZE, n_cols=None, n_jobs=None,
+                  use_cache=True):
+    """ Put thumbnails of all the images into one array.
+    Returns the array and the number of columns.
+    """
+    n = len(stim_ids)
+    if n_cols is None:
+        n_cols = int(np.ceil(np.sqrt(n)))
+    n_rows = int(np.ceil(n / n_cols))
+    fnames = [f'{STIM_DIR}{i_stim}.jpg' for i_stim in stim_ids]
+    with ThreadPoolExecutor(n_jobs) as pool: # PIL decodes without the GIL
+        thumbs = pool.map(lambda fn: thumbnail(fn, size, use_cache), fnames)
+        sheet = np.full((n_rows * size, n_cols * size, 3), BACKGROUND,
+                        dtype=np.uint8)
+        for i, thumb in enumerate(thumbs):
+            row, col = divmod(i, n_cols)
+            sheet[row * size:(row + 1) * size,
+                  col * size:(col + 1) * size] = thumb
+    return sheet, n_cols
+
+
+def plot_stimuli(categories=None, out_fname=None, size=THUMB_SIZE):
+    """ Plot the images as a grid with their IDs, and save the figure
+    """
+    assert os.path.exists(STIM_DIR), 'Stimuli directory does not exist'
+    if out_fname is None:
+        out_fname = f'{STIM_DIR}stim_selection.png'
+    stims_to_show = select_stims(categories)
+    sheet, n_cols = contact_sheet(stims_to_show, size)
+
+    plt.clf()
+    plt.imshow(sheet)
+    for i, i_stim in enumerate(stims_to_show):
+        row, col = divmod(i, n_cols)
+        plt.text(col * size + 2, row * size + 2, i_stim,
+                 ha='left', va='top', fontsize=6,
+                 bbox={'facecolor': 'white', 'edgecolor': 'none',
+                       'pad': 0.5})
     plt.axis('off')
-    plt.title(i_stim)
+    plt.tight_layout()
+    plt.savefig(out_fname, dpi=200)
+    return out_fname
+
 
-plt.tight_layout()
-plt.savefig(f'{STIM_DIR}stim_selection.png')
+if __name__ == '__main__':
+    categories = sys.argv[1:] or None
+    plot_stimuli(categories)
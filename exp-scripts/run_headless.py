@@ -0,0 +1,20 @@
+""" Simulate a whole session in virtual time, without a screen, keyboard,
+triggers or eye-tracker, to check the timing and the logfiles.
+
+Usage: python run_headless.py [n_trials] [replay_gaze]
+"""
+
+import sys
+import time
+import main
+
+n_trials = int(sys.argv[1]) if len(sys.argv) > 1 else None
+replay_gaze = sys.argv[2] if len(sys.argv) > 2 else None
+
+t0 = time.perf_counter()
+session = main.run_exp(headless=True, n_trials=n_trials,
+                       replay_gaze=replay_gaze, seed=0)
+t_real = time.perf_counter() - t0
+t_virtual = session.clock.getTime()
+print('Simulated {:.0f} s of the experiment in {:.1f} s ({} flips)'.format(
+    t_virtual, t_real, session.win.n_flips))
@@ -0,0 +1,229 @@
+"""
+Write the logfiles one row at a time while the experiment is running
+
+Rows are handed to a background thread, so writing to disk never holds up
+the frame loop. The thread flushes the file whenever it runs out of rows to
+write, and `sync()` (called at block breaks) forces everything onto the
+disk. If the experiment crashes, everything up to the last trial or two is
+still in the logfile.
+
+The behavioral logfile has the same `;`-delimited columns as
+`TrialHandler.saveAsWideText`, so the analysis can read it as before.
+At the start of the session, the whole list of trials is saved to
+`<start time>-plan.csv`. If a session crashed, `recover()` combines the plan
+and the partial logfile into a complete one, with `ran` = 0 for the trials
+that weren't run (like `saveAsWideText` does). Logfiles are never appended
+to or overwritten: if the experiment is restarted in the same minute, the
+new session's files get a suffix (`session_name()`).
+
+Usage: python trial_log.py ../logfiles/<start time>.csv
+"""
+
+import os
+import sys
+import queue
+import threading
+
+# Columns of the behavioral logfile
+TRIAL_COLUMNS = ['ran', 'order',
+                 'stim_left', 'stim_center', 'stim_right',
+                 'probe_word', 'fix_dur',
+                 'stim_onset', 'resp', 'rt',
+                 'draw_dur', # Time to draw the stimuli (s)
+                 'onset_dur'] # From drawing to the flip at onset (s)
+PLAN_COLUMNS = ['order',
+                'stim_left', 'stim_center', 'stim_right',
+                'probe_word', 'fix_dur']
+TRIGGER_COLUMNS = ['time', 'trigger', 'value']
+DELIM = ';'
+
+_SYNC = 'sync' # Messages to the writer thread
+_CLOSE = 'close'
+WAIT_POLL = 0.5 # How often to check that the writer thread is alive (s)
+
+
+def session_name(log_dir, start_time):
+    """ Name for the files of a session that doesn't clash with an earlier
+    session, e.g. after restarting a crashed session in the same minute.
+    Adds _1, _2, ... to the start time like PsychoPy's 'rename'.
+    """
+    name = start_time
+    n = 0
+    while any(os.path.exists(f'{log_dir}/{name}{end}')
+              for end in ('.csv', '-plan.csv', '-triggers.csv')):
+        n += 1
+        name = f'{start_time}_{n}'
+    return name
+
+
+def format_row(row, columns):
+    """ Make one line of a logfile from a dict
+    """
+    vals = []
+    for col in columns:
+        v = row.get(col)
+        if v is None:
+            v = ''
+        elif isinstance(v, float):
+            v = repr(float(v)) # Also for numpy floats
+        vals.append(str(v))
+    return DELIM.join(vals) + '\n'
+
+
+class LogWriter(object):
+    """ Append rows to a logfile from a background thread
+
+    fname: Logfile to write. It must not exist yet.
+    columns: Names of the columns
+
+    If writing fails (e.g. the disk is full), the error is raised by the next
+    call to `sync()` or `close()`.
+    """
+
+    def __init__(self, fname, columns):
+        self.fname = fname
+        self.columns = list(columns)
+        self.file = open(fname, 'x', newline='') # Never append to old logs
+        self.file.write(DELIM.join(self.columns) + '\n')
+        self.queue = queue.Queue()
+        self.n_rows = 0
+        self.error = None # Exception raised in the writer thread
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def write(self, row):
+        """ Add a row (a dict of column: value). This only puts the row in a
+        queue, so it's safe to call between frames.
+        """
+        self.queue.put(row)
+        self.n_rows += 1
+
+    def _wait(self, kind):
+        """ Send a message to the writer thread and wait until it's handled.
+        Raises the writer thread's error if it failed.
+        """
+        done = threading.Event()
+        self.queue.put((kind, done))
+        while not done.wait(WAIT_POLL):
+            if not self.thread.is_alive():
+                break
+        if self.error is not None:
+            raise IOError(f'Could not write {self.fname}') from self.error
+
+    def sync(self):
+        """ Wait until every row so far is on the disk (e.g. at block breaks)
+        """
+        self._wait(_SYNC)
+
+    def close(self):
+        """ Write everything that's left and close the file
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self._wait(_CLOSE)
+        self.thread.join()
+
+    def _run(self):
+        try:
+            self._write_rows()
+        except Exception as e:
+            self.error = e
+            self.file.close()
+            # Don't leave sync() or close() waiting for this thread
+            while True:
+                try:
+                    msg = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if isinstance(msg, tuple):
+                    msg[1].set()
+
+    def _write_rows(self):
+        f = self.file
+        while True:
+            msg = self.queue.get()
+            if isinstance(msg, dict):
+                f.write(format_row(msg, self.columns))
+                if self.queue.empty():
+                    f.flush()
+                continue
+            kind, done = msg
+            f.flush()
+            os.fsync(f.fileno())
+            if kind == _CLOSE:
+                f.close()
+                done.set()
+                return
+            done.set()
+
+
+def plan_fname(log_fname):
+    """ Name of the file with the list of planned trials
+    """
+    return os.path.splitext(log_fname)[0] + '-plan.csv'
+
+
+def write_plan(log_fname, trial_info):
+    """ Save the whole list of trials at the start of the session
+    """
+    with open(plan_fname(log_fname), 'x', newline='') as f:
+        f.write(DELIM.join(PLAN_COLUMNS) + '\n')
+        for order, trial in enumerate(trial_info):
+            row = dict(trial, order=order)
+            f.write(format_row(row, PLAN_COLUMNS))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def read_rows(fname):
+    """ Read a logfile as a list of dicts (of strings). A last line that was
+    cut off in the middle (e.g. by a crash) is skipped.
+    """
+    with open(fname, newline='') as f:
+        lines = f.read().split('\n')
+    header = lines[0].split(DELIM)
+    rows = []
+    # Every complete line ends in a newline, so the last piece is either
+    # empty or a partly-written line
+    for line in lines[1:-1]:
+        vals = line.split(DELIM)
+        if len(vals) != len(header):
+            print('Skipping a damaged line:', line)
+            continue
+        rows.append(dict(zip(header, vals)))
+    if lines[-1]:
+        print('Skipping an incomplete last line:', lines[-1])
+    return header, rows
+
+
+def recover(log_fname, out_fname=None):
+    """ Make a complete behavioral logfile from the partial logfile of a
+    session that crashed, and the list of planned trials.
+
+    out_fname: Where to save the complete logfile
+               (default: <start time>-recovered.csv)
+    Returns the name of the recovered logfile.
+    """
+    if out_fname is None:
+        out_fname = os.path.splitext(log_fname)[0] + '-recovered.csv'
+    _, plan = read_rows(plan_fname(log_fname))
+    _, logged = read_rows(log_fname)
+    logged = {row['order']: row for row in logged}
+    n_ran = 0
+    with open(out_fname, 'w', newline='') as f:
+        f.write(DELIM.join(TRIAL_COLUMNS) + '\n')
+        for trial in plan:
+            if trial['order'] in logged:
+                row = logged[trial['order']]
+                n_ran += 1
+            else:
+                row = dict(trial, ran=0)
+            f.write(format_row(row, TRIAL_COLUMNS))
+    print(f'Recovered {n_ran} of {len(plan)} trials: {out_fname}')
+    return out_fname
+
+
+if __name__ == '__main__':
+    recover(sys.argv[1])